@@ -1,90 +1,552 @@
-from collections import defaultdict
-import pandas as pd
+#the streaming detectors (what the edge runtime uses) only need the standard library when timestamps are int
+#epoch seconds; pandas/numpy are imported inside the functions that need them (pandas timestamps, dataframe and
+#batch helpers, offline notebooks), so importing this module does not load them
+from collections import OrderedDict
+import heapq
 import math
+import sys
+import numbers
+import hashlib
+import csv
+from array import array
+from zip_index import ZipIndex, index_path_for, zip_key, coord
 
-#counter for how many unique cards one merchant sees in a 30s window
-class MerchantWindow:
+#function to convert a timestamp to whole epoch seconds
+#ints are taken as epoch seconds already, anything else (pd.Timestamp, datetime, string) goes through pandas
+def epoch_seconds(ts):
+    #plain ints first, the isinstance check against the numbers ABC costs more than the rest of a window update
+    if type(ts) is int:
+        return ts
+    if isinstance(ts, numbers.Integral):
+        return int(ts)
+    import pandas as pd
+    #pandas stores timestamps as ns since epoch, floor divide down to whole seconds
+    return pd.Timestamp(ts).value // 1_000_000_000
+
+#function to find the bucket for a timestamp and the oldest bucket to keep
+#returns (bucket, cutoff, bucket_start)
+#int_epoch=True keys buckets on plain ints (epoch_s // window) and skips the pandas floor/Timedelta work
+#int_epoch=False keeps the original pd.Timestamp bucket keys
+def window_bucket(ts, window_s, keep_windows, int_epoch=False):
+    if int_epoch:
+        bucket = epoch_seconds(ts) // window_s
+        #bucket start in epoch seconds for logs
+        return bucket, bucket - keep_windows, bucket * window_s
+    import pandas as pd
+    bucket = pd.to_datetime(ts).floor(f"{window_s}s")
+    return bucket, bucket - pd.Timedelta(seconds=window_s * keep_windows), bucket
+
+#idle times are tracked in steps of ttl_s / TTL_STEPS (see BoundedState._used)
+TTL_STEPS = 64
+
+#size and idle limits shared by the per key state of all detectors
+#max_entries caps keys per detector (least recently used dropped first), ttl_s drops keys idle for longer than that
+#(a key is never dropped before ttl_s idle, and at most 3 steps of ttl_s / TTL_STEPS after)
+#None for both keeps everything (the original behaviour)
+class StatePolicy:
+    def __init__(self, max_entries=None, ttl_s=None):
+        self.max_entries = None if max_entries is None else int(max_entries)
+        self.ttl_s = None if ttl_s is None else float(ttl_s)
+        self.ttl_step = None if ttl_s is None else self.ttl_s / TTL_STEPS
+        #event clock (newest timestamp seen in epoch seconds), shared so idle time is measured the same everywhere
+        self.now = None
+
+    #true if this policy ever evicts anything
+    def bounded(self):
+        return self.max_entries is not None or self.ttl_s is not None
+
+#dict of key -> per key state kept in least recently used order
+#touch()/put() move a key to the back and drop keys from the front that are over the size limit or idle past the ttl
+#each key is dropped at most once per insert so eviction is amortised O(1)
+#with only a ttl, the order is by touch step: a key is moved back (and its touch time refreshed) once per ttl step,
+#not on every use
+class BoundedState(OrderedDict):
+    def __init__(self, policy=None, factory=None):
+        super().__init__()
+        self.policy = policy if policy is not None else StatePolicy()
+        self.factory = factory
+        #key -> event time of its last touch (only kept when there is a ttl)
+        self.touched = {}
+        #number of keys dropped so far
+        self.evictions = 0
+        #clock time of the next idle scan (start of the next ttl step)
+        self._sweep_at = float("-inf")
+
+    #get the value for key (creating it with factory if needed) and mark it as just used at time ts
+    def touch(self, key, ts=None):
+        if not self.policy.bounded():
+            #unbounded, plain dict behaviour
+            value = self.get(key)
+            if value is None:
+                value = self[key] = self.factory()
+            return value
+        if key in self:
+            value = self[key]
+        else:
+            value = self[key] = self.factory()
+        self._used(key, ts)
+        return value
+
+    #set the value for key and mark it as just used at time ts
+    def put(self, key, value, ts=None):
+        self[key] = value
+        if self.policy.bounded():
+            self._used(key, ts)
+
+    #function to record a use of key (moving it to the back) and drop whatever the policy no longer allows
+    def _used(self, key, ts):
+        p = self.policy
+        if p.ttl_s is None:
+            self.move_to_end(key)
+        else:
+            #advance the shared event clock
+            now = p.now
+            if ts is not None:
+                t = epoch_seconds(ts)
+                if now is None or t > now:
+                    p.now = now = t
+            if p.max_entries is not None:
+                #the size limit needs exact LRU order
+                self.move_to_end(key)
+            #a key's touch time is only refreshed once it is a whole step behind the clock, so it can be up to a
+            #step older than the key's last use (the idle scan allows for that)
+            t_key = self.touched.get(key)
+            if t_key is None or now is None or now - t_key >= p.ttl_step:
+                if p.max_entries is None:
+                    self.move_to_end(key)
+                self.touched[key] = now
+            #drop keys idle for longer than the ttl, once per step of the clock (front of the order is the least
+            #recently used); the cutoff only depends on the step, so a scan is the same whenever in the step it runs
+            if now is not None and now >= self._sweep_at:
+                step = now // p.ttl_step
+                self._sweep_at = (step + 1) * p.ttl_step
+                cutoff = (step - 1) * p.ttl_step - p.ttl_s
+                while len(self) > 1:
+                    old = next(iter(self))
+                    t_old = self.touched.get(old)
+                    if t_old is None or t_old >= cutoff:
+                        break
+                    self._drop(old)
+        if p.max_entries is not None:
+            while len(self) > p.max_entries:
+                self._drop(next(iter(self)))
+
+    def _drop(self, key):
+        self.discard(key)
+        self.evictions += 1
+
+    #remove key (not counted as an eviction, e.g. when its detector state is empty)
+    def discard(self, key):
+        if key in self:
+            del self[key]
+        self.touched.pop(key, None)
+
+    #counters for sizing the policy
+    def stats(self):
+        return {"live": len(self), "evictions": self.evictions}
+
+    #function to copy the key order, touch times and eviction count (values are copied by the owning detector)
+    def export_meta(self):
+        keys = list(self.keys())
+        touched = [self.touched.get(k) for k in keys] if self.touched else None
+        return keys, touched, self.evictions
+
+    #function to take a quick copy of the entries (in LRU order), touch times and eviction count
+    #only for values that are never changed in place (the tuples kept by CardEWMA, ImpossibleTravel and the
+    #warmup marks), so a snapshot can copy under a short lock and build its columns after (see export_columns)
+    def capture(self):
+        if self.policy.bounded():
+            items = list(self.items())
+        else:
+            #unbounded state is never reordered, so the plain dict order is the LRU order (and much faster to copy)
+            items = list(dict.items(self))
+        return items, (dict(self.touched) if self.touched else None), self.evictions
+
+    #function to split a capture (default a fresh one) into keys, values, touch times and eviction count
+    def export_columns(self, captured=None):
+        items, touched, evictions = captured if captured is not None else self.capture()
+        keys = [k for k, _ in items]
+        values = [v for _, v in items]
+        touched = [touched.get(k) for k in keys] if touched else None
+        return keys, values, touched, evictions
+
+    #function to replace the contents with keys/values in LRU order plus their touch times (see export_meta)
+    def import_meta(self, keys, values, touched, evictions):
+        self.clear()
+        self.touched.clear()
+        self.update(zip(keys, values))
+        if touched is not None:
+            self.touched.update((k, t) for k, t in zip(keys, touched) if t is not None)
+        self.evictions = evictions
+        self._sweep_at = float("-inf")
+
+#ordered expiry queue for window buckets, driven by event time
+#buckets are filed in a slot per bucket key (slot -> keys that opened that bucket) with a heap of slot keys,
+#so advancing the clock pops whole slots oldest first and each bucket is expired once (amortised O(1) per update)
+#the heap holds one entry per bucket key still open (about keep_windows), not one per key, so it does not grow with
+#the number of keys; what does grow is how often an update opens (and later expires) a bucket, see
+#pos_metrics cardinality
+class BucketExpiry:
+    def __init__(self):
+        #bucket key -> list of outer keys with that bucket open
+        self.slots = {}
+        #min heap of bucket keys that have a slot
+        self.heap = []
+        #oldest bucket key still kept (everything older has been expired)
+        self.cutoff = None
+        #number of buckets expired so far
+        self.expired = 0
+
+    #function to file a newly opened bucket for key
+    def add(self, bucket, key):
+        slot = self.slots.get(bucket)
+        if slot is None:
+            slot = self.slots[bucket] = []
+            heapq.heappush(self.heap, bucket)
+        slot.append(key)
+
+    #function to move the cutoff forward and return the (bucket, key) pairs that are now too old
+    #the cutoff never moves backwards, so late events do not bring old buckets back into range
+    def advance(self, cutoff):
+        if self.cutoff is not None and not (cutoff > self.cutoff):
+            return []
+        self.cutoff = cutoff
+        expired = []
+        while self.heap and self.heap[0] < cutoff:
+            bucket = heapq.heappop(self.heap)
+            for key in self.slots.pop(bucket):
+                expired.append((bucket, key))
+        self.expired += len(expired)
+        return expired
+
+#HyperLogLog sketch to estimate how many distinct items have been added in fixed memory
+#error is the relative standard error (1.04 / sqrt(registers)), e.g. 0.02 -> 4096 one byte registers
+class HyperLogLog:
+    def __init__(self, error=0.02):
+        #smallest power of two register count that meets the error bound (4..16 index bits)
+        self.p = min(16, max(4, math.ceil(math.log2((1.04 / float(error)) ** 2))))
+        self.m = 1 << self.p
+        self.registers = bytearray(self.m)
+        #running sum of 2^-register and count of empty registers, so estimate() is O(1)
+        self.inv_sum = float(self.m)
+        self.zeros = self.m
+
+    #function to rebuild a sketch from saved registers
+    @classmethod
+    def from_registers(cls, error, registers):
+        h = cls(error)
+        h.registers = bytearray(registers)
+        h.inv_sum = sum(2.0 ** -r for r in h.registers)
+        h.zeros = h.registers.count(0)
+        return h
+
+    #function to hash an item to 64 bits (stable across processes, unlike hash())
+    @staticmethod
+    def hash64(item):
+        return int.from_bytes(hashlib.blake2b(repr(item).encode(), digest_size=8).digest(), "big")
+
+    def add(self, item):
+        h = self.hash64(item)
+        #first p bits pick the register, the rest give the rank (position of the first 1 bit)
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        old = self.registers[idx]
+        if rank > old:
+            self.registers[idx] = rank
+            self.inv_sum += 2.0 ** -rank - 2.0 ** -old
+            if old == 0:
+                self.zeros -= 1
+
+    def estimate(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / self.inv_sum
+        #small range correction (linear counting)
+        if raw <= 2.5 * m and self.zeros:
+            return m * math.log(m / self.zeros)
+        return raw
+
+    def __len__(self):
+        return int(round(self.estimate()))
+
+#set of distinct items that switches to a HyperLogLog sketch once it holds more than exact_limit items
+#counts are exact in the low range the thresholds care about, and memory stops growing for busy keys
+class ApproxDistinct:
+    def __init__(self, error=0.02, exact_limit=64):
+        self.error = error
+        self.exact_limit = exact_limit
+        self.items = set()
+        self.sketch = None
+
+    def add(self, item):
+        if self.sketch is not None:
+            self.sketch.add(item)
+            return
+        self.items.add(item)
+        if len(self.items) > self.exact_limit:
+            #promote to a sketch and let go of the set
+            self.sketch = HyperLogLog(self.error)
+            for it in self.items:
+                self.sketch.add(it)
+            self.items = None
+
+    def __len__(self):
+        if self.sketch is not None:
+            #never report fewer than the exact count we had before promoting
+            return max(len(self.sketch), self.exact_limit + 1)
+        return len(self.items)
+
+    #function to copy to plain values for snapshots
+    def export(self):
+        if self.sketch is not None:
+            return (self.error, self.exact_limit, None, bytes(self.sketch.registers))
+        return (self.error, self.exact_limit, list(self.items), None)
+
+    @classmethod
+    def from_export(cls, saved):
+        error, exact_limit, items, registers = saved
+        a = cls(error, exact_limit)
+        if registers is not None:
+            a.items = None
+            a.sketch = HyperLogLog.from_registers(error, registers)
+        else:
+            a.items = set(items)
+        return a
+
+#functions to copy a window bucket (set or ApproxDistinct) to plain values and back
+def _export_items(items):
+    if isinstance(items, ApproxDistinct):
+        return ("hll", items.export())
+    return ("set", list(items))
+
+def _import_items(saved):
+    kind, value = saved
+    if kind == "hll":
+        return ApproxDistinct.from_export(value)
+    return set(value)
+
+#counter for how many unique items one key sees in a 30s window (shared by MerchantWindow and CardWindow)
+#buckets are kept for keep_windows behind the newest event of ANY key (one event clock, see BucketExpiry), not
+#behind each key's own newest event as before; for time ordered input the counts are the same
+#an event late enough that its bucket is behind that horizon is counted on its own (count 1) and not stored, even
+#if per key pruning would still have kept that key's bucket (pinned by tests/test_window_expiry.py)
+class DistinctWindow:
     #construct object set window to 30s
-    def __init__(self, window_s=30, keep_windows=10):
+    #int_epoch=True buckets on integer epoch seconds instead of pd.Timestamps (same flags, less pandas work)
+    #policy (StatePolicy) bounds how many keys are kept
+    #counter builds the distinct container per bucket (set for exact counts, ApproxDistinct for HLL)
+    def __init__(self, window_s=30, keep_windows=10, int_epoch=False, policy=None, counter=set):
         self.window = window_s
         self.keep_windows = keep_windows
-        #for each mercahnt create a nested dictionary
-        #outer dict -> key:merchant_id, value:inner dict
-        #inner dict -> key:bucket timestamp, value:set of card_ids
-        self.counts = defaultdict(lambda: defaultdict(set))
+        self.int_epoch = int_epoch
+        self.counter = counter
+        #start of the bucket used by the last update (read by the baseline wrappers for logs)
+        self.bucket_start = None
+        #nested dictionary
+        #outer dict -> key:merchant_id/card_id, value:inner dict
+        #inner dict -> key:bucket, value:set of card_ids/merchant_ids
+        self.counts = BoundedState(policy, factory=dict)
+        #expiry queue that drops buckets older than keep_windows behind the newest event, for every key
+        self.expiry = BucketExpiry()
 
     #main method called for each tx
+    #returns current count of unique items for this key in this window (after adding item)
+    def update(self, key, ts, item):
+        #converts timestamp into bucket key and the oldest bucket key we keep
+        bucket, cutoff, self.bucket_start = window_bucket(ts, self.window, self.keep_windows, self.int_epoch)
+        if self.expiry.cutoff is not None and bucket < self.expiry.cutoff:
+            #too late, the bucket has been expired for every key already
+            return 1
+        buckets = self.counts.touch(key, ts)
+        items = buckets.get(bucket)
+        #first item in this bucket for this key, open it and file it for expiry
+        if items is None:
+            items = buckets[bucket] = self.counter()
+            self.expiry.add(bucket, key)
+        #add item to the set (cannot have duplicates so only new items are counted)
+        items.add(item)
+        n = len(items)
+
+        #garbage collector, drop every key's buckets that the event clock has moved past
+        #keys left with no buckets are removed as well
+        for old, k in self.expiry.advance(cutoff):
+            kb = self.counts.get(k)
+            if kb is None:
+                #key already evicted by the state policy
+                continue
+            kb.pop(old, None)
+            if not kb:
+                self.counts.discard(k)
+        return n
+
+    def stats(self):
+        st = self.counts.stats()
+        st["buckets"] = sum(len(b) for b in self.counts.values())
+        return st
+
+    #function to copy the state to plain values (for snapshots)
+    def export_state(self):
+        keys, touched, evictions = self.counts.export_meta()
+        buckets = [[(b, _export_items(v)) for b, v in self.counts[k].items()] for k in keys]
+        return {"keys": keys, "buckets": buckets, "touched": touched,
+                "evictions": evictions, "cutoff": self.expiry.cutoff}
+
+    #function to load state saved by export_state (rebuilds the expiry queue)
+    def import_state(self, saved):
+        self.expiry = BucketExpiry()
+        values = []
+        for k, bl in zip(saved["keys"], saved["buckets"]):
+            values.append({b: _import_items(v) for b, v in bl})
+            for b, _ in bl:
+                self.expiry.add(b, k)
+        self.expiry.cutoff = saved["cutoff"]
+        self.counts.import_meta(saved["keys"], values, saved["touched"], saved["evictions"])
+
+#counter for how many unique cards one merchant sees in a 30s window
+class MerchantWindow(DistinctWindow):
     #takes args merchant_id, timestamp, and card_id
     #returns current count of unique card_ids in this 30s window (after adding this card_id)
     def update(self, merchant_id, ts, card_id):
-        #converts timestamp into bucket start time (pd.to_datetime ensure ts is a timestamp (not a string, etc.)
-        bucket = pd.to_datetime(ts).floor(f"{self.window}s")
-        #adds this card to the set for this merchant and bucket (cannot have duplicates so only new cards are added)
-        buckets = self.counts[merchant_id]
-        buckets[bucket].add(card_id)
-        #add small garbage collector to drop buckets after N windows
-        cutoff = bucket - pd.Timedelta(seconds=self.window * self.keep_windows)
-        #create list of keys for this merchant with bucket timestamps older than cutoff
-        old = [b for b in list(buckets.keys()) if b < cutoff]
-        for b in old:
-            del buckets[b]
-        #return number of unique card_ids in thsi merchant/bucket set
-        return len(buckets[bucket])
+        return super().update(merchant_id, ts, card_id)
 
 #counter for how many unique merchants one card sees in a 30s window
-class CardWindow:
-    def __init__(self, window_s=30, keep_windows=10):
+class CardWindow(DistinctWindow):
+    #returns number of unique merchant seen for this card/bucket (after adding this merchant_id)
+    def update(self, card_id, ts, merchant_id):
+        return super().update(card_id, ts, merchant_id)
+
+#exact sliding window version of DistinctWindow, counts distinct items a key has seen in the last window_s seconds
+#(so a burst straddling a 30s bucket boundary is not split in two)
+#per key it keeps item -> last seen time in time order, old items drop off the front, so amortised O(1) per update
+#and memory is bounded by the distinct items inside one window
+#timestamps are ints (epoch seconds) or anything epoch_seconds takes; a late event is counted at the key's newest time
+class SlidingDistinctWindow:
+    def __init__(self, window_s=30, policy=None):
         self.window = window_s
-        self.keep_windows = keep_windows
-        #for each card create a nested dictionary
-        #outer dict -> key:card_id, value:inner dict
-        #inner dict -> key:bucket timestamp, value:set of merchant_ids
-        self.counts = defaultdict(lambda: defaultdict(set))
+        #keys (not items) that have gone quiet are dropped through the expiry queue, slot = epoch_s // window
+        self.expiry = BucketExpiry()
+        #outer dict -> key:merchant_id/card_id, value: ordered dict of item -> last seen epoch seconds
+        self.counts = BoundedState(policy, factory=OrderedDict)
+        #start of the tumbling bucket for the last update (kept so logs look the same as the bucket mode)
+        self.bucket_start = None
 
-    def update(self, card_id, ts, merchant_id):
-        #converts timestamp into bucket start time (pd.to_datetime ensure ts is a timestamp (not a string, etc.)
-        ts = pd.to_datetime(ts)
-        bucket = ts.floor(f"{self.window}s")
-        #get/create dictionary for this card_id
-        buckets = self.counts[card_id]
-        #add this merchant id to set for this card and bucket
-        buckets[bucket].add(merchant_id)
-
-        #calculate oldest bucekt we keep's timestamp
-        cutoff = bucket - pd.Timedelta(seconds=self.window * self.keep_windows)
-        #find buckets older than cutoff bucket
-        #wrap 'buckets.keys()' as list to allow deletion safely
-        old_buckets = [b for b in list(buckets.keys()) if b < cutoff]
-            
-        #delete the old buckets
-        for b in old_buckets:
-            del buckets[b]
+    def update(self, key, ts, item):
+        t = epoch_seconds(ts)
+        slot = t // self.window
+        self.bucket_start = slot * self.window
+        seen = self.counts.touch(key, ts)
+        #clamp late events to the key's newest time so the dict stays in time order
+        if seen:
+            newest = seen[next(reversed(seen))]
+            if t < newest:
+                t = newest
+        #move item to the back with its new last seen time
+        seen.pop(item, None)
+        seen[item] = t
+        #drop items last seen window_s or more seconds ago
+        oldest = t - self.window
+        while True:
+            first = next(iter(seen))
+            if seen[first] > oldest:
+                break
+            del seen[first]
+        n = len(seen)
+        self.expiry.add(slot, key)
+
+        #drop keys with nothing seen in the last window (filed 2 slots back or more)
+        for old, k in self.expiry.advance(slot - 1):
+            kd = self.counts.get(k)
+            if kd and kd[next(reversed(kd))] <= t - self.window:
+                self.counts.discard(k)
+        return n
+
+    def stats(self):
+        st = self.counts.stats()
+        st["items"] = sum(len(d) for d in self.counts.values())
+        return st
+
+    #function to copy the state to plain values (for snapshots)
+    def export_state(self):
+        keys, touched, evictions = self.counts.export_meta()
+        items = [list(self.counts[k].items()) for k in keys]
+        return {"keys": keys, "items": items, "touched": touched,
+                "evictions": evictions, "cutoff": self.expiry.cutoff}
+
+    #function to load state saved by export_state (rebuilds the expiry queue)
+    def import_state(self, saved):
+        self.expiry = BucketExpiry()
+        values = []
+        for k, il in zip(saved["keys"], saved["items"]):
+            values.append(OrderedDict(il))
+            if il:
+                self.expiry.add(il[-1][1] // self.window, k)
+        self.expiry.cutoff = saved["cutoff"]
+        self.counts.import_meta(saved["keys"], values, saved["touched"], saved["evictions"])
 
-        #return number of unique merchant seen for this card/bucket
-        return len(buckets[bucket])
+#function to build the window counter for a baseline
+#window_mode "tumbling" = 30s buckets (original), "sliding" = exact last window_s seconds
+#counter is the per bucket distinct container (tumbling only)
+def make_window(cls, window_mode, window_s, keep_windows, int_epoch, policy, counter=set):
+    if window_mode == "tumbling":
+        return cls(window_s, keep_windows, int_epoch, policy, counter)
+    if window_mode == "sliding":
+        if counter is not set:
+            raise ValueError("approximate distinct counting is only available with window_mode='tumbling'")
+        return SlidingDistinctWindow(window_s, policy)
+    raise ValueError(f"unknown window_mode {window_mode!r} (use 'tumbling' or 'sliding')")
 
 #baseline rule wrapper class
 class MerchantBaseline:
-    def __init__(self, threshold=6, window_s=30, keep_windows=10):
+    #distinct="hll" swaps the per bucket card sets for ApproxDistinct (exact up to hll_exact_limit cards,
+    #then a HyperLogLog sketch with relative error hll_error) for busy merchants
+    def __init__(self, threshold=6, window_s=30, keep_windows=10, int_epoch=False, policy=None, window_mode="tumbling",
+                 distinct="exact", hll_error=0.02, hll_exact_limit=64):
         #threshold for how many cards per merchant/bucket before flag
         self.th = threshold
-        #counter from above which counts unique cards per mechant/bucket
-        self.win = MerchantWindow(window_s, keep_windows)
+        self.window_mode = window_mode
+        self.distinct = distinct
+        if distinct == "exact":
+            counter = set
+        elif distinct == "hll":
+            #exact counting has to cover the threshold or flags near it would be approximate
+            if hll_exact_limit < threshold:
+                raise ValueError("hll_exact_limit must be at least the threshold")
+            counter = lambda: ApproxDistinct(hll_error, hll_exact_limit)
+        else:
+            raise ValueError(f"unknown distinct mode {distinct!r} (use 'exact' or 'hll')")
+        #keep the parameters so an empty copy can be made (see spawn)
+        self.params = dict(threshold=threshold, window_s=window_s, keep_windows=keep_windows, int_epoch=int_epoch,
+                           window_mode=window_mode, distinct=distinct, hll_error=hll_error, hll_exact_limit=hll_exact_limit)
+        #counter from above which counts unique cards per mechant/bucket (or per last window_s seconds when sliding)
+        self.win = make_window(MerchantWindow, window_mode, window_s, keep_windows, int_epoch, policy, counter)
+
+    #function to make a new baseline with the same parameters and empty state
+    def spawn(self):
+        return MerchantBaseline(**self.params)
 
     def update(self, merchant_id, ts, card_id):
         #run the update methoid from window class above
         n = self.win.update(merchant_id, ts, card_id)
         #decide if the count crosses the threshold
         flag = n >= self.th
-        #retuirm flag and some context for logs
-        return flag, {"unique_cards": n, "bucket": pd.to_datetime(ts).floor(f"{self.win.window}s")}
+        #retuirm flag and some context for logs (bucket already worked out by the window)
+        return flag, {"unique_cards": n, "bucket": self.win.bucket_start}
 
 class CardBaseline:
-    def __init__(self, threshold=4, window_s=30, keep_windows=10):
+    def __init__(self, threshold=4, window_s=30, keep_windows=10, int_epoch=False, policy=None, window_mode="tumbling"):
         #thrshold for how many unique merchants per card/bucket before flag
         self.th = threshold
+        self.window_mode = window_mode
+        #keep the parameters so an empty copy can be made (see spawn)
+        self.params = dict(threshold=threshold, window_s=window_s, keep_windows=keep_windows, int_epoch=int_epoch,
+                           window_mode=window_mode)
         #counter from above
-        self.win = CardWindow(window_s, keep_windows)
+        self.win = make_window(CardWindow, window_mode, window_s, keep_windows, int_epoch, policy)
+
+    #function to make a new baseline with the same parameters and empty state
+    def spawn(self):
+        return CardBaseline(**self.params)
 
     def update(self, card_id, ts, merchant_id):
         #run the update method from window class
@@ -92,7 +554,7 @@ class CardBaseline:
         #see if the count crosses threshold
         flag = m >= self.th
         #return flag and some context
-        return flag, {"unique_merchants": m, "bucket": pd.to_datetime(ts).floor(f"{self.win.window}s")}
+        return flag, {"unique_merchants": m, "bucket": self.win.bucket_start}
 
 #simple class to create a cap for transaction amount
 class AmountCap:
@@ -106,7 +568,7 @@ class AmountCap:
     
 #class to adapt amount rule per card based on Exponentially Weighted Moving Average on log(amount)
 class CardEWMA:
-    def __init__(self, alpha=0.2, k=3.0, initial=5, min_gate=None):
+    def __init__(self, alpha=0.2, k=3.0, initial=5, min_gate=None, policy=None):
         #alpha is the smoothing factor, changes how reactive the model is
         self.alpha = float(alpha)
         #k is the threshold in standdard deviations
@@ -116,27 +578,24 @@ class CardEWMA:
         #minimum amount for flag
         self.min_gate = None if (min_gate == None) else float(min_gate)
 
+        #per card state, card_id -> (mu, mu2, seen)
         #mu is per card EWMA of the mean, E[x]
-        self.mu = defaultdict(float)
-        #the per card EWMA of the second moment, E[x^2] (to derive variance)
-        self.mu2 = defaultdict(float)
-        #per card count of buckets seen already
-        self.seen = defaultdict(int)
+        #mu2 is the per card EWMA of the second moment, E[x^2] (to derive variance)
+        #seen is per card count of buckets seen already
+        #bounded by policy (StatePolicy)
+        self.state = BoundedState(policy)
     
     #update state for a card with latest transaction amount
+    #ts (optional) is the tx time, only used for the idle ttl of the state policy
     #returns (flag, info) where flag is true if z >= k and info is a log of z scores and log_amounts
-    def update(self, card_id, amount):
+    def update(self, card_id, amount, ts=None):
         #convert amount to log(amount) so z scores are more comaparable across cards with different spend habits
         #take max of 0.01 and amount to avoid log(0) and negaitve numbers
         x = math.log(max(float(amount),0.01)) 
 
         a = self.alpha
-        #how many buckets we've seen for this card
-        s = self.seen[card_id]
-
-        #get previous EWMA values
-        mu_prev = self.mu[card_id]
-        mu2_prev = self.mu2[card_id]
+        #get previous EWMA values and how many buckets we've seen for this card
+        mu_prev, mu2_prev, s = self.state.get(card_id, (0.0, 0.0, 0))
 
         #if enough buckets have been seen, calculate variance, std. dev. and z score
         if (s >= self.initial):
@@ -169,12 +628,91 @@ class CardEWMA:
             mu2 = a * (x*x) + (mu2_prev*(1-a))
 
         #update variables for this card
-        self.mu[card_id] = mu
-        self.mu2[card_id] = mu2
-        self.seen[card_id] = s + 1
+        self.state.put(card_id, (mu, mu2, s + 1), ts)
 
         return flag, {"z": z, "log_amount": x}
 
+    #batch version of update for arrays of card ids and amounts in time order
+    #starts from the current per card state, so it can pick up after streaming (or seed it)
+    #returns (flags, z, state) where flags/z are numpy arrays per row and state is card_id -> (mu, mu2, seen) after the last row
+    #commit=True also writes that state back so streaming update() carries on where the batch ended
+    def update_batch(self, card_ids, amounts, commit=True):
+        import numpy as np
+        import pandas as pd
+        codes, cards = pd.factorize(np.asarray(card_ids, dtype=object))
+        amt = np.asarray(amounts, dtype=float)
+        n = len(amt)
+        #math.log (not np.log) so results are bit for bit the same as update()
+        x = np.fromiter(map(math.log, np.maximum(amt, 0.01)), dtype=float, count=n)
+
+        #seed per card arrays from the current state
+        prev = [self.state.get(c, (0.0, 0.0, 0)) for c in cards]
+        mu = np.array([p[0] for p in prev], dtype=float)
+        mu2 = np.array([p[1] for p in prev], dtype=float)
+        seen = np.array([p[2] for p in prev], dtype=np.int64)
+
+        #position of each row within its own card's rows, then group rows by that position
+        #each group has at most one row per card, so one numpy step updates every card at once
+        rank = pd.Series(codes).groupby(codes).cumcount().to_numpy()
+        order = np.argsort(rank, kind="stable")
+        bounds = np.searchsorted(rank[order], np.arange(rank.max() + 2)) if n else np.zeros(1, dtype=np.int64)
+
+        a = self.alpha
+        flags = np.zeros(n, dtype=bool)
+        z = np.zeros(n)
+        for r in range(len(bounds) - 1):
+            rows = order[bounds[r]:bounds[r + 1]]
+            c = codes[rows]
+            xr = x[rows]
+            s = seen[c]
+            mu_prev = mu[c]
+            mu2_prev = mu2[c]
+
+            #score the rows whose card is past warm up (same float ops and order as update())
+            warm = s >= self.initial
+            if warm.any():
+                var = np.maximum(mu2_prev[warm] - (mu_prev[warm] * mu_prev[warm]), 0.0)
+                sigma = np.sqrt(var)
+                zr = np.zeros(len(sigma))
+                big = sigma > 1e-8
+                zr[big] = (xr[warm][big] - mu_prev[warm][big]) / sigma[big]
+                gate_ok = True if self.min_gate is None else (amt[rows][warm] >= self.min_gate)
+                z[rows[warm]] = zr
+                flags[rows[warm]] = (zr >= self.k) & gate_ok
+
+            #first tx for a card starts the averages, otherwise EWMA formula
+            first = s == 0
+            mu[c] = np.where(first, xr, a * xr + (mu_prev * (1 - a)))
+            mu2[c] = np.where(first, xr * xr, a * (xr * xr) + (mu2_prev * (1 - a)))
+            seen[c] = s + 1
+
+        state = {card: (float(mu[i]), float(mu2[i]), int(seen[i])) for i, card in enumerate(cards)}
+        if commit:
+            self.load_state(state)
+        return flags, z, state
+
+    #function to seed per card state from a dict of card_id -> (mu, mu2, seen)
+    #e.g. the state returned by update_batch over historical data
+    def load_state(self, state):
+        for card, (mu, mu2, seen) in state.items():
+            self.state.put(card, (mu, mu2, seen))
+
+    def stats(self):
+        return self.state.stats()
+
+    #function to copy the state to plain columns (for snapshots)
+    #captured is a state.capture() taken earlier (e.g. under a lock), default is the current state
+    def export_state(self, captured=None):
+        keys, values, touched, evictions = self.state.export_columns(captured)
+        mu, mu2, seen = zip(*values) if keys else ((), (), ())
+        return {"keys": keys, "mu": array("d", mu), "mu2": array("d", mu2), "seen": array("q", seen),
+                "touched": touched, "evictions": evictions}
+
+    #function to load state saved by export_state
+    def import_state(self, saved):
+        self.state.import_meta(saved["keys"], zip(saved["mu"], saved["mu2"], saved["seen"]),
+                               saved["touched"], saved["evictions"])
+
 #function to turn string to only digits for zip codes
 def digits_only(s):
     return "".join(ch for ch in str(s) if ch.isdigit())
@@ -193,39 +731,61 @@ def haversine_km(lat1, lon1, lat2, lon2):
     #return haversine distance
     return h_dist
 
+#function to check for a missing value (None or NaN) without pandas
+def is_missing(v):
+    if v is None:
+        return True
+    try:
+        #NaN is the only value not equal to itself
+        return bool(v != v)
+    except TypeError:
+        return True
+
 #class to create zip code -> (lat, long) lookup table
+#source can be the zip CSV or a binary index built by zip_index.py
+#if a built index sits next to the CSV (and is not older than it) that is memory mapped instead of reading the CSV
+#use_index=False always reads the CSV
 class ZipToCoord:
-    def __init__(self, source):
-        #read csv as dataframe
-        df = pd.read_csv(source, dtype={"ZIP": str}, low_memory=False)
+    def __init__(self, source, use_index=True):
+        index_path = index_path_for(source) if use_index else None
+        if index_path is not None:
+            #binary search over the mapped index, no pandas or dict build
+            self._index = ZipIndex(index_path)
+            self._map = None
+            return
+        self._index = None
 
-        #apply digits only function to all of zip column 
-        df["ZIP"] = df["ZIP"].map(digits_only)
-
-        #create dictionary of zip -> (lat, long)
-        self._map = {z: (float(lat), float(lon))
-                     for z, lat, lon in zip(df["ZIP"], df["LAT"], df["LNG"])}
+        #read the csv with the stdlib reader and create dictionary of zip key -> (lat, long)
+        #keys and coords are read the same way as build_index, so lookups match with or without the index
+        self._map = {}
+        with open(source, newline="") as f:
+            rows = csv.reader(f)
+            header = next(rows)
+            zi, la, lo = header.index("ZIP"), header.index("LAT"), header.index("LNG")
+            for row in rows:
+                key = zip_key(row[zi])
+                if key is not None:
+                    self._map[key] = (coord(row[la]), coord(row[lo]))
 
     #fucntion to get coords for zip code
     def get(self, zip_code):
         #ensure no missing values
-        if pd.isna(zip_code):
+        if is_missing(zip_code):
             return (None, None)
-        #get only digits
-        z = digits_only(zip_code)
-
-        #return coords for zip code 'z' or None if z doesn't exist
-        return self._map.get(z, (None, None))
+        if self._index is not None:
+            return self._index.get(zip_code)
+        #return coords for the zip or None if it doesn't exist
+        return self._map.get(zip_key(zip_code), (None, None))
     
 #class to detect impossible travel distances/times between taps of a card
 class ImpossibleTravel:
-    def __init__(self, zip_lookup=None, vmax_kmh=500.0, min_km=100.0, min_dt_s=60.0):
+    def __init__(self, zip_lookup=None, vmax_kmh=500.0, min_km=100.0, min_dt_s=60.0, policy=None):
         self.vmax = float(vmax_kmh)
         self.min_km = float(min_km)
         self.min_dt_s = float(min_dt_s)
         self.lookup = zip_lookup
-        #dict for state of card (card_id -> (lat, long, timestamp))
-        self.last = {}
+        #dict for state of card (card_id -> (timestamp, lat, long)), bounded by policy (StatePolicy)
+        self.last = BoundedState(policy)
 
     #return (lat, lon) as floats or None if unavailable
     def resolve_coords(self, zip_code=None, lat=None, lon=None):
@@ -238,39 +798,42 @@ class ImpossibleTravel:
         #if neither above work return None
         return (None, None)
 
+    #ts is int epoch seconds (stdlib only) or anything pd.to_datetime parses
     def update(self, card_id, ts, zip_code=None, lat=None, lon=None):
-        #parse ts as timestamp
-        ts = pd.to_datetime(ts)
+        #parse ts as timestamp, int epoch seconds are kept as they are
+        if not isinstance(ts, numbers.Integral):
+            import pandas as pd
+            ts = pd.to_datetime(ts)
 
         #resolve coords for current tap
         cur_lat, cur_lon = self.resolve_coords(zip_code=zip_code, lat=lat, lon=lon)
 
         #if coords unresolved, store state and dont raise flag
         if cur_lat is None or cur_lon is None:
-            self.last[card_id] = (ts, None, None)
+            self.last.put(card_id, (ts, None, None), ts)
             return False, {"reason": "no_coords", "speed_kmh": 0.0, "dist_km": 0.0, "dt_s": None}
 
 
         prev = self.last.get(card_id)
         #for the first tap, store state and dont raise flag
         if prev is None or prev[1] is None or prev[2] is None:
-            self.last[card_id] = (ts, cur_lat, cur_lon)
+            self.last.put(card_id, (ts, cur_lat, cur_lon), ts)
             return False, {"reason": "no_prev", "speed_kmh": 0.0, "dist_km": 0.0, "dt_s": None}
         
         prev_ts, prev_lat, prev_lon = prev
     
         #calculate time gap
-        dt_s = (ts - prev_ts).total_seconds()
+        dt_s = _seconds_between(prev_ts, ts)
         #ignore small gaps
         if dt_s <= self.min_dt_s:
-            self.last[card_id] = (ts, cur_lat, cur_lon)
+            self.last.put(card_id, (ts, cur_lat, cur_lon), ts)
             return False, {"reason": "short_gap", "speed_kmh": 0.0, "dist_km": 0.0, "dt_s": dt_s}
 
         #calc distance
         dist_km = haversine_km(prev_lat, prev_lon, cur_lat, cur_lon)
         #ignore small distances
         if dist_km < self.min_km:
-            self.last[card_id] = (ts, cur_lat, cur_lon)
+            self.last.put(card_id, (ts, cur_lat, cur_lon), ts)
             return False, { "reason": "short_dist", "speed_kmh": dist_km / (dt_s/3600.0), "dist_km": dist_km, "dt_s": dt_s}
 
         #calc implied speed
@@ -279,9 +842,56 @@ class ImpossibleTravel:
         flag = speed_kmh > self.vmax
 
         #update the state and return
-        self.last[card_id] = (ts, cur_lat, cur_lon)
+        self.last.put(card_id, (ts, cur_lat, cur_lon), ts)
         return flag, {"reason": "impossible" if flag else "ok", "speed_kmh": speed_kmh, "dist_km": dist_km, "dt_s": dt_s}
 
+    def stats(self):
+        return self.last.stats()
+
+    #function to copy the state to plain columns (for snapshots)
+    #timestamps are stored as int seconds when they are ints, int ns when they are pandas timestamps,
+    #lat/lon None is stored as NaN
+    #captured is a last.capture() taken earlier (e.g. under a lock), default is the current state
+    def export_state(self, captured=None):
+        keys, values, touched, evictions = self.last.export_columns(captured)
+        ts, lat, lon = zip(*values) if keys else ((), (), ())
+        if all(isinstance(t, numbers.Integral) for t in ts):
+            ts_col = ("s", array("q", ts))
+        elif "pandas" in sys.modules and all(isinstance(t, sys.modules["pandas"].Timestamp) for t in ts):
+            ts_col = ("ns", array("q", [t.value for t in ts]))
+        else:
+            ts_col = ("raw", list(ts))
+        nan = float("nan")
+        return {"keys": keys, "ts": ts_col,
+                "lat": array("d", [nan if v is None else v for v in lat]),
+                "lon": array("d", [nan if v is None else v for v in lon]),
+                "touched": touched, "evictions": evictions}
+
+    #function to load state saved by export_state
+    def import_state(self, saved):
+        kind, ts = saved["ts"]
+        if kind == "s":
+            ts = list(ts)
+        elif kind == "ns":
+            import numpy as np
+            import pandas as pd
+            ts = list(pd.to_datetime(np.frombuffer(ts, dtype=np.int64)))
+        lat = [None if v != v else v for v in saved["lat"]]
+        lon = [None if v != v else v for v in saved["lon"]]
+        self.last.import_meta(saved["keys"], zip(ts, lat, lon), saved["touched"], saved["evictions"])
+
+#function to get the seconds from prev_ts to ts (int epoch seconds or pandas timestamps)
+def _seconds_between(prev_ts, ts):
+    if isinstance(ts, numbers.Integral) and isinstance(prev_ts, numbers.Integral):
+        return float(ts - prev_ts)
+    import pandas as pd
+    #one side int seconds (state from before a switch of timestamp type), compare as pandas timestamps
+    if isinstance(ts, numbers.Integral):
+        ts = pd.to_datetime(ts, unit="s")
+    if isinstance(prev_ts, numbers.Integral):
+        prev_ts = pd.to_datetime(prev_ts, unit="s")
+    return (ts - prev_ts).total_seconds()
+
 #class to combine all of the edge rules set out above using logic OR into one edge flag
 class RuleCombiner:
     def __init__(self, merchant_baseline, card_baseline, amount_cap, card_ewma, travel):
@@ -292,31 +902,181 @@ class RuleCombiner:
         self.travel = travel
     
     #tx will be a dict with keys from dataset (timestamp, merchant_id, card_id, amount, zip)
-    #returen bool, True if any rule sets flag
-    def update(self, tx):
+    #returns dict of rule name -> bool flag for this tx
+    def rule_flags(self, tx):
         
-        #list to collect flags from each rule
-        flags = []
+        #dict to collect flags from each rule
+        flags = {}
         
         #merchant velocity rule (unique cards per merchant/30s) - returns (flag, info)
         f, _ = self.m.update(tx["merchant_id"], tx["timestamp"], tx["card_id"])
-        #add flag to flags list of rule fires
-        flags.append(f)
+        #add flag to flags dict of rule fires
+        flags["merchant_window"] = f
 
         #card burst rule (merchants per card/30s) - returns (flag, info)
         f, _ = self.c.update(tx["card_id"], tx["timestamp"], tx["merchant_id"])
-        flags.append(f)
+        flags["card_window"] = f
 
         #amount cap rule
-        flags.append(self.ac.update(tx["amount"]))
+        flags["amount_cap"] = self.ac.update(tx["amount"])
 
         #card EWMA amount rule - returns (flag, info)
         f, _ = self.ce.update(tx["card_id"], tx["amount"])
-        flags.append(f)
+        flags["card_ewma"] = f
 
         #location change rule
         f, _ = self.travel.update(tx["card_id"], tx["timestamp"], zip_code=tx.get("zip"), lat=tx.get("lat"), lon=tx.get("lon"))
-        flags.append(f)
+        flags["impossible_travel"] = f
 
+        return flags
+
+    #returen bool, True if any rule sets flag
+    def update(self, tx):
         #ruturns true if any rule fires
-        return any(flags)
\ No newline at end of file
+        return any(self.rule_flags(tx).values())
+
+    #batch version of update() for a whole dataframe sorted in stream order
+    #needs timestamp, merchant_id, card_id and amount columns (zip/lat/lon optional)
+    #returns a dataframe (same index as df) with one bool column per rule name from rule_flags() and an "flag" column
+    #rows are replayed as if streamed through fresh detectors with the same parameters, live state is not used or changed
+    def evaluate_frame(self, df):
+        import pandas as pd
+        out = pd.DataFrame(index=df.index)
+        ts = df["timestamp"]
+        #window rules are exact group counts as long as time never goes backwards
+        #(otherwise a late row can land in a bucket the streaming GC already dropped), so replay them if it does
+        in_order = pd.to_datetime(ts).is_monotonic_increasing if not pd.api.types.is_integer_dtype(ts) else ts.is_monotonic_increasing
+
+        #merchant velocity rule (sliding windows and HLL counts are replayed row by row)
+        mw = self.m.win
+        if in_order and self.m.window_mode == "tumbling" and self.m.distinct == "exact":
+            n = _frame_distinct_counts(df["merchant_id"], _frame_buckets(ts, mw.window, mw.int_epoch), df["card_id"])
+            out["merchant_window"] = n >= self.m.th
+        else:
+            fresh = self.m.spawn()
+            out["merchant_window"] = [fresh.update(m, t, c)[0] for m, t, c in zip(df["merchant_id"], ts, df["card_id"])]
+
+        #card burst rule
+        cw = self.c.win
+        if in_order and self.c.window_mode == "tumbling":
+            n = _frame_distinct_counts(df["card_id"], _frame_buckets(ts, cw.window, cw.int_epoch), df["merchant_id"])
+            out["card_window"] = n >= self.c.th
+        else:
+            fresh = self.c.spawn()
+            out["card_window"] = [fresh.update(c, t, m)[0] for c, t, m in zip(df["card_id"], ts, df["merchant_id"])]
+
+        #amount cap rule
+        out["amount_cap"] = df["amount"].astype(float).to_numpy() >= self.ac.cap
+
+        #card EWMA amount rule (fresh copy so live state is left alone)
+        fresh = CardEWMA(self.ce.alpha, self.ce.k, self.ce.initial, self.ce.min_gate)
+        out["card_ewma"], _, _ = fresh.update_batch(df["card_id"], df["amount"], commit=False)
+
+        #location change rule
+        out["impossible_travel"] = _frame_travel_flags(self.travel, df)
+
+        #logic OR of all rules
+        out["flag"] = out.any(axis=1)
+        return out
+
+#BATCH HELPERS (used by RuleCombiner.evaluate_frame)
+
+#function to get the same bucket keys for a timestamp column that window_bucket gives per row
+def _frame_buckets(ts, window_s, int_epoch):
+    import numpy as np
+    import pandas as pd
+    if int_epoch:
+        #ints are epoch seconds already, otherwise floor ns down to seconds
+        if pd.api.types.is_integer_dtype(ts):
+            secs = ts.to_numpy(dtype=np.int64)
+        else:
+            secs = pd.to_datetime(ts).to_numpy(dtype="datetime64[ns]").astype(np.int64) // 1_000_000_000
+        return secs // window_s
+    #pandas path floors the same way as pd.Timestamp.floor
+    return pd.to_datetime(ts).dt.floor(f"{window_s}s").to_numpy()
+
+#function to count distinct items per (key, bucket) as seen up to and including each row
+#a row only adds to the count the first time its item shows up in that key/bucket
+def _frame_distinct_counts(keys, buckets, items):
+    import numpy as np
+    import pandas as pd
+    k = pd.factorize(keys)[0]
+    b = pd.factorize(buckets)[0]
+    i = pd.factorize(items)[0]
+    frame = pd.DataFrame({"k": k, "b": b, "i": i})
+    first = (~frame.duplicated(["k", "b", "i"])).astype(np.int64)
+    return first.groupby([frame["k"], frame["b"]], sort=False).cumsum().to_numpy()
+
+#function to turn ns differences into seconds the same way pd.Timedelta.total_seconds does
+def _timedelta_seconds(ns):
+    us = ns // 1000
+    days = us // 86_400_000_000
+    rem = us - days * 86_400_000_000
+    return (days * 86400 + rem // 1_000_000) + (rem % 1_000_000) / 1e6
+
+#function to replay ImpossibleTravel over a dataframe using each card's previous row
+def _frame_travel_flags(it, df):
+    import numpy as np
+    import pandas as pd
+    n = len(df)
+    lat = np.full(n, np.nan)
+    lon = np.full(n, np.nan)
+    has = np.zeros(n, dtype=bool)
+
+    #rows with both lat and lon set use them directly (same "is not None" check as resolve_coords)
+    direct = np.zeros(n, dtype=bool)
+    if "lat" in df.columns and "lon" in df.columns:
+        lat_col = df["lat"].to_numpy(dtype=object)
+        lon_col = df["lon"].to_numpy(dtype=object)
+        direct = (lat_col != None) & (lon_col != None)
+        lat[direct] = lat_col[direct].astype(float)
+        lon[direct] = lon_col[direct].astype(float)
+        has |= direct
+
+    #everything else goes through the zip lookup, once per distinct zip
+    if it.lookup is not None and "zip" in df.columns and (~direct).any():
+        rest = np.flatnonzero(~direct)
+        codes, uniq = pd.factorize(df["zip"].to_numpy(dtype=object)[rest], use_na_sentinel=False)
+        coords = [it.lookup.get(z) for z in uniq]
+        u_has = np.array([c[0] is not None and c[1] is not None for c in coords], dtype=bool)
+        u_lat = np.array([c[0] if h else np.nan for c, h in zip(coords, u_has)], dtype=float)
+        u_lon = np.array([c[1] if h else np.nan for c, h in zip(coords, u_has)], dtype=float)
+        lat[rest] = u_lat[codes]
+        lon[rest] = u_lon[codes]
+        has[rest] = u_has[codes]
+
+    #previous row for the same card (stable sort keeps stream order within a card)
+    cards = pd.factorize(df["card_id"])[0]
+    order = np.argsort(cards, kind="stable")
+    same = np.zeros(n, dtype=bool)
+    same[1:] = cards[order][1:] == cards[order][:-1]
+    cur = order[1:][same[1:]]
+    prev = order[:-1][same[1:]]
+
+    #only rows where this tap and the previous tap both have coords can flag
+    ok = has[cur] & has[prev]
+    cur, prev = cur[ok], prev[ok]
+    #int timestamps are epoch seconds, as in ImpossibleTravel.update
+    if pd.api.types.is_integer_dtype(df["timestamp"]):
+        ns = df["timestamp"].to_numpy(dtype=np.int64) * 1_000_000_000
+    else:
+        ns = pd.to_datetime(df["timestamp"]).to_numpy(dtype="datetime64[ns]").astype(np.int64)
+    dt_s = _timedelta_seconds(ns[cur] - ns[prev])
+    keep = dt_s > it.min_dt_s
+    cur, prev, dt_s = cur[keep], prev[keep], dt_s[keep]
+
+    #vectorised haversine, same formula as haversine_km
+    p = np.radians
+    a = (np.sin(p(lat[cur] - lat[prev]) / 2) ** 2
+         + np.cos(p(lat[prev])) * np.cos(p(lat[cur])) * np.sin(p(lon[cur] - lon[prev]) / 2) ** 2)
+    dist_km = 2 * 6371 * np.arcsin(np.sqrt(a))
+    speed = dist_km / (dt_s / 3600.0)
+    #numpy trig can be an ulp off math, so redo rows sitting right on a threshold with haversine_km
+    close = (np.abs(dist_km - it.min_km) <= 1e-9 * max(it.min_km, 1.0)) | (np.abs(speed - it.vmax) <= 1e-9 * max(it.vmax, 1.0))
+    for j in np.flatnonzero(close):
+        dist_km[j] = haversine_km(lat[prev[j]], lon[prev[j]], lat[cur[j]], lon[cur[j]])
+        speed[j] = dist_km[j] / (dt_s[j] / 3600.0)
+
+    flags = np.zeros(n, dtype=bool)
+    flags[cur] = ~(dist_km < it.min_km) & (speed > it.vmax)
+    return flags
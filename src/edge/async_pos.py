@@ -0,0 +1,226 @@
+#asyncio POS loop: a tap runs as stages linked by queues instead of one blocking call after another
+#  detect   wait for the card, read its history and warm up the rules (card IO)
+#  evaluate run the rules on the new tx
+#  write    append the tx to the card and end the card session (card IO)
+#  log      append the tx to the CSV log (file IO)
+#blocking card calls run on one card thread (the SPI bus does one command at a time and the card session is per
+#thread), logging on a log thread, so the event loop only hands taps from stage to stage
+#the card is busy from detection until its write is done, the next customer's card is detected while the last
+#tap is still being logged
+import argparse
+import asyncio
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from edge.card_reader import make_reader, set_thread_reader
+from edge.edge_card import wait_for_card, read_recent_tx, pack_tx, write_recent_tx, end_session, Deadline
+from edge.edge_rules import EdgeRules
+from edge.reader_pool import MERCHANT_ID, TAP_BUDGET_MS, CARD_TIMEOUT_S
+from edge.demo_script import log_row, close_log
+
+#taps waiting between two stages (a full queue holds the stage before it back)
+STAGE_QUEUE = 4
+#amounts a card record can hold (signed 32 bit cents, see edge_card.TX_LAYOUT)
+AMOUNT_MIN = -2**31
+AMOUNT_MAX = 2**31 - 1
+
+#the tap loop, one reader and one EdgeRules
+#reader None uses the default reader (card_reader.get_reader)
+#log(tx, flag, reasons) is called on the log thread for every tap with a card (None = no log)
+#on_result(result) is called on the event loop once a tap's card write is done, before the next card is looked for
+#(a simulation swaps the card there)
+class AsyncTapLoop:
+    def __init__(self, rules, reader=None, merchant_id=MERCHANT_ID, budget_ms=TAP_BUDGET_MS,
+                 card_timeout=CARD_TIMEOUT_S, log=log_row, on_result=None):
+        self.rules = rules
+        self.reader = reader
+        self.merchant_id = merchant_id
+        self.budget_ms = budget_ms
+        self.card_timeout = card_timeout
+        self.log = log
+        self.on_result = on_result
+        self.stats = {"taps": 0, "flagged": 0, "no_card": 0, "write_failed": 0, "logged": 0}
+        self._tasks = []
+
+    #function to start the stage tasks (call from inside the running event loop)
+    def start(self):
+        #the card thread uses self.reader (None = the default reader)
+        self._card_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="card", initializer=set_thread_reader,
+                                           initargs=(self.reader,))
+        self._log_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log")
+        self._charges = asyncio.Queue()
+        self._to_eval = asyncio.Queue(STAGE_QUEUE)
+        self._to_write = asyncio.Queue(STAGE_QUEUE)
+        self._to_log = asyncio.Queue(STAGE_QUEUE)
+        #held from card detection until the tap's write is done
+        self._card_busy = asyncio.Lock()
+        self._tasks = [asyncio.create_task(stage()) for stage in (self._detect, self._evaluate, self._write, self._log)]
+        return self
+
+    #function to queue a charge, returns a future with the tap result (as ReaderPool.process), set once the card
+    #write is done (logging carries on in the background)
+    #raises ValueError for an amount the card record can't hold, before anything is queued
+    def charge(self, amount_cents, zip_code=None, merchant_id=None):
+        amount_cents = int(amount_cents)
+        if not AMOUNT_MIN <= amount_cents <= AMOUNT_MAX:
+            raise ValueError(f"amount_cents {amount_cents} is outside {AMOUNT_MIN}..{AMOUNT_MAX}")
+        fut = asyncio.get_running_loop().create_future()
+        merchant_id = self.merchant_id if merchant_id is None else int(merchant_id)
+        self._charges.put_nowait(({"amount_cents": amount_cents, "zip": zip_code,
+                                   "merchant_id": merchant_id}, fut))
+        return fut
+
+    #function to finish every queued charge and its log line, then stop the stages and their threads
+    async def stop(self):
+        self._charges.put_nowait(None)
+        await asyncio.gather(*self._tasks)
+        self._card_io.shutdown()
+        self._log_io.shutdown()
+
+    #function to run a blocking call on the card thread
+    def _card(self, fn, *args, **kw):
+        return asyncio.get_running_loop().run_in_executor(self._card_io, lambda: fn(*args, **kw))
+
+    #card thread: read the last 10 txs (fewer if the budget runs out) and warm up on them, oldest first
+    def _warmup(self, uid, deadline):
+        meta, recent = read_recent_tx(uid, max_count=10, deadline=deadline)
+        self.rules.warmup_from_card(uid.hex(), list(reversed(recent)), partial=deadline.partial)
+
+    #card thread: append the tx and end the card session while the card is still on the reader
+    def _append(self, uid, rec, deadline):
+        ok, msg = write_recent_tx(uid, rec, deadline=deadline)
+        end_session()
+        return ok, msg
+
+    #STAGES (each passes None on when it is done)
+
+    async def _detect(self):
+        while True:
+            item = await self._charges.get()
+            if item is None:
+                await self._to_eval.put(None)
+                return
+            charge, fut = item
+            #the previous tap's card must be written before looking for the next card
+            await self._card_busy.acquire()
+            try:
+                uid = await self._card(wait_for_card, timeout=self.card_timeout)
+                if uid:
+                    t0 = time.perf_counter()
+                    deadline = Deadline(self.budget_ms / 1000.0 if self.budget_ms > 0 else None)
+                    await self._card(self._warmup, uid, deadline)
+            except Exception as e:
+                self._card_busy.release()
+                fut.set_exception(e)
+                continue
+            if not uid:
+                self._card_busy.release()
+                self.stats["no_card"] += 1
+                fut.set_result({"card_id": None, "flag": False, "reasons": [], "ok": False, "msg": "no card",
+                                "tap": None, "ms": 0.0})
+                continue
+            await self._to_eval.put((charge, fut, uid, deadline, t0))
+
+    async def _evaluate(self):
+        while True:
+            item = await self._to_eval.get()
+            if item is None:
+                await self._to_write.put(None)
+                return
+            charge, fut, uid, deadline, t0 = item
+            tx = {
+                "timestamp": int(time.time()),
+                "merchant_id": charge["merchant_id"],
+                "card_id": uid.hex(),
+                "amount": charge["amount_cents"] / 100.0,
+                "amount_cents": charge["amount_cents"],
+                "zip": charge["zip"],
+                "lat": None,
+                "lon": None,
+            }
+            #microseconds of CPU, run on the loop
+            #a tap that fails here fails on its own (as in _detect), the stages carry on with the next one
+            try:
+                flag, reasons = self.rules.evaluate(tx)
+            except Exception as e:
+                self._card_busy.release()
+                fut.set_exception(e)
+                continue
+            await self._to_write.put((tx, flag, reasons, fut, uid, deadline, t0))
+
+    async def _write(self):
+        while True:
+            item = await self._to_write.get()
+            if item is None:
+                await self._to_log.put(None)
+                return
+            tx, flag, reasons, fut, uid, deadline, t0 = item
+            try:
+                rec = pack_tx(timestamp=tx["timestamp"], amount_cents=tx["amount_cents"],
+                              merchant_id=tx["merchant_id"], zip_code=tx["zip"], flags=1 if flag else 0)
+                ok, msg = await self._card(self._append, uid, rec, deadline)
+            except Exception as e:
+                self._card_busy.release()
+                fut.set_exception(e)
+                continue
+            self.stats["taps"] += 1
+            self.stats["flagged"] += 1 if flag else 0
+            self.stats["write_failed"] += 0 if ok else 1
+            result = {"card_id": tx["card_id"], "flag": flag, "reasons": reasons, "ok": ok, "msg": msg,
+                      "tap": deadline.report(), "ms": (time.perf_counter() - t0) * 1e3}
+            if self.on_result is not None:
+                self.on_result(result)
+            #the card is done, the next one can be detected while this tap is logged
+            self._card_busy.release()
+            fut.set_result(result)
+            await self._to_log.put((tx, flag, reasons))
+
+    async def _log(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._to_log.get()
+            if item is None:
+                return
+            if self.log is not None:
+                await loop.run_in_executor(self._log_io, self.log, *item)
+                self.stats["logged"] += 1
+
+#interactive loop: one line per charge on stdin, "<amount_cents> [zip]"
+async def main(args):
+    rules = EdgeRules(zip_csv_path="data/raw/zip_lat_long.csv")
+    reader = make_reader(args.reader) if args.reader else None
+
+    def show(result):
+        print(f"card {result['card_id']}: {'FLAGGED' if result['flag'] else 'OK'} {result['reasons']}  "
+              f"append: {result['ok']} {result['msg']}  {result['ms']:.0f} ms")
+
+    taps = AsyncTapLoop(rules, reader, merchant_id=args.merchant, budget_ms=args.budget_ms, on_result=show).start()
+    loop = asyncio.get_running_loop()
+    print("Enter '<amount_cents> [zip]' per charge and tap the card, Ctrl-D to quit.")
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        parts = line.split()
+        if not parts:
+            continue
+        try:
+            amount = int(parts[0])
+        except ValueError:
+            print("usage: <amount_cents> [zip]")
+            continue
+        try:
+            taps.charge(amount, parts[1] if len(parts) > 1 else None)
+        except ValueError as e:
+            print("Error:", e)
+    await taps.stop()
+    close_log()
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="asyncio POS loop (card detection, evaluation, card write and logging "
+                                            "as separate stages)")
+    p.add_argument("--reader", default=None)
+    p.add_argument("--merchant", type=int, default=MERCHANT_ID)
+    p.add_argument("--budget-ms", type=int, default=TAP_BUDGET_MS)
+    asyncio.run(main(p.parse_args()))
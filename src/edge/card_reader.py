@@ -0,0 +1,232 @@
+#card reader transports used by edge_card.py
+#"pn532" is the WaveShare PN532 on the Pi's SPI bus (hardware libraries only imported when it is opened),
+#several can share the bus on different chip select pins (one per checkout lane, see reader_pool.py)
+#"sim" is an in-memory MIFARE Classic 1K simulator so the card code can run and be benchmarked on any machine
+#pick one with the EDGE_READER environment variable (default pn532) or set_reader()
+import os
+import random
+import threading
+import time
+
+#environment variable that selects the reader when none has been set
+READER_ENV = "EDGE_READER"
+#environment variable listing the readers of a multi lane host (reader_pool.py), comma separated
+READERS_ENV = "EDGE_READERS"
+
+#MIFARE Classic 1K layout
+SECTORS = 16
+BLOCKS_PER_SECTOR = 4
+BLOCK_SIZE = 16
+#PN532 authentication commands
+AUTH_A = 0x60
+AUTH_B = 0x61
+#factory transport key and access bits (FF0780, user byte 69)
+DEFAULT_KEY = bytes([0xFF] * 6)
+DEFAULT_ACCESS = bytes([0xFF, 0x07, 0x80, 0x69])
+
+#SPI bus shared by every PN532 (each one has its own chip select), opened with the first reader
+_spi = None
+
+#function to open a PN532 over SPI (same wiring as pn532_uid.py by default)
+#cs/rst are board pin names: several readers share the SPI bus, each on its own chip select (and reset) pin
+#returns the driver object, which already has the read/auth/write methods edge_card uses
+def open_pn532(cs="D4", rst="D20"):
+    global _spi
+    import board
+    import busio
+    #library to use GPIO as digital input/output
+    from digitalio import DigitalInOut
+    from adafruit_pn532.spi import PN532_SPI
+
+    #initialise chip select (NSS) and reset pins as digital pins
+    #on WaveShare PN532 in SPI, NSS is on BCM4 (board.D4), RSTPDN on BCM20 (board.D20)
+    cs_pin = DigitalInOut(getattr(board, cs))
+    rst_pin = DigitalInOut(getattr(board, rst)) if rst else None
+    #initialise SPI bus using Pi's SPI pins (the driver locks the bus for each command)
+    if _spi is None:
+        _spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
+    pn = PN532_SPI(_spi, cs_pin, reset=rst_pin, debug=False)
+    #enable MiFARE communication
+    pn.SAM_configuration()
+    return pn
+
+#in-memory MIFARE Classic 1K card
+class SimulatedCard:
+    def __init__(self, uid=None, key_a=DEFAULT_KEY, key_b=DEFAULT_KEY):
+        self.uid = bytes(uid) if uid is not None else bytes(random.getrandbits(8) for _ in range(4))
+        self.blocks = [bytes(BLOCK_SIZE) for _ in range(SECTORS * BLOCKS_PER_SECTOR)]
+        #block 0 is the read only manufacturer block (uid + bcc)
+        bcc = 0
+        for b in self.uid[:4]:
+            bcc ^= b
+        self.blocks[0] = (self.uid[:4] + bytes([bcc]) + bytes(11))[:BLOCK_SIZE]
+        #sector trailers: key A, access bits, key B
+        for sector in range(SECTORS):
+            self.blocks[trailer_of(sector)] = bytes(key_a) + DEFAULT_ACCESS + bytes(key_b)
+
+    #function to get (key A, key B) of a sector from its trailer
+    def keys(self, sector):
+        t = self.blocks[trailer_of(sector)]
+        return t[0:6], t[10:16]
+
+#function to get the trailer block of a sector
+def trailer_of(sector):
+    return sector * BLOCKS_PER_SECTOR + BLOCKS_PER_SECTOR - 1
+
+#simulated PN532 with one card slot
+#models per command latency, one authenticated sector at a time, the card halting after a failed
+#auth (needs a reselect), random auth failures (RF noise) and the card leaving the field
+class SimulatedReader:
+    #latency is seconds per command, keys: select, auth, read, write
+    LATENCY = {"select": 0.010, "auth": 0.004, "read": 0.003, "write": 0.009}
+
+    def __init__(self, card=None, latency=None, auth_fail_rate=0.0, seed=None):
+        self.latency = dict(self.LATENCY)
+        if latency is not None:
+            self.latency.update(latency)
+        self.auth_fail_rate = float(auth_fail_rate)
+        self.rng = random.Random(seed)
+        self.card = None
+        #sector the card is authenticated to (None = not authenticated), halted after an error until reselected
+        self.sector = None
+        self.halted = False
+        #commands left before the card is pulled away (None = stays)
+        self.remove_in = None
+        #command counters
+        self.stats = {"select": 0, "auth": 0, "auth_fail": 0, "read": 0, "write": 0}
+        if card is not None:
+            self.present(card)
+
+    #function to put a card on the reader
+    def present(self, card):
+        self.card = card
+        self.sector = None
+        self.halted = False
+        self.remove_in = None
+
+    #function to take the card off the reader (after n more commands if given)
+    def remove(self, after=None):
+        if after is None:
+            self.card = None
+            self.sector = None
+        else:
+            self.remove_in = int(after)
+
+    #function to charge one command: wait its latency and pull the card if a removal is due
+    #returns the card if it is still in the field
+    def _command(self, kind):
+        self.stats[kind] += 1
+        delay = self.latency.get(kind, 0.0)
+        if delay:
+            time.sleep(delay)
+        if self.remove_in is not None:
+            if self.remove_in <= 0:
+                self.remove()
+                self.remove_in = None
+            else:
+                self.remove_in -= 1
+        return self.card
+
+    def SAM_configuration(self):
+        pass
+
+    #function to select the card in the field, returns its uid or None
+    def read_passive_target(self, timeout=1.0):
+        card = self._command("select")
+        if card is None:
+            #nothing in the field, the real reader waits out the timeout
+            time.sleep(min(timeout, 0.05))
+            return None
+        self.sector = None
+        self.halted = False
+        return card.uid
+
+    def mifare_classic_authenticate_block(self, uid, block_number, key_number, key):
+        card = self._command("auth")
+        self.sector = None
+        ok = (card is not None and not self.halted and bytes(uid) == card.uid
+              and key_number in (AUTH_A, AUTH_B) and 0 <= block_number < len(card.blocks))
+        if ok:
+            key_a, key_b = card.keys(block_number // BLOCKS_PER_SECTOR)
+            ok = bytes(key) == (key_a if key_number == AUTH_A else key_b)
+        if ok and self.auth_fail_rate and self.rng.random() < self.auth_fail_rate:
+            ok = False
+        if not ok:
+            #a failed auth halts the card, it has to be selected again
+            self.stats["auth_fail"] += 1
+            self.halted = True
+            return False
+        self.sector = block_number // BLOCKS_PER_SECTOR
+        return True
+
+    #function to check a block command can run (card present, not halted, sector authenticated)
+    def _can_access(self, card, block_number):
+        if card is None or self.halted or self.sector != block_number // BLOCKS_PER_SECTOR:
+            self.sector = None
+            self.halted = card is not None
+            return False
+        return True
+
+    def mifare_classic_read_block(self, block_number):
+        card = self._command("read")
+        if not self._can_access(card, block_number):
+            return None
+        data = card.blocks[block_number]
+        if block_number % BLOCKS_PER_SECTOR == BLOCKS_PER_SECTOR - 1:
+            #key A is never readable
+            data = bytes(6) + data[6:]
+        return bytearray(data)
+
+    def mifare_classic_write_block(self, block_number, data):
+        card = self._command("write")
+        if not self._can_access(card, block_number) or len(data) != BLOCK_SIZE or block_number == 0:
+            return False
+        card.blocks[block_number] = bytes(data)
+        return True
+
+#the reader used when no thread override is set (built on first use)
+_reader = None
+#per thread reader override (one worker thread per reader)
+_local = threading.local()
+
+#function to build the reader named by name (or the EDGE_READER environment variable)
+#"pn532" or "pn532:<cs pin>:<reset pin>" (e.g. pn532:D5:D21, empty reset pin for none), "sim"
+def make_reader(name=None):
+    name = (name or os.environ.get(READER_ENV) or "pn532").lower()
+    kind, _, pins = name.partition(":")
+    if kind == "pn532":
+        if not pins:
+            return open_pn532()
+        cs, _, rst = pins.partition(":")
+        return open_pn532(cs.upper(), rst.upper() or None)
+    if kind == "sim":
+        #a simulated reader with one blank card already on it
+        return SimulatedReader(SimulatedCard(uid=b"\x5e\x11\xca\x4d"))
+    raise ValueError(f"unknown reader {name!r} (use 'pn532', 'pn532:<cs>:<rst>' or 'sim')")
+
+#function to build every reader named in names (a list or comma separated string, default $EDGE_READERS)
+def make_readers(names=None):
+    if names is None:
+        names = os.environ.get(READERS_ENV) or os.environ.get(READER_ENV) or "pn532"
+    if isinstance(names, str):
+        names = [n.strip() for n in names.split(",") if n.strip()]
+    return [make_reader(n) for n in names]
+
+#function to get the reader for the calling thread
+def get_reader():
+    global _reader
+    reader = getattr(_local, "reader", None)
+    if reader is not None:
+        return reader
+    if _reader is None:
+        _reader = make_reader()
+    return _reader
+
+#function to set the default reader (a SimulatedReader, a PN532 driver, or None to rebuild from the environment)
+def set_reader(reader):
+    global _reader
+    _reader = reader
+
+#function to set (or clear with None) the reader used by the calling thread only
+def set_thread_reader(reader):
+    _local.reader = reader
@@ -1,14 +1,66 @@
 import sys
+import time
 import argparse
-from edge.edge_card import wait_for_card, format_card
+from edge.edge_card import wait_for_card, format_card, provision_card, io_stats, reset_io_stats
+
+#function to format cards one after another as they are tapped (card issuing)
+#each new card is formatted (only the blocks that are not blank already are written) and verified,
+#a card left on the reader is only done once; stops after count cards (0 = until Ctrl-C)
+def bulk_provision(keep_header=True, count=0, timeout=60):
+    done = 0
+    failed = 0
+    written = 0
+    skipped = 0
+    last = None
+    t_start = None
+    print("Tap cards one after another … keep each still until it is reported. Ctrl-C to stop.")
+    try:
+        while not count or done < count:
+            uid = wait_for_card(timeout=timeout)
+            if not uid:
+                print("No card detected.")
+                break
+            #still the card just done, wait for the next one
+            if uid == last:
+                time.sleep(0.1)
+                continue
+            last = uid
+            if t_start is None:
+                t_start = time.monotonic()
+            t0 = time.monotonic()
+            reset_io_stats()
+            ok, st = provision_card(uid, keep_header=keep_header, verify=True)
+            done += 1
+            failed += 0 if ok else 1
+            written += st["written"]
+            skipped += st["skipped"]
+            print(f"{done:4d} {uid.hex()} {'OK' if ok else 'FAILED'} - wrote {st['written']}, "
+                  f"skipped {st['skipped']}, failed {st['failed']}, auths {io_stats()['auths']}, "
+                  f"{(time.monotonic() - t0) * 1e3:.0f} ms")
+    except KeyboardInterrupt:
+        print()
+    if done:
+        #cards per minute from the first card, including the time to swap cards
+        minutes = max(time.monotonic() - t_start, 1e-9) / 60
+        print(f"{done} cards ({failed} failed) in {minutes * 60:.1f} s: {done / minutes:.1f} cards/min, "
+              f"{written} block writes, {skipped} skipped (already formatted)")
+    return failed == 0
 
 def main():
     #parse command line arguments
     parser = argparse.ArgumentParser(description="Clear the transaction history on an NFC card and reset header")
     #add argument to clear the header instead of resetting it
     parser.add_argument("--clear", action="store_true", help="Clear header (remove magic) instead of resetting it")
+    #write every block instead of only the ones that differ
+    parser.add_argument("--full", action="store_true", help="Write every block, even ones already blank")
+    #format cards as they are tapped until Ctrl-C (or --count cards)
+    parser.add_argument("--bulk", action="store_true", help="Format and verify cards one after another")
+    parser.add_argument("--count", type=int, default=0, help="With --bulk, stop after this many cards")
     args = parser.parse_args()
 
+    if args.bulk:
+        sys.exit(0 if bulk_provision(keep_header=not args.clear, count=args.count) else 1)
+
     #wait for a card to be tapped
     print("Tap card to clear/format … keep it still until done.")
     uid = wait_for_card(timeout=60)
@@ -17,9 +69,9 @@ def main():
         print("No card detected.")
         sys.exit(1)
     #if card is detected, reset or clear it
-    ok, info = format_card(uid, keep_header=not args.clear)
+    ok, info = format_card(uid, keep_header=not args.clear, diff=not args.full)
     #print result
     print("OK" if ok else "FAILED", "-", info)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,32 +1,38 @@
 #import libraries and functions
-import csv, time, os, datetime, random
+import time, datetime, random
 from edge.edge_rules import EdgeRules
-from edge.edge_card  import wait_for_card, read_recent_tx, pack_tx, write_recent_tx
+from edge.edge_card  import wait_for_card, read_recent_tx, pack_tx, write_recent_tx, end_session
+from edge.tx_log import TxLog
+from edge.pos_binlog import SUFFIX as BINLOG_SUFFIX
 
-#set path to log Tx records
+#set path to log Tx records (a path ending in .posb writes the binary log, see pos_binlog)
 LOG_PATH = "data/runs/pos_log.csv"
+#log writer for LOG_PATH, opened on the first row (see tx_log.TxLog)
+_log = None
+
+#function to get the log writer, reopened if LOG_PATH changed or it was closed
+def get_log():
+    global _log
+    if _log is None or _log.closed or _log.path != LOG_PATH:
+        if _log is not None:
+            _log.close()
+        _log = TxLog(LOG_PATH, fmt="bin" if LOG_PATH.endswith(BINLOG_SUFFIX) else "csv")
+    return _log
 
 #function to write row to log
+#only queues the row, the log's writer thread writes it (call close_log() or flush_log() to wait for it)
 def log_row(tx, edge_flag, reasons):
-    #make sure directory exists
-    os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
-    exists = os.path.exists(LOG_PATH)
-    #open the file
-    with open(LOG_PATH, "a", newline="") as f:
-        #create csv writer object
-        w = csv.writer(f)
-        #if the file doesn't exist, write the column names / metadata
-        if not exists:
-            w.writerow(["ts_iso","uid","amount_cents","merchant_id","flag","reasons"])
-        #write the transaction details to log
-        w.writerow([
-            datetime.datetime.fromtimestamp(tx["timestamp"]).isoformat(timespec="seconds"),
-            tx["card_id"],
-            tx["amount_cents"],
-            tx["merchant_id"],
-            int(edge_flag),
-            "|".join(reasons),
-        ])
+    get_log().append(tx, edge_flag, reasons)
+
+#function to wait until every row logged so far is in the file
+def flush_log():
+    if _log is not None:
+        _log.flush()
+
+#function to write the rows still queued and stop the log writer
+def close_log():
+    if _log is not None:
+        _log.close()
 
 #function to wait for next 30s window to start
 #used to ensure that the demo does not run too fast and trigger the same rules repeatedly
@@ -65,6 +71,8 @@ def eval_and_write(uid, rules, merchant_id, amount_cents=None, zipc=None, lat=No
     rec = pack_tx(tx["timestamp"], amount_cents, merchant_id, 1 if flag else 0)
     #write the detasils to the card
     ok, msg = write_recent_tx(uid, rec)
+    #end the card session while the card is still on the reader (writes back the cached header)
+    end_session()
     #show that the tx was recorded
     print("Append:", ok, msg)
     #log the transaction
@@ -194,6 +202,8 @@ def demo_walkthrough():
     uid = wait_for_card(timeout=60)
     eval_and_write(uid, rules, merchant_id=5002, zipc=90405, note="\n[Travel B]")
 
+    #write out the log
+    close_log()
     #print confirmation that script is finished
     print("\nDone.")
 
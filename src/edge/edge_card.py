@@ -1,26 +1,10 @@
 #file to store recent transactions on an NFC card
 #struct to pack/unpack integers to/from bytes
 import struct
+import threading
 import time
-import board
-import busio
-#library to use GPIO as digital input/output
-from digitalio import DigitalInOut
-
-from adafruit_pn532.spi import PN532_SPI
-
-#initialise chip select (NSS) and reset pins as digital pins
-#on WaveShare PN532 in SPI, NSS is on BCM4 (board.D4)
-CS_PIN   = DigitalInOut(board.D4)
-#RSTPDN on BCM20 (board.D20)
-RESET_PIN= DigitalInOut(board.D20)
-#initialise SPI bus using Pi's SPI pins
-spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
-
-#create instance of PN532 driver
-pn = PN532_SPI(spi, CS_PIN, reset=RESET_PIN, debug=False)
-#enable MiFARE communication
-pn.SAM_configuration()
+#the reader transport (real PN532 or the simulator) is picked by card_reader, not opened at import
+from edge.card_reader import get_reader
 
 #section to report memory usage of the POS loop
 #try and except to avoid breaking loop
@@ -53,8 +37,27 @@ TX_BLOCKS = [b for b in range(4, 64) if ((b + 1) % 4) != 0]
 #block 4 for header, leaves 44 blocks for transaction data
 TX_DATA_BLOCKS = TX_BLOCKS[1:]
 
+#MIFARE Classic 1K: 16 sectors of 4 blocks, one authentication covers every block in a sector
+BLOCKS_PER_SECTOR = 4
+
+#card IO counters (auths, block reads/writes, retries) for benchmarks, see io_stats()
+IO_STATS = {"auths": 0, "reads": 0, "writes": 0, "retries": 0, "recoveries": 0}
+
 #HELPER FUNCTIONS
 
+#function to get the sector number of a block
+def sector_of(block):
+    return block // BLOCKS_PER_SECTOR
+
+#function to get a copy of the card IO counters
+def io_stats():
+    return dict(IO_STATS)
+
+#function to zero the card IO counters
+def reset_io_stats():
+    for k in IO_STATS:
+        IO_STATS[k] = 0
+
 #calculate 16-bit checksum (2 byte masked sum)
 def sum16(b):
     #calculate the 16-bit sum of the byte array
@@ -63,17 +66,76 @@ def sum16(b):
 #function to try to authenticate a block with Key A, then Key B
 #returns True if authentication succeeds with either key
 def auth_any(uid, block):
+    IO_STATS["auths"] += 1
     #AUTH_A = 0x60 (defined by PN532)
-    return pn.mifare_classic_authenticate_block(uid, block, 0x60, KEY_A)
+    return get_reader().mifare_classic_authenticate_block(uid, block, 0x60, KEY_A)
+
+#TAP DEADLINE
+
+#retry backoff: first retry after BACKOFF_START_S, doubling up to BACKOFF_MAX_S (always cut short by a deadline)
+BACKOFF_START_S = 0.01
+BACKOFF_MAX_S = 0.1
+#longest single reader poll when selecting a card
+POLL_S = 0.2
+
+#time budget for one tap, passed down to every card call made for it
+#card calls stop retrying when it runs out and history reads return what they have
+#budget_s None = no limit (same retries as before, no early stop)
+#also collects what happened for the caller: retries used and whether history was cut short
+class Deadline:
+    def __init__(self, budget_s=None):
+        self.budget_s = budget_s
+        self.start = time.monotonic()
+        self.end = None if budget_s is None else self.start + budget_s
+        self.retries = 0
+        #set when a history read stopped early
+        self.partial = False
+        #set when the budget ran out before the header was read (no history at all, partial is set too)
+        self.no_header = False
+
+    #seconds left (inf if there is no budget)
+    def remaining(self):
+        if self.end is None:
+            return float("inf")
+        return max(0.0, self.end - time.monotonic())
+
+    def expired(self):
+        return self.end is not None and time.monotonic() >= self.end
+
+    #function to wait for the i-th retry backoff, cut to the time left
+    #returns False if there is no time left for another attempt
+    def backoff(self, i):
+        delay = min(BACKOFF_MAX_S, BACKOFF_START_S * (2 ** i), self.remaining())
+        if delay > 0:
+            time.sleep(delay)
+        return not self.expired()
+
+    #function to get the outcome of the tap so far
+    def report(self):
+        return {
+            "history": "none" if self.no_header else "partial" if self.partial else "full",
+            "retries": self.retries,
+            "elapsed_ms": (time.monotonic() - self.start) * 1e3,
+            "budget_ms": None if self.budget_s is None else self.budget_s * 1e3,
+            "expired": self.expired(),
+        }
+
+#deadline used when a caller does not pass one (never expires)
+def _no_deadline(deadline):
+    return deadline if deadline is not None else Deadline()
 
-#function to return card's UID or timeout after a set time
-def wait_for_card(timeout=None, stable_read=3):
+#function to return card's UID or timeout after a set time (or when deadline runs out)
+def wait_for_card(timeout=None, stable_read=3, deadline=None):
+    #a new tap starts a new card session (the card may have been written elsewhere since)
+    #the last card is probably gone, so callers flush with end_session() at the end of a tap instead
+    end_session(flush=False)
+    deadline = _no_deadline(deadline)
     t0 = time.time()
     last = None
     count = 0
     while True:
         #try to read NFC card UID
-        uid = pn.read_passive_target(timeout=0.2)
+        uid = get_reader().read_passive_target(timeout=min(POLL_S, deadline.remaining()))
         #if a card is detected
         if uid:
             #if the UID read is stable (same UID read multiple times), return it
@@ -88,149 +150,551 @@ def wait_for_card(timeout=None, stable_read=3):
         #if timeout is set and exceeded, return None
         if timeout and (time.time() - t0) > timeout:
             return None
+        if deadline.expired():
+            return None
 
-def reselect_card(uid, attempts=3):
+def reselect_card(uid, attempts=3, deadline=None):
+    deadline = _no_deadline(deadline)
     #try to reselect the card by reading its UID multiple times
     for _ in range(attempts):
+        if deadline.expired():
+            break
         #read the UID
-        uid2 = pn.read_passive_target(timeout=0.2)
+        uid2 = get_reader().read_passive_target(timeout=min(POLL_S, deadline.remaining()))
         #if UID is read and matches the original, return True
         if uid2 and uid2 == uid:
             return True
     #else return False
     return False
 
+#function to get ready for retry i (i >= 1) of a failed card command
+#reselects the card and backs off, returns False if the deadline leaves no time for the retry
+def _retry(uid, i, deadline):
+    IO_STATS["retries"] += 1
+    deadline.retries += 1
+    #if auth fails, try to reselect the card and try again
+    reselect_card(uid, deadline=deadline)
+    #wait a bit before retrying
+    return deadline.backoff(i - 1)
+
 #function to read a block from the card, authenticating first
-def read_block(uid, block, attempts=3):
+#the first attempt always runs, retries only while the deadline has time left
+def read_block(uid, block, attempts=3, deadline=None):
+    deadline = _no_deadline(deadline)
     #try to authenticate and read the block multiple times
-    for _ in range(attempts):
+    for i in range(attempts):
+        if i and not _retry(uid, i, deadline):
+            break
         #if auth succeeds, read the block and return it
         if auth_any(uid, block):
-            data = pn.mifare_classic_read_block(block)
+            IO_STATS["reads"] += 1
+            data = get_reader().mifare_classic_read_block(block)
             if data:
                 return data
-        #if auth fails, try to reselect the card and try again
-        reselect_card(uid)
-        #wait a bit before retrying
-        time.sleep(0.1)
     #if all attempts fail, return None
     return None
 
+#function to read several blocks with one authentication per sector
+#blocks are grouped by sector (in the order given), the sector is authenticated once and its blocks read back to back
+#if the auth or a read fails the rest of that sector falls back to read_block (auth + retries per block)
+#stops before the next sector once the deadline has run out (deadline.partial is set)
+#returns a dict of block -> 16 bytes (or None if the block could not be read)
+def read_blocks(uid, blocks, attempts=3, deadline=None):
+    deadline = _no_deadline(deadline)
+    #group blocks by sector, keeping the order the caller asked for
+    plan = {}
+    for b in blocks:
+        plan.setdefault(sector_of(b), []).append(b)
+
+    out = {b: None for b in blocks}
+    for sector_blocks in plan.values():
+        if deadline.expired():
+            deadline.partial = True
+            break
+        pending = list(sector_blocks)
+        if auth_any(uid, pending[0]):
+            while pending:
+                IO_STATS["reads"] += 1
+                data = get_reader().mifare_classic_read_block(pending[0])
+                if not data:
+                    break
+                out[pending.pop(0)] = data
+        if pending:
+            #the card drops its auth state after an error, so reselect before falling back
+            reselect_card(uid, deadline=deadline)
+            for b in pending:
+                if deadline.expired():
+                    deadline.partial = True
+                    break
+                out[b] = read_block(uid, b, attempts, deadline)
+    return out
+
 #function to write a block (16 bytes) to the card, authenticating first
-def write_block(uid, block, data, attempts=3):
+#the first attempt always runs, retries only while the deadline has time left
+def write_block(uid, block, data, attempts=3, deadline=None):
     if len(data) != 16:
         raise ValueError("Data must be exactly 16 bytes")
-    for _ in range(attempts):
+    deadline = _no_deadline(deadline)
+    for i in range(attempts):
+        if i and not _retry(uid, i, deadline):
+            break
         #if auth succeeds, write the block and return True if successful
         if auth_any(uid, block):
-            if pn.mifare_classic_write_block(block, data):
+            IO_STATS["writes"] += 1
+            if get_reader().mifare_classic_write_block(block, data):
                 return True
-        #if auth fails, try to reselect the card and try again
-        reselect_card(uid)
-        #wait a bit before retrying
-        time.sleep(0.1)
     #if all attempts fail, return False
     return False
 
+#function to write several blocks, authenticating once per sector (the write side of read_blocks)
+#blocks is a dict of block -> 16 bytes, grouped by sector in the order given
+#if the auth or a write fails the rest of that sector falls back to write_block (auth + retries per block)
+#returns a dict of block -> True if written
+def write_blocks(uid, blocks, attempts=3, deadline=None):
+    if any(len(data) != 16 for data in blocks.values()):
+        raise ValueError("Data must be exactly 16 bytes")
+    deadline = _no_deadline(deadline)
+    plan = {}
+    for b in blocks:
+        plan.setdefault(sector_of(b), []).append(b)
+
+    out = {b: False for b in blocks}
+    for sector_blocks in plan.values():
+        pending = list(sector_blocks)
+        if auth_any(uid, pending[0]):
+            while pending:
+                IO_STATS["writes"] += 1
+                if not get_reader().mifare_classic_write_block(pending[0], blocks[pending[0]]):
+                    break
+                out[pending.pop(0)] = True
+        if pending:
+            #the card drops its auth state after an error, so reselect before falling back
+            reselect_card(uid, deadline=deadline)
+            for b in pending:
+                out[b] = write_block(uid, b, blocks[b], attempts, deadline)
+    return out
+
 #HEADER FUNCTIONS and PACKING/UNPACKING
 
+#PRECOMPILED LAYOUTS (big endian, one struct.Struct per 16 byte block layout)
+#header: magic, version, write index, total count, last timestamp, block sequence, tail, checksum
+HEADER_LAYOUT = struct.Struct(">4sBBHIBBH")
+HEADER_MAGIC = b"COLM"
+#v1 record (and v2 wide block): timestamp, amount in cents (signed), merchant id, zip, flags, byte 13, checksum
+#byte 13 is 0 in v1 and the block kind in v2
+TX_LAYOUT = struct.Struct(">IiHHBBH")
+#v2 pair block head: first timestamp, seconds to the second record, dictionary slots (4 bits each)
+PAIR_HEAD = struct.Struct(">IHB")
+#16 bit checksum in bytes 14-15
+CHECKSUM = struct.Struct(">H")
+
+#checksum of a 16 byte block whose bytes 14-15 hold the checksum: the masked sum of bytes 0-13
+#(summing the whole block and taking the checksum bytes back out avoids copying a 14 byte slice)
+def _block_sum(b, check):
+    return (sum(b) - (check >> 8) - (check & 0xFF)) & 0xFFFF
+
+#one transaction read from a card
+#fields are attributes (r.timestamp), and it can be used like the dict the card code used to return
+#(r["timestamp"], r.get("zip"), dict(r), == against a dict)
+class TxRecord:
+    __slots__ = ("timestamp", "amount_cents", "merchant_id", "zip", "flags")
+
+    def __init__(self, timestamp, amount_cents, merchant_id, zip, flags):
+        self.timestamp = timestamp
+        self.amount_cents = amount_cents
+        self.merchant_id = merchant_id
+        self.zip = zip
+        self.flags = flags
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            return default
+
+    def keys(self):
+        return TxRecord.__slots__
+
+    def as_dict(self):
+        return {"timestamp": self.timestamp, "amount_cents": self.amount_cents, "merchant_id": self.merchant_id,
+                "zip": self.zip, "flags": self.flags}
+
+    def __eq__(self, other):
+        if isinstance(other, TxRecord):
+            return (self.timestamp == other.timestamp and self.amount_cents == other.amount_cents
+                    and self.merchant_id == other.merchant_id and self.zip == other.zip and self.flags == other.flags)
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    #mutable like the dicts it replaces, so not hashable
+    __hash__ = None
+
+    def __repr__(self):
+        return f"TxRecord({self.as_dict()!r})"
+
 #fucntion to pack header data into a byte array
-def pack_header(version, write_index, total_count, last_timestamp):
-    #create a bytearray of 16 bytes and fill it with header data
-    b = bytearray(16)
-    #set magic header bytes
-    b[0:4] = b"COLM"
-    #set version
-    b[4] = version & 0xFF
-    #set write index
-    b[5] = write_index & 0xFF
-    #set total count (big endian 16-bit unsigned integer)
-    b[6:8] = struct.pack(">H", total_count & 0xFFFF)
-    #set last timestamp (big endian 32-bit unsigned integer)
-    b[8:12] = struct.pack(">I", last_timestamp & 0xFFFFFFFF)
-    #set unused bytes to zero
-    b[12] = 0
-    b[13] = 0
-    #set checksum (16-bit sum of first 14 bytes)
-    b[14:16] = struct.pack(">H", sum16(b[:14]))
-    #return the packed byte array
-    return bytes(b)
+#tail is the number of records in the newest ring block (v2 pair blocks hold 2), used by ring recovery
+#seq counts the ring blocks opened (mod 256), v3 cards use it to age dictionary entries (0 on v1 cards)
+def pack_header(version, write_index, total_count, last_timestamp, tail=0, seq=0):
+    fields = (HEADER_MAGIC, version & 0xFF, write_index & 0xFF, total_count & 0xFFFF,
+              last_timestamp & 0xFFFFFFFF, seq & 0xFF, tail & 0xFF)
+    #checksum bytes are 0 in the first pack, so the sum of the block is the sum of bytes 0-13
+    return HEADER_LAYOUT.pack(*fields, sum(HEADER_LAYOUT.pack(*fields, 0)) & 0xFFFF)
 
 #function to unpack header data from a byte array
 def unpack_header(b):
     #check if the byte array is valid
-    if not b or len(b) != 16 or b[0:4] != b"COLM":
+    if not b or len(b) != 16:
         return None
-    #check if the checksum is valid
-    #struct.unpack returns a tuple, so add [0] to get the first element
-    if sum16(b[:14]) != struct.unpack(">H", b[14:16])[0]:
+    magic, version, write_index, total_count, last_timestamp, seq, tail, check = HEADER_LAYOUT.unpack_from(b)
+    #check the magic bytes and the checksum
+    if magic != HEADER_MAGIC or _block_sum(b, check) != check:
         return None
     #if both checks succeed, return a dictionary with the unpacked header data
     return {
-        "version": b[4],
-        "write_index": b[5],
-        "total_count": struct.unpack(">H", b[6:8])[0],
-        "last_timestamp": struct.unpack(">I", b[8:12])[0]
+        "version": version,
+        "write_index": write_index,
+        "total_count": total_count,
+        "last_timestamp": last_timestamp,
+        "tail": tail,
+        "seq": seq,
     }
 
+#function to get the zip code stored on the card (first 5 digits as an int, 0 if no zip code)
+#values above 65535 are clamped to fit the 16 bit field
+def _zip_int(zip_code):
+    if not zip_code:
+        return 0
+    z = zip_code if type(zip_code) is str else str(zip_code)
+    if not z.isdigit():
+        #keep only the digits (e.g. "10036-1234")
+        z = "".join(ch for ch in z if ch.isdigit())
+    z = z[:5]
+    #convert to integer, ensuring it's within max unsigned int range
+    return max(0, min(65535, int(z))) if z else 0
+
 #function to pack a transaction into a byte array
 def pack_tx(timestamp, amount_cents, merchant_id, flags, zip_code=None):
-    #create a bytearray of 16 bytes and fill it with transaction data
-    b = bytearray(16)
-    #set timestamp (big endian 32-bit unsigned integer)
-    b[0:4] = struct.pack(">I", timestamp & 0xFFFFFFFF)
-    #set amount in cents (big endian 32-bit signed integer)
-    b[4:8] = struct.pack(">i", amount_cents)
-    #set merchant ID (big endian 16-bit unsigned integer)
-    b[8:10] = struct.pack(">H", merchant_id & 0xFFFF)
-    #set zip code (big endian 16-bit unsigned integer, 0 if no zip code)
-    #initalise zip_int to 0
-    zip_int = 0
-    if zip_code:
-        #convert zip code to string, keeping only 5 digits
-        z = "".join(ch for ch in str(zip_code) if ch.isdigit())[:5]
-        if z:
-            #convert to integer, ensuring it's within max unsigned int range 
-            zip_int = max(0, min(65535, int(z)))
-    b[10:12] = struct.pack(">H", zip_int)
-    #set flags (1 byte)
-    b[12] = flags & 0xFF
-    #set unused bytes to zero
-    b[13] = 0
-    #set checksum (16-bit sum of first 14 bytes)
-    b[14:16] = struct.pack(">H", sum16(bytes(b[:14])))
-    #return the packed byte array
-    return bytes(b)
+    fields = (timestamp & 0xFFFFFFFF, amount_cents, merchant_id & 0xFFFF, _zip_int(zip_code), flags & 0xFF, 0)
+    #checksum bytes are 0 in the first pack, so the sum of the block is the sum of bytes 0-13
+    return TX_LAYOUT.pack(*fields, sum(TX_LAYOUT.pack(*fields, 0)) & 0xFFFF)
 
 #function to unpack a transaction from a byte array
+#returns a TxRecord, or None if the block is not a valid record
 def unpack_tx(b):
     #check if the byte array is valid
     if not b or len(b) != 16:
         return None
+    timestamp, amount_cents, merchant_id, zip_int, flags, _, check = TX_LAYOUT.unpack_from(b)
     #check if the checksum is valid
-    if sum16(b[0:14]) != struct.unpack(">H", b[14:16])[0]:
+    if _block_sum(b, check) != check:
         return None
-    #if both checks succeed, continue
-    #unpack zip code
-    zip_int = struct.unpack(">H", b[10:12])[0]
-    #fill with 0s until it is 5 digits long if needs be
-    #set string to None if zip_int is 0
-    zip_str = str(zip_int).zfill(5) if zip_int > 0 else None
-    #return a dictionary with the unpacked transaction data
-    return {
-        "timestamp": struct.unpack(">I", b[0:4])[0],
-        "amount_cents": struct.unpack(">i", b[4:8])[0],
-        "merchant_id": struct.unpack(">H", b[8:10])[0],
-        "zip": zip_str,
-        "flags": b[12]
-    }
+    #zip is the 5 digit string (None if no zip code)
+    return TxRecord(timestamp, amount_cents, merchant_id, str(zip_int).zfill(5) if zip_int > 0 else None, flags)
+
+#function to unpack the v1 records in a buffer of whole blocks (e.g. a dump of several blocks)
+#yields a TxRecord (or None for a block that is not a valid record) per 16 bytes, without copying the buffer
+def unpack_tx_blocks(buf):
+    mv = memoryview(buf)
+    for off in range(0, len(mv) - 15, 16):
+        timestamp, amount_cents, merchant_id, zip_int, flags, _, check = TX_LAYOUT.unpack_from(mv, off)
+        if _block_sum(mv[off:off + 16], check) != check:
+            yield None
+        else:
+            yield TxRecord(timestamp, amount_cents, merchant_id, str(zip_int).zfill(5) if zip_int > 0 else None,
+                           flags)
+
+#V2 RECORD FORMAT
+#version 2 cards fit two transactions in most ring blocks:
+#- blocks 5 and 6 (same sector as the header) hold an append only dictionary of (merchant_id, zip) pairs
+#- a "pair" block holds up to two transactions that use dictionary entries, a "wide" block holds one
+#  transaction in the v1 layout (used when the merchant/zip is not in a full dictionary, the gap is too
+#  long or the amount too large for the pair layout)
+#the ring is the remaining 42 data blocks, write_index points at the next block to open
+#a new transaction goes in the second half of the newest block if it is an open pair block, otherwise in a new block
+#version 3 is the same layout with an evictable dictionary: every entry carries the header block sequence (seq) of
+#the last block that used it (refreshed every DICT_REFRESH blocks), so an entry no live ring block can refer to any
+#more is given to the next new merchant/zip instead of that merchant going to a wide block for good
+
+#version written to new or formatted cards (cards with a v1 or v2 header keep their format)
+CARD_VERSION = 3
+#dictionary blocks and ring blocks for v2 cards
+DICT_BLOCKS = TX_DATA_BLOCKS[:2]
+TX_DATA_BLOCKS_V2 = TX_DATA_BLOCKS[2:]
+#dictionary entries per block (merchant u16 + zip 17 bits + last use seq 7 bits) and in total
+DICT_PER_BLOCK = 3
+DICT_SIZE = DICT_PER_BLOCK * len(DICT_BLOCKS)
+#v3: an entry's seq is rewritten once it is this many blocks old, so it lags its true last use by less than this
+DICT_REFRESH = 8
+#v3: age (blocks opened since the stored seq, mod 128) from which no live block can use the entry any more
+#(the ring holds len(TX_DATA_BLOCKS_V2) blocks and the stored seq lags by up to DICT_REFRESH - 1)
+DICT_EVICT_AGE = len(TX_DATA_BLOCKS_V2) + DICT_REFRESH
+DICT_SEQ_MASK = 0x7F
+ZIP_MASK = 0x1FFFF
+#dictionary slot index meaning "not in the dictionary"
+NO_ENTRY = 0xF
+#kind bits in byte 13 of a v2 ring block (v1 leaves it 0, so a cleared block is never a valid record)
+KIND_WIDE = 0x40
+KIND_PAIR = 0x80
+#pair block byte 13 low bits
+PAIR_FLAG_A = 0x01
+PAIR_FLAG_B = 0x02
+PAIR_HAS_B = 0x04
+#bytes for the two zigzag varint amounts in a pair block
+PAIR_AMOUNT_BYTES = 6
+#checksums are xored so an all zero (cleared) block never passes
+CHECK8 = 0xA5
+CHECK16 = 0xA5A5
+
+#function to zigzag + varint encode a signed integer (small magnitudes take fewer bytes)
+def varint(n):
+    z = (n << 1) ^ (n >> 63)
+    out = bytearray()
+    while True:
+        if z < 0x80:
+            out.append(z)
+            return bytes(out)
+        out.append((z & 0x7F) | 0x80)
+        z >>= 7
+
+#function to decode a zigzag varint from b at offset off, returns (value, new offset)
+def read_varint(b, off):
+    z = 0
+    shift = 0
+    while True:
+        byte = b[off]
+        off += 1
+        z |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return (z >> 1) ^ -(z & 1), off
+        shift += 7
+
+#function to pack the (merchant_id, zip_int, seq) dictionary entries for one dictionary block (seq is 0 on v2 cards)
+def pack_dict_block(entries):
+    b = bytearray(b"\xff" * 16)
+    for i, (merchant_id, zip_int, seq) in enumerate(entries[:DICT_PER_BLOCK]):
+        b[i*5:i*5+2] = struct.pack(">H", merchant_id & 0xFFFF)
+        b[i*5+2:i*5+5] = ((zip_int & ZIP_MASK) | (seq & DICT_SEQ_MASK) << 17).to_bytes(3, "big")
+    b[15] = (sum(b[:15]) & 0xFF) ^ CHECK8
+    return bytes(b)
+
+#function to unpack a dictionary block, returns a list of (merchant_id, zip_int, seq) (empty if invalid or cleared)
+def unpack_dict_block(b):
+    if not b or len(b) != 16 or ((sum(b[:15]) & 0xFF) ^ CHECK8) != b[15]:
+        return []
+    entries = []
+    for i in range(DICT_PER_BLOCK):
+        e = b[i*5:i*5+5]
+        #unused slots are all 0xFF
+        if e == b"\xff" * 5:
+            break
+        packed = int.from_bytes(e[2:5], "big")
+        zip_int = packed & ZIP_MASK
+        #not a 5 digit zip, so not a dictionary block (e.g. an old v1 record)
+        if zip_int > 99999:
+            return []
+        entries.append((struct.unpack(">H", e[0:2])[0], zip_int, packed >> 17))
+    return entries
+
+#function to get the dictionary from the dictionary blocks (dict of block -> bytes)
+#entries after the first short block are ignored, so the list always matches the slot numbers used by records
+def unpack_dict(blocks):
+    entries = []
+    for b in DICT_BLOCKS:
+        part = unpack_dict_block(blocks.get(b))
+        entries += part
+        if len(part) < DICT_PER_BLOCK:
+            break
+    return entries
+
+#function to turn a stored zip int back into the 5 digit string (None if no zip)
+def _zip_str(zip_int):
+    return str(zip_int).zfill(5) if zip_int > 0 else None
+
+#function to pack a pair block
+#a and b are (timestamp, amount_cents, dict slot, flags) tuples, b can be None
+#returns None if they do not fit the pair layout
+def pack_pair_block(a, b=None):
+    ts_a, amt_a, slot_a, flags_a = a
+    amounts = varint(amt_a)
+    kind = KIND_PAIR | (PAIR_FLAG_A if flags_a else 0)
+    dt = 0
+    slot_b = NO_ENTRY
+    if b is not None:
+        ts_b, amt_b, slot_b, flags_b = b
+        dt = ts_b - ts_a
+        amounts += varint(amt_b)
+        kind |= PAIR_HAS_B | (PAIR_FLAG_B if flags_b else 0)
+        if not (0 <= dt <= 0xFFFF) or flags_b not in (0, 1) or slot_b >= NO_ENTRY:
+            return None
+    if len(amounts) > PAIR_AMOUNT_BYTES or flags_a not in (0, 1) or slot_a >= NO_ENTRY:
+        return None
+    blk = bytearray(16)
+    PAIR_HEAD.pack_into(blk, 0, ts_a & 0xFFFFFFFF, dt, (slot_a << 4) | slot_b)
+    blk[7:7 + len(amounts)] = amounts
+    blk[13] = kind
+    CHECKSUM.pack_into(blk, 14, (sum(blk) & 0xFFFF) ^ CHECK16)
+    return bytes(blk)
+
+#function to unpack a v2 ring block with the card dictionary
+#returns a list of tx dicts (oldest first, 1 or 2) or None if the block is not a valid v2 record
+def unpack_block_v2(blk, entries):
+    if not blk or len(blk) != 16:
+        return None
+    kind = blk[13]
+    if kind == KIND_WIDE:
+        tx = unpack_tx(blk)
+        return [tx] if tx else None
+    if not kind & KIND_PAIR:
+        return None
+    check = CHECKSUM.unpack_from(blk, 14)[0]
+    if (_block_sum(blk, check) ^ CHECK16) != check:
+        return None
+    ts_a, dt, packed_slots = PAIR_HEAD.unpack_from(blk)
+    slots = [packed_slots >> 4, packed_slots & 0xF]
+    flags = [1 if kind & PAIR_FLAG_A else 0, 1 if kind & PAIR_FLAG_B else 0]
+    n = 2 if kind & PAIR_HAS_B else 1
+    out = []
+    off = 7
+    for i in range(n):
+        amt, off = read_varint(blk, off)
+        if slots[i] >= len(entries):
+            #refers to a dictionary entry that never made it to the card
+            return None
+        merchant_id, zip_int, _ = entries[slots[i]]
+        out.append(TxRecord(ts_a + (dt if i else 0), amt, merchant_id, _zip_str(zip_int), flags[i]))
+    return out
+
+#function to read the newest max_count transactions from a v2 card through a CardSession (newest first)
+def _read_recent_v2(session, metadata, max_count):
+    ring = TX_DATA_BLOCKS_V2
+    index = metadata["write_index"]
+    want = min(max_count, metadata["total_count"])
+    transactions = []
+    entries = None
+    done = 0
+    while len(transactions) < want and done < len(ring):
+        if session.deadline.expired():
+            #out of time, the rules run on what was read so far
+            session.deadline.partial = True
+            break
+        #most blocks hold two records, so read about half as many blocks as records still needed
+        n = min(len(ring) - done, (want - len(transactions)) // 2 + 1)
+        blocks = [ring[(index - 1 - j) % len(ring)] for j in range(done, done + n)]
+        #the dictionary shares a sector with the header, read it with the first batch
+        data = session.read_blocks((DICT_BLOCKS if entries is None else []) + blocks)
+        if entries is None:
+            entries = unpack_dict(data)
+        for b in blocks:
+            records = unpack_block_v2(data[b], entries)
+            #skip cleared or damaged blocks like v1 skips records with a bad checksum
+            if records:
+                transactions.extend(reversed(records))
+        done += n
+    return transactions[:want]
+
+#function to find (or make) the dictionary slot for key on a v2/v3 card
+#entries is the card dictionary, changed in place (the caller writes back the dictionary blocks in changed)
+#seq is the sequence number of the newest block the record can end up in
+#returns the slot, or None if the key is not in a full dictionary with nothing to evict (a wide block)
+def _dict_slot(entries, key, seq, evict, changed):
+    keys = [e[:2] for e in entries]
+    if key in keys:
+        slot = keys.index(key)
+        #v3: keep the entry's last use close enough that it is not evicted under a live block
+        if evict and (seq - entries[slot][2]) & DICT_SEQ_MASK >= DICT_REFRESH:
+            entries[slot] = key + (seq & DICT_SEQ_MASK,)
+            changed.add(slot // DICT_PER_BLOCK)
+        return slot
+    if len(entries) < DICT_SIZE:
+        entries.append(key + (seq & DICT_SEQ_MASK if evict else 0,))
+        changed.add((len(entries) - 1) // DICT_PER_BLOCK)
+        return len(entries) - 1
+    if not evict:
+        return None
+    #v3: reuse the entry unused for longest, if no live block can still refer to it
+    age, slot = max(((seq - e[2]) & DICT_SEQ_MASK, i) for i, e in enumerate(entries))
+    if age < DICT_EVICT_AGE:
+        return None
+    entries[slot] = key + (seq & DICT_SEQ_MASK,)
+    changed.add(slot // DICT_PER_BLOCK)
+    return slot
+
+#function to restart the age of every dictionary entry of a v3 card from seq (after the header was rebuilt without
+#its block sequence, every entry is taken as just used), returns False if a dictionary write failed
+def reset_dict_ages(session, seq):
+    entries = unpack_dict(session.read_blocks(DICT_BLOCKS))
+    for i in range(0, len(entries), DICT_PER_BLOCK):
+        part = [e[:2] + (seq & DICT_SEQ_MASK,) for e in entries[i:i + DICT_PER_BLOCK]]
+        if part != entries[i:i + DICT_PER_BLOCK] and not session.write_block(DICT_BLOCKS[i // DICT_PER_BLOCK],
+                                                                             pack_dict_block(part)):
+            return False
+    return True
+
+#function to append one transaction (v1 record bytes from pack_tx) to a v2/v3 card through a CardSession
+#updates write_index (and seq) in metadata, the caller updates the counters and writes the header
+#returns (ok, message)
+def _write_tx_v2(session, metadata, rec):
+    tx = unpack_tx(rec)
+    if tx is None:
+        return False, "bad record"
+    ring = TX_DATA_BLOCKS_V2
+    key = (tx["merchant_id"], int(tx["zip"]) if tx["zip"] else 0)
+    evict = metadata["version"] >= 3
+    seq = metadata.get("seq", 0)
+
+    #find the merchant/zip in the dictionary, adding it if there is room (or an entry can be evicted)
+    #the dictionary goes to the card before the ring block, so an entry never looks older than its last use
+    entries = unpack_dict(session.read_blocks(DICT_BLOCKS))
+    changed = set()
+    slot = _dict_slot(entries, key, seq, evict, changed)
+    for i in sorted(changed):
+        if not session.write_block(DICT_BLOCKS[i], pack_dict_block(entries[i*DICT_PER_BLOCK:(i+1)*DICT_PER_BLOCK])):
+            return False, "dictionary write failed"
+    new = (tx["timestamp"], tx["amount_cents"], NO_ENTRY if slot is None else slot, tx["flags"])
+    index = metadata["write_index"] % len(ring)
+
+    #fill the second half of the newest block if it is an open pair block
+    if slot is not None and metadata["total_count"] > 0:
+        last = ring[(index - 1) % len(ring)]
+        blk = session.read_blocks([last])[last]
+        records = unpack_block_v2(blk, entries)
+        if records and blk[13] & KIND_PAIR and not blk[13] & PAIR_HAS_B:
+            a = records[0]
+            packed = pack_pair_block((a["timestamp"], a["amount_cents"], blk[6] >> 4, a["flags"]), new)
+            if packed is not None:
+                if not session.write_block(last, packed):
+                    return False, "write failed"
+                metadata["tail"] = 2
+                return True, "write successful"
+
+    #otherwise open a new block, a pair block if it fits, else a wide (v1 layout) block
+    packed = pack_pair_block(new) if slot is not None else None
+    if packed is None:
+        wide = bytearray(rec)
+        wide[13] = KIND_WIDE
+        CHECKSUM.pack_into(wide, 14, sum(wide[:14]) & 0xFFFF)
+        packed = bytes(wide)
+    if not session.write_block(ring[index], packed):
+        return False, "write failed"
+    metadata["write_index"] = (index + 1) % len(ring)
+    metadata["seq"] = (seq + 1) & 0xFF
+    metadata["tail"] = 1
+    return True, "write successful"
 
 #HIGH LEVEL FUNCTIONS
 
 #function to read the header block and return the metadata
-def read_header(uid):
+def read_header(uid, deadline=None):
     #read the header block (block 4)
-    header_block = read_block(uid, HEADER_BLOCK)
+    header_block = read_block(uid, HEADER_BLOCK, deadline=deadline)
     #if reading the block fails, return None
     if not header_block:
         return None
@@ -238,57 +702,318 @@ def read_header(uid):
     return unpack_header(header_block)
 
 #function to write the header block with metadata
-def write_header(uid, metadata):
+def write_header(uid, metadata, deadline=None):
     #pack the header data into a byte array
     header_data = pack_header(
         metadata["version"],
         metadata["write_index"],
         metadata["total_count"],
-        metadata["last_timestamp"]
+        metadata["last_timestamp"],
+        metadata.get("tail", 0),
+        metadata.get("seq", 0),
     )
     #write the packed header data to the header block
-    return write_block(uid, HEADER_BLOCK, header_data)
+    return write_block(uid, HEADER_BLOCK, header_data, deadline=deadline)
 
 #function to load header, or create it if it doesn't exist
-def load_init_header(uid):
+def load_init_header(uid, deadline=None):
+    deadline = _no_deadline(deadline)
     #try to read the header block
-    metadata = read_header(uid)
+    metadata = read_header(uid, deadline)
     #if header exists, return it
     if metadata:
         return metadata
+    #out of time: the read may have failed on a good header, do not overwrite it with a blank one
+    if deadline.expired():
+        deadline.partial = True
+        deadline.no_header = True
+        return None
     #if header does not exist, create a new one with default values
-    metadata = {"version": 1, "write_index": 0, "total_count": 0, "last_timestamp": 0}
+    metadata = {"version": CARD_VERSION, "write_index": 0, "total_count": 0, "last_timestamp": 0, "tail": 0, "seq": 0}
     #try to write the new header to the card
-    if write_header(uid, metadata):
+    if write_header(uid, metadata, deadline):
         #wait a bit to ensure the write is stable
-        time.sleep(0.1)
-        reselect_card(uid)
+        time.sleep(min(0.1, deadline.remaining()))
+        reselect_card(uid, deadline=deadline)
         return metadata
     #if that fails, return None
     else:
         return None
     
+#RING RECOVERY
+#the header can be older than the ring (header writes are deferred, the card can leave before the flush)
+#records carry their own checksum and timestamp, so the true write index and count can be rebuilt from the ring:
+#records written after the header sit at write_index, write_index+1, ... with timestamps that do not go back
+
+#function to decode a ring block for recovery, returns its records (oldest first) or None if empty/invalid
+def _ring_records(blk, version, entries):
+    if version >= 2:
+        return unpack_block_v2(blk, entries)
+    tx = unpack_tx(blk) if blk else None
+    #an all zero (cleared) block passes the v1 checksum, timestamp 0 means empty
+    return [tx] if tx and tx["timestamp"] else None
+
+#function to check if the ring has records the header does not know about
+#only looks at the newest block and the one after it (the blocks a tap reads anyway)
+def ring_is_ahead(session, metadata):
+    v2 = metadata["version"] >= 2
+    ring = TX_DATA_BLOCKS_V2 if v2 else TX_DATA_BLOCKS
+    wi = metadata["write_index"] % len(ring)
+    last, nxt = ring[(wi - 1) % len(ring)], ring[wi]
+    data = session.read_blocks((DICT_BLOCKS if v2 else []) + [last, nxt])
+    entries = unpack_dict(data) if v2 else None
+    prev = _ring_records(data[last], metadata["version"], entries) if metadata["total_count"] else None
+    #a v2 pair block that gained its second record after the header was written
+    if v2 and prev and metadata.get("tail") and len(prev) > metadata["tail"]:
+        return True
+    following = _ring_records(data[nxt], metadata["version"], entries)
+    return bool(following) and following[0]["timestamp"] >= (prev[-1]["timestamp"] if prev else 0)
+
+#function to rebuild write_index, total_count and tail in metadata from one sector batched scan of the ring
+#header_ok=False means the header was missing (freshly created), so the version and count come from the ring alone
+#returns the number of records found that the header did not count
+#if the deadline cuts the scan short nothing is changed and the session is marked stale (no writes until a full scan)
+def recover_ring(session, metadata, header_ok=True):
+    IO_STATS["recoveries"] += 1
+    deadline = session.deadline
+    was_partial, deadline.partial = deadline.partial, False
+    if not header_ok:
+        #the ring format decides the version: v2/v3 blocks are tagged, anything else with a timestamp is v1
+        #(a tagged ring is taken as v3, which reads a v2 ring as it is once the dictionary ages are reset)
+        data = session.read_blocks(DICT_BLOCKS + TX_DATA_BLOCKS_V2)
+        entries = unpack_dict(data)
+        if any(_ring_records(data[b], 2, entries) for b in TX_DATA_BLOCKS_V2):
+            metadata["version"] = 3
+        else:
+            data = session.read_blocks(TX_DATA_BLOCKS)
+            if any(_ring_records(data[b], 1, None) for b in TX_DATA_BLOCKS):
+                metadata["version"] = 1
+    v2 = metadata["version"] >= 2
+    ring = TX_DATA_BLOCKS_V2 if v2 else TX_DATA_BLOCKS
+    data = session.read_blocks((DICT_BLOCKS if v2 else []) + ring)
+    entries = unpack_dict(data) if v2 else None
+    cut_short = deadline.partial
+    deadline.partial = was_partial or cut_short
+    if cut_short:
+        #writing with a stale write index could overwrite records, so the session refuses to write
+        session.stale = True
+        return 0
+    records = [_ring_records(data[b], metadata["version"], entries) for b in ring]
+    n = len(ring)
+
+    found = 0
+    if header_ok:
+        #walk forward from the header's write index while timestamps keep going forward
+        wi = metadata["write_index"] % n
+        prev = records[(wi - 1) % n] if metadata["total_count"] else None
+        newest = prev[-1]["timestamp"] if prev else 0
+        if v2 and prev and metadata.get("tail") and len(prev) > metadata["tail"]:
+            found += len(prev) - metadata["tail"]
+            metadata["tail"] = len(prev)
+        steps = 0
+        while steps < n - 1:
+            r = records[(wi + steps) % n]
+            if not r or r[0]["timestamp"] < newest:
+                break
+            found += len(r)
+            newest = r[-1]["timestamp"]
+            metadata["tail"] = len(r)
+            steps += 1
+        metadata["write_index"] = (wi + steps) % n
+        #every block found was opened after the header's seq
+        metadata["seq"] = (metadata.get("seq", 0) + steps) & 0xFF
+    else:
+        #no header: the newest block ends a run of forward going timestamps and has the latest timestamp
+        best = None
+        for i, r in enumerate(records):
+            if not r:
+                continue
+            nxt = records[(i + 1) % n]
+            if nxt and nxt[0]["timestamp"] >= r[-1]["timestamp"]:
+                continue
+            if best is None or r[-1]["timestamp"] > records[best][-1]["timestamp"]:
+                best = i
+        if best is None and any(records):
+            #every record has the same timestamp, take the last one in ring order
+            best = max(i for i, r in enumerate(records) if r)
+        if best is not None:
+            found = sum(len(r) for r in records if r)
+            metadata["write_index"] = (best + 1) % n
+            metadata["tail"] = len(records[best])
+        #the block sequence is gone with the header, the dictionary ages restart from 0 (see reset_dict_ages)
+        metadata["seq"] = 0
+    metadata["total_count"] = min(65535, metadata["total_count"] + found)
+    return found
+
+#CARD SESSION
+
+#write the header back after this many ring writes (it is always rewritten when the session is flushed)
+#used by the use_session=False path, sessions only write the header when the tap ends (ring recovery
+#rebuilds it if the card leaves first)
+UPDATE_HEADER_EVERY = 3
+#header writes per session before the tap ends (None = only on flush/end_session)
+SESSION_FLUSH_EVERY = None
+
+#cache for one card while it stays in the field
+#holds the header and every block read or written, so one tap reads the header once and re-reads nothing
+#header updates from writes stay in the cache and are written back every flush_every writes (or on flush())
+#a header left behind by a card that was pulled before its flush is repaired from the ring when loaded
+#the session ends when wait_for_card runs again, on a card IO failure, or when the card is formatted
+#callers should end_session() at the end of a tap (card still in the field) so no header update is lost
+class CardSession:
+    def __init__(self, uid, flush_every=SESSION_FLUSH_EVERY):
+        self.uid = uid
+        self.flush_every = flush_every
+        #header dict (None until loaded)
+        self.metadata = None
+        #block -> 16 bytes
+        self.blocks = {}
+        #header updates not yet written to the card
+        self.dirty = 0
+        #deadline of the call using the session (set by read_recent_tx / write_recent_tx)
+        self.deadline = Deadline()
+        #set when ring recovery was cut short by a deadline, the write index cannot be trusted
+        self.stale = False
+
+    #function to set the deadline for the calls that follow (None = no limit)
+    def use(self, deadline):
+        self.deadline = _no_deadline(deadline)
+        return self
+
+    #function to get the header (read or created once per session, then checked against the ring)
+    def header(self):
+        if self.metadata is None:
+            metadata = read_header(self.uid, self.deadline)
+            header_ok = metadata is not None
+            if not header_ok:
+                #out of time: the read may have failed on a good header, do not replace it
+                if self.deadline.expired():
+                    self.deadline.partial = True
+                    self.deadline.no_header = True
+                    return None
+                #no header: start from a blank one and rebuild it from the ring before anything is written
+                metadata = {"version": CARD_VERSION, "write_index": 0, "total_count": 0, "last_timestamp": 0,
+                            "tail": 0, "seq": 0}
+            self.metadata = metadata
+            if not header_ok or ring_is_ahead(self, metadata):
+                found = recover_ring(self, metadata, header_ok)
+                if (found or not header_ok) and not self.stale:
+                    #write the repaired header back at the next flush
+                    self.dirty += 1
+                    #a missing header is written straight away (a card pulled before the flush would otherwise
+                    #come back with no header again), on v3 cards once the dictionary ages match its new seq
+                    if not header_ok and (metadata["version"] < 3 or reset_dict_ages(self, metadata["seq"])):
+                        self.flush()
+        return self.metadata
+
+    #function to read blocks, only going to the card for blocks not cached yet
+    #returns a dict of block -> 16 bytes (or None)
+    def read_blocks(self, blocks):
+        missing = [b for b in blocks if b not in self.blocks]
+        if missing:
+            for b, data in read_blocks(self.uid, missing, deadline=self.deadline).items():
+                if data:
+                    self.blocks[b] = data
+        return {b: self.blocks.get(b) for b in blocks}
+
+    #function to write a block through to the card and cache it
+    def write_block(self, block, data):
+        if not write_block(self.uid, block, data, deadline=self.deadline):
+            #the card may have left the field, nothing cached can be trusted
+            self.invalidate()
+            return False
+        self.blocks[block] = bytes(data)
+        return True
+
+    #function to note a header change and write it back when the flush policy says so
+    #returns False if a due header write failed
+    def header_updated(self):
+        self.dirty += 1
+        if self.flush_every and self.dirty >= self.flush_every:
+            return self.flush()
+        return True
+
+    #function to write the cached header back if it has unsaved changes
+    def flush(self):
+        if not self.dirty or self.metadata is None:
+            return True
+        if not write_header(self.uid, self.metadata, self.deadline):
+            return False
+        self.dirty = 0
+        return True
+
+    #function to drop everything cached
+    def invalidate(self):
+        self.metadata = None
+        self.blocks.clear()
+        self.dirty = 0
+        self.stale = False
+
+#session for the card currently in the field, per thread (each reader worker has its own card in the field)
+_local = threading.local()
+
+#function to get the session for a card, starting a new one if a different card is presented
+def session_for(uid):
+    session = getattr(_local, "session", None)
+    if session is None or session.uid != uid:
+        session = _local.session = CardSession(uid)
+    return session
+
+#function to make a session that is not shared (for use_session=False calls on v2 cards)
+def _one_off_session(uid, metadata, flush_every=UPDATE_HEADER_EVERY, deadline=None):
+    s = CardSession(uid, flush_every=flush_every).use(deadline)
+    s.metadata = metadata
+    return s
+
+#function to end the current card session (flush=True writes back a pending header first)
+#returns False if the final header write failed
+def end_session(flush=True):
+    session = getattr(_local, "session", None)
+    ok = True
+    if session is not None and flush:
+        ok = session.flush()
+    _local.session = None
+    return ok
+
 #function to read recent transactions from the card
 #returns the metadata and a list of transactions (newest first)
-def read_recent_tx(uid, max_count=10):
+#batched=True reads the ring with one auth per sector (read_blocks), False reads block by block (old path)
+#use_session=True reuses the header and blocks cached for this card (CardSession), False always reads the card
+#deadline (Deadline) bounds retries and stops the history read early, deadline.report() says if it was partial
+#(or "none": out of time before the header was read, returns None and an empty list)
+def read_recent_tx(uid, max_count=10, batched=True, use_session=True, deadline=None):
+    deadline = _no_deadline(deadline)
+    session = session_for(uid).use(deadline) if use_session else None
     #load or create the header
-    metadata = load_init_header(uid)
+    metadata = session.header() if session else load_init_header(uid, deadline)
     #if header is None, return None and an empty list
     if not metadata:
         return None, []
+    #version 2 cards pack records two to a block
+    if metadata["version"] >= 2:
+        return metadata, _read_recent_v2(session or _one_off_session(uid, metadata, deadline=deadline), metadata,
+                                         max_count)
     #get the write index and create a list to hold transactions
     index = metadata["write_index"]
     transactions = []
     #get amount of transactions to read
     to_read = min(max_count, len(TX_DATA_BLOCKS), metadata["total_count"])
+    #blocks of the last transactions, newest first
+    blocks = [TX_DATA_BLOCKS[(index - 1 - i) % len(TX_DATA_BLOCKS)] for i in range(to_read)]
+    if session:
+        data = session.read_blocks(blocks)
+    elif batched:
+        data = read_blocks(uid, blocks, deadline=deadline)
+    else:
+        data = None
     #loop through the last transactions in reverse order
-    for i in range(to_read):
-        #calculate the block number to read
-        block_index = (index - 1 - i) % len(TX_DATA_BLOCKS)
-        #set block to read from
-        block = TX_DATA_BLOCKS[block_index]
+    for block in blocks:
+        if data is None and deadline.expired():
+            #out of time, the rules run on what was read so far
+            deadline.partial = True
+            break
         #read the transaction block
-        bytes_read = read_block(uid, block)
+        bytes_read = data[block] if data is not None else read_block(uid, block, deadline=deadline)
         #unpack the transaction data
         tx = unpack_tx(bytes_read) if bytes_read else None
         #if transaction data is valid, add it to the list
@@ -299,35 +1024,56 @@ def read_recent_tx(uid, max_count=10):
     return metadata, transactions
 
 #function to write a transaction to the card
-def write_recent_tx(uid, tx):
+#use_session=True updates the cached header (written back when the session ends), False reads it again
+#deadline (Deadline) bounds the retries, the first attempt of every write always runs
+def write_recent_tx(uid, tx, use_session=True, deadline=None):
+    deadline = _no_deadline(deadline)
+    session = session_for(uid).use(deadline) if use_session else None
     #load or create the header
-    metadata = load_init_header(uid)
+    metadata = session.header() if session else load_init_header(uid, deadline)
     #if header is None, return False
     if not metadata:
         return False, "header not found"
+    #ring recovery did not finish, the write index could point at a record still in use
+    if session and session.stale:
+        return False, "ring recovery incomplete"
+
+    #version 2 cards, the header is written back by the session (every write without one)
+    if metadata["version"] >= 2:
+        s = session or _one_off_session(uid, metadata, flush_every=1, deadline=deadline)
+        ok, msg = _write_tx_v2(s, metadata, tx)
+        if not ok:
+            return ok, msg
+        metadata["total_count"] = min(65535, metadata["total_count"] + 1)
+        metadata["last_timestamp"] = int(time.time())
+        if not s.header_updated():
+            return False, "header write failed"
+        return True, msg
     
     #get the block to write to with current write index
     block = TX_DATA_BLOCKS[metadata["write_index"] % len(TX_DATA_BLOCKS)]
 
     #try to write the transaction data to the block, if it fails, return False and an error message
-    if not write_block(uid, block, tx): 
+    if not (session.write_block(block, tx) if session else write_block(uid, block, tx, deadline=deadline)):
         return False, "write failed"
     #if write succeeds, update the metadata
     #increment write index, wrap back to start if it exceeds the number of data blocks
     metadata["write_index"] = (metadata["write_index"] + 1) % len(TX_DATA_BLOCKS)
+    metadata["tail"] = 1
     #increment total count, but limit it to 65535 (2 byte unsigned integer max)
     metadata["total_count"] = min(65535, metadata["total_count"] + 1)
     #set the last timestamp to current time
     metadata["last_timestamp"] = int(time.time())
 
+    if session:
+        #the session writes the header back when its flush policy says so
+        if not session.header_updated():
+            return False, "header write failed"
     #only update header every 3 transactions to speed up process
-    UPDATE_HEADER_EVERY = 3
-    if (metadata["total_count"] % UPDATE_HEADER_EVERY) == 0:
+    elif (metadata["total_count"] % UPDATE_HEADER_EVERY) == 0:
         #try to write the updated metadata back to the header block
-        if not write_header(uid, metadata):
+        if not write_header(uid, metadata, deadline):
             return False, "header write failed"
-    else:
-        pass
 
     #if everything succeeds, return True and a success message
     return True, "write successful"
@@ -336,6 +1082,8 @@ def write_recent_tx(uid, tx):
 
 #function to clear the ring buffer by writing empty blocks
 def clear_ring_buffer(uid):
+    #the cached session state no longer matches the card
+    end_session(flush=False)
     #create a payload of 16 bytes of zeros
     payload = bytes([0] * 16)
     cleared = 0
@@ -349,23 +1097,76 @@ def clear_ring_buffer(uid):
     return cleared
 
 #function to reset the header, keeping the magic bytes
-def reset_header(uid, version=1):
+def reset_header(uid, version=CARD_VERSION):
+    #the cached session state no longer matches the card
+    end_session(flush=False)
     #create a new header with default values
     metadata = {
         "version": version,
         "write_index": 0,
         "total_count": 0,
-        "last_timestamp": 0
+        "last_timestamp": 0,
+        "tail": 0,
+        "seq": 0,
     }
     return write_header(uid, metadata)
 
 #function to clear the header including the magic bytes
 def clear_header(uid):
+    #the cached session state no longer matches the card
+    end_session(flush=False)
     #clear the header block by writing all zeros
     return write_block(uid, HEADER_BLOCK, b"\x00"*16)
 
+#function to get the blocks of a formatted card: every data block blank and the header reset (or cleared)
+def format_target(keep_header=True, version=CARD_VERSION):
+    blank = bytes(16)
+    target = {b: blank for b in TX_DATA_BLOCKS}
+    target[HEADER_BLOCK] = pack_header(version, 0, 0, 0) if keep_header else blank
+    return target
+
+#function to bring a card to target (dict of block -> 16 bytes), writing only the blocks that differ
+#reads every sector once, writes the differing data blocks (one auth per sector) and then the header, so a card
+#pulled away part way never has a fresh header in front of old records
+#verify=True reads the written blocks back
+#returns a dict: written, skipped (already matched), failed (not written or not read back as written), unread
+def sync_blocks(uid, target, verify=False, deadline=None):
+    #the cached session state no longer matches the card
+    end_session(flush=False)
+    current = read_blocks(uid, list(target), deadline=deadline)
+    #blocks that could not be read are written anyway
+    diff = {b: data for b, data in target.items() if current[b] is None or bytes(current[b]) != data}
+    stats = {"written": 0, "skipped": len(target) - len(diff), "failed": 0,
+             "unread": sum(1 for b in target if current[b] is None)}
+    header = diff.pop(HEADER_BLOCK, None)
+    done = write_blocks(uid, diff, deadline=deadline)
+    if header is not None:
+        #the header goes last, and only once the ring matches
+        if all(done.values()):
+            done[HEADER_BLOCK] = write_block(uid, HEADER_BLOCK, header, deadline=deadline)
+        else:
+            done[HEADER_BLOCK] = False
+    stats["written"] = sum(1 for ok in done.values() if ok)
+    stats["failed"] = len(done) - stats["written"]
+    if verify and stats["written"]:
+        written = [b for b, ok in done.items() if ok]
+        back = read_blocks(uid, written, deadline=deadline)
+        stats["failed"] += sum(1 for b in written if back[b] is None or bytes(back[b]) != target[b])
+    return stats
+
+#function to format a card, writing only the blocks that are not blank/reset already (see sync_blocks)
+#returns (ok, stats)
+def provision_card(uid, keep_header=True, verify=True, deadline=None):
+    stats = sync_blocks(uid, format_target(keep_header), verify=verify, deadline=deadline)
+    return stats["failed"] == 0, stats
+
 #function to format card for use, clear data blocks and reset or clear header
-def format_card(uid, keep_header=True):
+#diff=True reads the card first and only writes blocks that differ (provision_card), False writes every block
+def format_card(uid, keep_header=True, diff=True, verify=False):
+    if diff:
+        ok, st = provision_card(uid, keep_header=keep_header, verify=verify)
+        return ok, (f"wrote {st['written']} blocks, {st['skipped']} already blank; "
+                    f"header {'reset' if keep_header else 'cleared'}" + (f"; {st['failed']} FAILED" if st["failed"] else ""))
     #clear the ring buffer
     cleared = clear_ring_buffer(uid)
     #if keep_header is True, reset the header (keep magic, reset counters)
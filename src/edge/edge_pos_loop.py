@@ -4,12 +4,14 @@ import time
 import argparse
 
 #import helper functions from edge_card.py
-from edge.edge_card import wait_for_card, pack_tx, read_recent_tx, write_recent_tx
+from edge.edge_card import wait_for_card, pack_tx, read_recent_tx, write_recent_tx, end_session, Deadline
 #import rules wrapper
 from edge.edge_rules import EdgeRules
 
 #constant for merchant ID, used in transactions
 MERCHANT_ID = 1234
+#time budget for the card IO of one tap (ms), the decision uses whatever history was read in time
+TAP_BUDGET_MS = 300
 
 #instantiate the edge rules object (add path to zipcode CSV file)
 rules = EdgeRules(zip_csv_path="data/raw/zip_lat_long.csv")
@@ -28,11 +30,13 @@ def process_transaction(args):
         return
     #set card ID from the UID
     card_id = uid.hex()
-    #read recent transactions from the card up to 10 txs
-    meta, recent = read_recent_tx(uid, max_count=10)
+    #the tap's time budget starts once the card is selected
+    deadline = Deadline(args.budget_ms / 1000.0 if args.budget_ms > 0 else None)
+    #read recent transactions from the card up to 10 txs (fewer if the budget runs out)
+    meta, recent = read_recent_tx(uid, max_count=10, deadline=deadline)
 
-    #warmup the rules using on-card history
-    rules.warmup_from_card(card_id, list(reversed(recent)))
+    #warmup the rules using on-card history (partial history is still used)
+    rules.warmup_from_card(card_id, list(reversed(recent)), partial=deadline.partial)
 
     #create transaction dictionary for rules evaluation
     tx = {
@@ -61,8 +65,12 @@ def process_transaction(args):
         zip_code=args.zip, 
         flags=1 if edge_flag else 0
     )
-    ok, msg = write_recent_tx(uid, rec)
+    ok, msg = write_recent_tx(uid, rec, deadline=deadline)
+    #end the card session while the card is still on the reader (writes back the cached header)
+    end_session()
     print("Append:", ok, msg)
+    #history full/partial/none, retries and time used against the budget
+    print("Tap:", deadline.report())
 
 #main function to run the script
 if __name__ == "__main__":
@@ -72,6 +80,8 @@ if __name__ == "__main__":
     p.add_argument("amount_cents", type=int)
     p.add_argument("--merchant", type=int, default=MERCHANT_ID)
     p.add_argument("--zip")
+    #card IO budget per tap in ms (0 = no budget, retry until the attempts run out)
+    p.add_argument("--budget-ms", type=int, default=TAP_BUDGET_MS)
     #parse the command line arguments
     args = p.parse_args()
 
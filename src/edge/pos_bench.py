@@ -1,8 +1,15 @@
 #import libraries, classe and functiosn
-import time, statistics
+import time, statistics, argparse, os, sys, subprocess, tempfile, threading
 from time import perf_counter_ns
 from edge.edge_rules import EdgeRules
-from edge.edge_card import wait_for_card, read_recent_tx, write_recent_tx, pack_tx
+from edge.card_reader import make_reader, set_reader, SimulatedReader, SimulatedCard
+from edge.reader_pool import ReaderPool
+from edge.pos_daemon import PosDaemon, PosClient
+from edge.async_pos import AsyncTapLoop
+import edge.demo_script as demo_script
+import asyncio
+from edge.edge_card import (wait_for_card, read_recent_tx, write_recent_tx, pack_tx, io_stats,
+                            reset_io_stats, end_session, reset_header, format_card, provision_card, Deadline)
 
 #helper funcs
 #nanosecond timer
@@ -12,8 +19,227 @@ def us(dt_ns): return dt_ns / 1e3
 #convert to milliseconds
 def ms(dt_ns): return dt_ns / 1e6
 
+#fucntion to sort and index lists
+def q(arr, p):
+    #sort the input list
+    arr = sorted(arr)
+    #get index for percentile p
+    idx = max(0, min(len(arr)-1, int(p/100*len(arr))-1))
+    #return value at index
+    return arr[idx]
+
+#function to compare reading the recent tx block by block (one auth per block) vs one auth per sector
+def compare_reads(uid, iters=20):
+    for label, batched in (("per block", False), ("per sector", True)):
+        times = []
+        reset_io_stats()
+        for _ in range(iters):
+            t0 = ns()
+            read_recent_tx(uid, max_count=10, batched=batched, use_session=False)
+            times.append(ms(ns() - t0))
+        st = io_stats()
+        print(f"Read {label:<10} (ms): mean={statistics.mean(times):.2f}  P50={q(times,50):.2f}  "
+              f"P95={q(times,95):.2f}  auths/read={st['auths'] / iters:.1f}  retries={st['retries']}")
+
+#function to measure tap throughput of a multi lane host with 1..max_lanes simulated readers sharing one EdgeRules
+#every lane alternates between two cards of its own, so the store's merchant window sees 2 cards per lane
+def compare_lanes(max_lanes=4, taps=40, latency_scale=1.0, auth_fail_rate=0.0):
+    print(f"{taps} taps per lane, simulated readers (latency x{latency_scale}, {auth_fail_rate:.0%} auth failures)")
+    for n in range(1, max_lanes + 1):
+        rules = EdgeRules(zip_csv_path="data/raw/zip_lat_long.csv")
+        readers = []
+        cards = []
+        for i in range(n):
+            reader = SimulatedReader(latency={k: v * latency_scale for k, v in SimulatedReader.LATENCY.items()},
+                                     auth_fail_rate=auth_fail_rate, seed=i)
+            pair = [SimulatedCard(), SimulatedCard()]
+            #provision the cards (header written) as a card issuer would, a blank card's first tap has to scan
+            #the whole ring for a lost header
+            set_reader(reader)
+            for card in pair:
+                reader.present(card)
+                reset_header(card.uid)
+            set_reader(None)
+            reader.present(pair[0])
+            readers.append(reader)
+            cards.append(pair)
+
+        #swap the lane's card after every tap (runs on the lane's thread)
+        def next_card(lane, result):
+            pair = cards[lane.index]
+            lane.reader.present(pair[1] if lane.reader.card is pair[0] else pair[0])
+
+        pool = ReaderPool(rules, readers, on_result=next_card).start()
+        t0 = ns()
+        futures = [pool.charge(i, 999) for _ in range(taps) for i in range(n)]
+        results = [f.result() for f in futures]
+        elapsed = ms(ns() - t0) / 1e3
+        pool.stop()
+        tap_ms = [r["ms"] for r in results]
+        merchant_flags = sum(1 for r in results if "merchant_window" in r["reasons"])
+        failed = sum(1 for r in results if not r["ok"])
+        print(f"  {n} lane(s): {len(results) / elapsed:6.1f} taps/s  tap P50={q(tap_ms,50):.1f} ms  "
+              f"P95={q(tap_ms,95):.1f} ms  merchant window flags={merchant_flags}  failed writes={failed}")
+
+#function to compare formatting a batch of used cards block by block vs diff aware (read, write what differs, verify)
+#the batch is a mix as a card issuer sees it: new blank cards, cards already formatted and cards with some history
+def compare_format(cards=12, latency_scale=1.0, auth_fail_rate=0.0):
+    reader = SimulatedReader(latency={k: v * latency_scale for k, v in SimulatedReader.LATENCY.items()},
+                             auth_fail_rate=auth_fail_rate, seed=0)
+    set_reader(reader)
+    print(f"{cards} cards (blank / formatted / used), simulated reader "
+          f"(latency x{latency_scale}, {auth_fail_rate:.0%} auth failures)")
+    for label, diff in (("every block", False), ("diff + verify", True)):
+        batch = []
+        for i in range(cards):
+            card = SimulatedCard()
+            reader.present(card)
+            if i % 3:
+                reset_header(card.uid)
+            #used cards: a few taps of history
+            for t in range(((i % 3) - 1) * 6):
+                write_recent_tx(card.uid, pack_tx(1_700_000_000 + t * 60, 999, 1234, 0), use_session=False)
+            batch.append(card)
+        times = []
+        writes = 0
+        skipped = 0
+        bad = 0
+        for card in batch:
+            reader.present(card)
+            reset_io_stats()
+            t0 = ns()
+            if diff:
+                ok, st = provision_card(card.uid, verify=True)
+                skipped += st["skipped"]
+            else:
+                ok, _ = format_card(card.uid, diff=False)
+            times.append(ms(ns() - t0))
+            writes += io_stats()["writes"]
+            bad += 0 if ok else 1
+        print(f"  {label:<14} per card (ms): mean={statistics.mean(times):.1f}  P95={q(times,95):.1f}  "
+              f"{60e3 / statistics.mean(times):.0f} cards/min (card IO only)  writes={writes}  skipped={skipped}  "
+              f"failed={bad}")
+    set_reader(None)
+
+#function to compare charges through the POS daemon (one process, rules and reader kept warm) with the one shot
+#CLI (python -m edge.edge_pos_loop, a new process per sale), both on the simulated reader
+#the one shot CLI starts with a blank simulated card every time, so the daemon is run once with its card kept
+#(the real till) and once with a blank card per charge (same card IO as the one shot runs)
+#no tap budget on either, a blank card's first tap scans the whole ring and would run out of a 300 ms budget
+def compare_daemon(requests=50, one_shot=10, latency_scale=1.0):
+    latency = {k: v * latency_scale for k, v in SimulatedReader.LATENCY.items()}
+    tmp = tempfile.mkdtemp()
+    print(f"{requests} daemon charges, {one_shot} one shot charges, simulated reader (latency x{latency_scale})")
+    for label, fresh in (("daemon, same card", False), ("daemon, blank card each", True)):
+        reader = SimulatedReader(SimulatedCard(), latency=latency)
+        daemon = PosDaemon([reader], path=os.path.join(tmp, f"pos{int(fresh)}.sock"), budget_ms=0).start()
+        if fresh:
+            daemon.pool.on_result = lambda lane, result: lane.reader.present(SimulatedCard())
+        server = threading.Thread(target=daemon.serve_forever, daemon=True)
+        server.start()
+        times = []
+        failed = 0
+        t0 = ns()
+        with PosClient(daemon.path) as client:
+            for i in range(requests):
+                t_r0 = ns()
+                result = client.charge(999 + i, "10036")
+                times.append(ms(ns() - t_r0))
+                failed += 0 if result["ok"] else 1
+        elapsed = ms(ns() - t0) / 1e3
+        daemon.shutdown()
+        daemon.close()
+        print(f"  {label:<24} {requests / elapsed:6.1f} req/s  latency P50={q(times,50):7.1f} ms  "
+              f"P95={q(times,95):7.1f} ms  first={times[0]:7.1f} ms  failed writes={failed}")
+
+    env = dict(os.environ, EDGE_READER="sim", PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    times = []
+    for i in range(one_shot):
+        t_r0 = ns()
+        subprocess.run([sys.executable, "-m", "edge.edge_pos_loop", str(999 + i), "--zip", "10036", "--budget-ms", "0"],
+                       env=env, capture_output=True, check=True)
+        times.append(ms(ns() - t_r0))
+    print(f"  {'one shot CLI':<24} {1e3 / statistics.mean(times):6.1f} req/s  latency P50={q(times,50):7.1f} ms  "
+          f"P95={q(times,95):7.1f} ms  (new process per charge, simulator latency x1)")
+    os.rmdir(tmp)
+
+#function to compare sustained taps per minute of the sequential loop (detect, read+warmup, evaluate, write, log,
+#one after the other as demo_script.eval_and_write) with the asyncio staged loop (async_pos.AsyncTapLoop)
+#both run on a simulated reader whose card is swapped for the next customer's as soon as a tap's write is done
+#log_ms adds a storage delay to every CSV log line (an SD card flush on the Pi, 0 = this machine's disk)
+def compare_async(taps=40, latency_scale=1.0, log_ms=0.0):
+    latency = {k: v * latency_scale for k, v in SimulatedReader.LATENCY.items()}
+    tmp = tempfile.mkdtemp()
+    demo_script.LOG_PATH = os.path.join(tmp, "pos_log.csv")
+
+    def log(tx, flag, reasons):
+        demo_script.log_row(tx, flag, reasons)
+        if log_ms:
+            time.sleep(log_ms / 1000.0)
+
+    #provisioned cards, a blank card's first tap scans the whole ring
+    def new_cards(reader):
+        set_reader(reader)
+        cards = [SimulatedCard() for _ in range(4)]
+        for card in cards:
+            reader.present(card)
+            reset_header(card.uid)
+        set_reader(None)
+        return cards
+
+    print(f"{taps} taps, 4 cards in turn, simulated reader (latency x{latency_scale}), log +{log_ms:g} ms per line")
+    #sequential loop
+    reader = SimulatedReader(latency=latency, seed=0)
+    cards = new_cards(reader)
+    reader.present(cards[0])
+    set_reader(reader)
+    rules = EdgeRules(zip_csv_path="data/raw/zip_lat_long.csv")
+    t0 = ns()
+    for i in range(taps):
+        uid = wait_for_card(timeout=10)
+        deadline = Deadline(0.3)
+        meta, recent = read_recent_tx(uid, max_count=10, deadline=deadline)
+        rules.warmup_from_card(uid.hex(), list(reversed(recent)), partial=deadline.partial)
+        tx = {"timestamp": int(time.time()), "merchant_id": 1234, "card_id": uid.hex(), "amount": 9.99,
+              "amount_cents": 999, "zip": "10036", "lat": None, "lon": None}
+        flag, reasons = rules.evaluate(tx)
+        write_recent_tx(uid, pack_tx(tx["timestamp"], 999, 1234, 1 if flag else 0, zip_code="10036"),
+                        deadline=deadline)
+        end_session()
+        reader.present(cards[(i + 1) % len(cards)])
+        log(tx, flag, reasons)
+    seq_s = ms(ns() - t0) / 1e3
+    set_reader(None)
+    print(f"  {'sequential loop':<16} {taps / seq_s * 60:7.1f} taps/min")
+
+    #staged asyncio loop
+    reader = SimulatedReader(latency=latency, seed=0)
+    cards = new_cards(reader)
+    reader.present(cards[0])
+    turn = [0]
+
+    def next_card(result):
+        turn[0] += 1
+        reader.present(cards[turn[0] % len(cards)])
+
+    async def run():
+        loop = AsyncTapLoop(EdgeRules(zip_csv_path="data/raw/zip_lat_long.csv"), reader, log=log,
+                            on_result=next_card).start()
+        futures = [loop.charge(999, "10036") for _ in range(taps)]
+        t0 = ns()
+        results = await asyncio.gather(*futures)
+        await loop.stop()
+        return ms(ns() - t0) / 1e3, results, loop.stats
+
+    async_s, results, stats = asyncio.run(run())
+    print(f"  {'asyncio stages':<16} {taps / async_s * 60:7.1f} taps/min  (x{seq_s / async_s:.2f})  "
+          f"failed writes={sum(1 for r in results if not r['ok'])}  logged={stats['logged']}")
+    demo_script.close_log()
+    os.remove(demo_script.LOG_PATH)
+    os.rmdir(tmp)
+
 #main function to test pos loop
-def main(iters=20):
+def main(iters=20, budget_ms=0):
     #ask user to present card
     print("Place and KEEP a card on the antenna for the duration.")
     #get uid
@@ -25,10 +251,31 @@ def main(iters=20):
     rules = EdgeRules(zip_csv_path="data/raw/zip_lat_long.csv")
 
     #warm up from card
-    meta, recent = read_recent_tx(uid, max_count=10)
+    meta, recent = read_recent_tx(uid, max_count=10, use_session=False)
     rules.warmup_from_card(uid_hex, list(reversed(recent)))
 
+    #block by block vs sector batched reads of the header + last 10 records
+    compare_reads(uid, iters)
+
+    #the same tap loop reading the card every time (old) and through the per card session cache
+    for use_session in (False, True):
+        run_taps(uid, rules, iters, use_session)
+    #the session loop again with a card IO budget per tap
+    if budget_ms > 0:
+        run_taps(uid, rules, iters, True, budget_ms)
+    #write back the header still cached by the session
+    end_session()
+
+#function to time iters taps (read, warmup, evaluate, write) and print the results
+#use_session=False reads the header/blocks from the card on every call, True uses the per card session cache
+#budget_ms > 0 gives every tap a Deadline, reads stop early (partial history) when it runs out
+def run_taps(uid, rules, iters, use_session, budget_ms=0):
+    uid_hex = uid.hex()
     #lists to store times
+    auths = []
+    retries = []
+    partial = 0
+    failed = 0
     eval_us = []
     read_ms = []
     write_ms = []
@@ -38,14 +285,16 @@ def main(iters=20):
     for i in range(iters):
         #start time
         t0 = ns()
+        reset_io_stats()
+        deadline = Deadline(budget_ms / 1000.0) if budget_ms > 0 else None
 
         #check read time
         t_r0 = ns()
-        meta, recent = read_recent_tx(uid, max_count=10)
+        meta, recent = read_recent_tx(uid, max_count=10, use_session=use_session, deadline=deadline)
         t_r1 = ns()
 
         #warm up rules from history
-        rules.warmup_from_card(uid_hex, list(reversed(recent)))
+        rules.warmup_from_card(uid_hex, list(reversed(recent)), partial=deadline is not None and deadline.partial)
 
         #time evaluation of transaction
         tx_ts = int(time.time())
@@ -64,7 +313,7 @@ def main(iters=20):
         #time writing tx to cards
         rec = pack_tx(tx_ts, amount_cents, tx["merchant_id"], 1 if flag else 0)
         t_w0 = ns()
-        ok, _ = write_recent_tx(uid, rec)
+        ok, _ = write_recent_tx(uid, rec, use_session=use_session, deadline=deadline)
         t_w1 = ns()
 
         #stop time
@@ -75,19 +324,15 @@ def main(iters=20):
         eval_us.append(us(t_e1 - t_e0))
         write_ms.append(ms(t_w1 - t_w0))
         total_ms.append(ms(t1 - t0))
-
-    #fucntion to sort and index lists
-    def q(arr, p):
-        #sort the input list
-        arr = sorted(arr)
-        #get index for percentile p
-        idx = max(0, min(len(arr)-1, int(p/100*len(arr))-1))
-        #return value at index
-        return arr[idx]
+        auths.append(io_stats()["auths"])
+        retries.append(io_stats()["retries"])
+        partial += 1 if deadline is not None and deadline.partial else 0
+        failed += 0 if ok else 1
 
     #print all results
     #numbner of iterations
-    print(f"\nIters: {iters}")
+    budget = f"{budget_ms} ms" if budget_ms > 0 else "none"
+    print(f"\nIters: {iters}  card session cache: {'on' if use_session else 'off'}  budget per tap: {budget}")
     #mean and 50th/95th percentile for read timing
     print(f"Read  (ms): mean={statistics.mean(read_ms):.2f}  P50={q(read_ms,50):.2f}  P95={q(read_ms,95):.2f}")
     #mean and 50th/95th percentile for evaluation timing
@@ -96,7 +341,51 @@ def main(iters=20):
     print(f"Write (ms): mean={statistics.mean(write_ms):.2f}  P50={q(write_ms,50):.2f}  P95={q(write_ms,95):.2f}")
     #mean and 50th/95th percentile for total timing
     print(f"TOTAL (ms): mean={statistics.mean(total_ms):.2f}  P50={q(total_ms,50):.2f}  P95={q(total_ms,95):.2f}")
+    #card authentications per tap (read + write)
+    print(f"Auths per tap: mean={statistics.mean(auths):.1f}  max={max(auths)}")
+    #retries, taps decided on partial history and taps whose write failed
+    print(f"Retries per tap: mean={statistics.mean(retries):.1f}  max={max(retries)}  "
+          f"partial history={partial}/{iters}  failed writes={failed}/{iters}")
 
 if __name__ == "__main__":
-    #call main function with 30 iterations
-    main(iters=30)
+    p = argparse.ArgumentParser(description="End to end tap benchmark (card read, warmup, evaluate, card write)")
+    p.add_argument("--iters", type=int, default=30)
+    #sim runs against the in-memory MIFARE simulator (no Pi needed), default is $EDGE_READER or the PN532
+    p.add_argument("--reader", choices=["pn532", "sim"], default=None)
+    #simulator only: scale its per command latency (0 = as fast as possible)
+    p.add_argument("--latency-scale", type=float, default=1.0)
+    #simulator only: fraction of authentications that fail (RF noise), each one costs a reselect and a retry
+    p.add_argument("--auth-fail-rate", type=float, default=0.0)
+    #also run the session loop with this card IO budget per tap (ms)
+    p.add_argument("--budget-ms", type=int, default=0)
+    #measure a multi lane host with 1..N simulated readers instead of the single card benchmark
+    p.add_argument("--lanes", type=int, default=0)
+    #measure formatting a batch of this many simulated cards (full vs diff aware) instead
+    p.add_argument("--format-cards", type=int, default=0)
+    #measure charges through the POS daemon vs the one shot CLI (this many daemon charges)
+    p.add_argument("--daemon", type=int, default=0)
+    #measure taps/min of the sequential loop vs the asyncio staged loop (this many taps), with a storage delay per
+    #log line
+    p.add_argument("--async-taps", type=int, default=0)
+    p.add_argument("--log-ms", type=float, default=0.0)
+    args = p.parse_args()
+    if args.async_taps:
+        compare_async(args.async_taps, args.latency_scale, args.log_ms)
+        raise SystemExit
+    if args.daemon:
+        compare_daemon(args.daemon, max(1, min(args.iters, args.daemon)), args.latency_scale)
+        raise SystemExit
+    if args.format_cards:
+        compare_format(args.format_cards, args.latency_scale, args.auth_fail_rate)
+        raise SystemExit
+    if args.lanes:
+        compare_lanes(args.lanes, args.iters, args.latency_scale, args.auth_fail_rate)
+        raise SystemExit
+    if args.reader:
+        reader = make_reader(args.reader)
+        if isinstance(reader, SimulatedReader):
+            reader.latency = {k: v * args.latency_scale for k, v in reader.latency.items()}
+            reader.auth_fail_rate = args.auth_fail_rate
+        set_reader(reader)
+    #call main function
+    main(iters=args.iters, budget_ms=args.budget_ms)
@@ -0,0 +1,202 @@
+#compact binary POS log: fixed width records, reasons stored as a bitmask
+#written by tx_log.TxLog(fmt="bin") or converted from a CSV log (python -m edge.pos_binlog log.csv log.posb)
+#reports read it with numpy.memmap and work on whole columns at once, so months of traffic are not parsed row by row
+#writing only needs the standard library, numpy is imported by the readers
+import argparse
+import csv
+import datetime
+import os
+import re
+import struct
+
+#file header: magic, version, record size, 8 spare bytes (16 bytes)
+MAGIC = b"POSB"
+VERSION = 1
+HEADER = struct.Struct("<4sHH8x")
+#record (little endian, 32 bytes): timestamp (epoch s), amount in cents, merchant id, travel speed (km/h) of an
+#impossible_travel reason, card uid as an int, reason bitmask, uid length (hex digits), flag, 4 spare bytes
+RECORD = struct.Struct("<IiIIQHBB4x")
+#numpy dtype of a record (same layout)
+DTYPE_FIELDS = [("ts", "<u4"), ("amount_cents", "<i4"), ("merchant_id", "<u4"), ("travel_kmh", "<u4"),
+                ("uid", "<u8"), ("reasons", "<u2"), ("uid_len", "u1"), ("flag", "u1"), ("spare", "V4")]
+#file extension of binary logs
+SUFFIX = ".posb"
+
+#reason name -> bit (impossible_travel_<speed>kmh is one reason, its speed goes in travel_kmh)
+REASON_BITS = {"merchant_window": 0, "card_window": 1, "amount_cap": 2, "card_ewma": 3, "impossible_travel": 4}
+#bit for any reason not in REASON_BITS (the name is not kept, so convert_csv refuses them unless told otherwise)
+OTHER_BIT = 15
+REASON_NAMES = {b: name for name, b in REASON_BITS.items()}
+REASON_NAMES[OTHER_BIT] = "other"
+_TRAVEL = re.compile(r"impossible_travel_(\d+)kmh")
+
+#function to get a reason's name without its details (impossible_travel_812kmh -> impossible_travel)
+def reason_name(reason):
+    return "impossible_travel" if _TRAVEL.fullmatch(reason) else reason
+
+#function to turn a list of reasons into (bitmask, travel speed)
+def reason_mask(reasons):
+    mask = 0
+    kmh = 0
+    for r in reasons:
+        m = _TRAVEL.fullmatch(r)
+        if m:
+            kmh = min(int(m.group(1)), 0xFFFFFFFF)
+        mask |= 1 << REASON_BITS.get(reason_name(r), OTHER_BIT)
+    return mask, kmh
+
+#function to turn a bitmask (and travel speed) back into reason strings, in rule order
+def mask_reasons(mask, kmh=0):
+    out = []
+    for b in sorted(REASON_NAMES):
+        if mask >> b & 1:
+            out.append(f"impossible_travel_{kmh}kmh" if b == REASON_BITS["impossible_travel"] else REASON_NAMES[b])
+    return out
+
+#function to get the file header bytes
+def file_header():
+    return HEADER.pack(MAGIC, VERSION, RECORD.size)
+
+#function to pack one log row, card_id is the uid in hex (anything else is stored as uid 0, length 0)
+def pack_row(ts, card_id, amount_cents, merchant_id, flag, reasons):
+    card_id = str(card_id)
+    try:
+        uid = int(card_id, 16) if len(card_id) <= 16 else 0
+        uid_len = len(card_id) if uid or card_id.strip("0") == "" else 0
+    except ValueError:
+        uid, uid_len = 0, 0
+    mask, kmh = reason_mask(reasons)
+    return RECORD.pack(int(ts) & 0xFFFFFFFF, int(amount_cents), int(merchant_id) & 0xFFFFFFFF, kmh, uid, mask,
+                       uid_len, int(flag) & 0xFF)
+
+#function to unpack one record into (ts, card_id, amount_cents, merchant_id, flag, reasons)
+def unpack_row(b):
+    ts, amount, merchant, kmh, uid, mask, uid_len, flag = RECORD.unpack(b)
+    card_id = f"{uid:0{uid_len}x}" if uid_len else ""
+    return ts, card_id, amount, merchant, flag, mask_reasons(mask, kmh)
+
+#function to check whether path is a binary log (by its magic)
+def is_binlog(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+#function to convert a CSV log (ts_iso,uid,amount_cents,merchant_id,flag,reasons) to a binary log
+#ts_iso is local time as log_row writes it, so convert on a machine in the same time zone
+#a reason with no bit in REASON_BITS raises ValueError and nothing is left at bin_path, allow_other=True stores it
+#as "other" instead (its name is lost)
+#returns the number of rows converted
+def convert_csv(csv_path, bin_path, chunk_rows=65536, allow_other=False):
+    n = 0
+    with open(csv_path, newline="") as src, open(bin_path, "wb") as dst:
+        try:
+            dst.write(file_header())
+            rows = csv.reader(src)
+            header = next(rows, None)
+            if header is None:
+                return 0
+            col = {name: i for i, name in enumerate(header)}
+            ti, ui, ai, mi, fi, ri = (col[k] for k in ("ts_iso", "uid", "amount_cents", "merchant_id", "flag",
+                                                       "reasons"))
+            buf = []
+            for row in rows:
+                ts = int(datetime.datetime.fromisoformat(row[ti]).timestamp())
+                reasons = [s for s in row[ri].split("|") if s]
+                if not allow_other:
+                    for r in reasons:
+                        if reason_name(r) not in REASON_BITS:
+                            raise ValueError(f"{csv_path} line {rows.line_num}: reason {r!r} has no bit in "
+                                             f"REASON_BITS (add one, or convert with allow_other=True to store it "
+                                             f"as 'other')")
+                buf.append(pack_row(ts, row[ui], row[ai], row[mi], row[fi], reasons))
+                if len(buf) >= chunk_rows:
+                    dst.write(b"".join(buf))
+                    n += len(buf)
+                    buf = []
+            dst.write(b"".join(buf))
+            n += len(buf)
+        except BaseException:
+            #no half converted log
+            dst.close()
+            os.remove(bin_path)
+            raise
+    return n
+
+#READERS (numpy)
+
+#function to map a binary log as a numpy record array (read only, nothing is loaded until it is used)
+def open_binlog(path):
+    import numpy as np
+    with open(path, "rb") as f:
+        head = f.read(HEADER.size)
+    if len(head) < HEADER.size:
+        raise ValueError(f"{path}: not a binary POS log (too short)")
+    magic, version, size = HEADER.unpack(head)
+    if magic != MAGIC or version != VERSION or size != RECORD.size:
+        raise ValueError(f"{path}: not a version {VERSION} binary POS log")
+    dtype = np.dtype(DTYPE_FIELDS)
+    #a record cut short by a crash mid write is left out
+    n = (os.path.getsize(path) - HEADER.size) // dtype.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=HEADER.size, shape=(n,))
+
+#function to get the rows with start <= ts < end (epoch seconds, None = open ended)
+#the log is in time order, so the range is found by binary search (falls back to a mask if it is not)
+def time_range(log, start=None, end=None):
+    import numpy as np
+    if start is None and end is None:
+        return log
+    ts = log["ts"]
+    lo = 0 if start is None else start
+    hi = 0xFFFFFFFF + 1 if end is None else end
+    if len(ts) < 2 or bool((ts[1:] >= ts[:-1]).all()):
+        return log[np.searchsorted(ts, lo, "left"):np.searchsorted(ts, hi, "left")]
+    return log[(ts >= lo) & (ts < hi)]
+
+#function to get the explainability numbers: total rows, flagged rows, flagged rows with a reason and how often
+#each reason was given on a flagged row (reason name -> count, most common first)
+def explain(log):
+    import numpy as np
+    flagged = log["flag"] == 1
+    masks = log["reasons"][flagged]
+    counts = {REASON_NAMES[b]: int(np.count_nonzero(masks & (1 << b))) for b in sorted(REASON_NAMES)}
+    counts = dict(sorted(((k, v) for k, v in counts.items() if v), key=lambda kv: -kv[1]))
+    return {"total": int(len(log)), "flagged": int(np.count_nonzero(flagged)),
+            "with_reasons": int(np.count_nonzero(masks)), "counts": counts, "speeds": _speeds(log[flagged])}
+
+#function to get the median/max travel speed of the rows with an impossible_travel reason ({} if none)
+def _speeds(log):
+    import numpy as np
+    travel = log["travel_kmh"][(log["reasons"] & (1 << REASON_BITS["impossible_travel"])) != 0]
+    return {"median_kmh": float(np.median(travel)), "max_kmh": int(travel.max())} if len(travel) else {}
+
+#function to get the flag rate per bucket_s bucket (default one day, UTC)
+#returns a list of (bucket start epoch s, rows, flagged rows) for buckets with rows
+def flag_rate(log, bucket_s=86400):
+    import numpy as np
+    if len(log) == 0:
+        return []
+    bucket = log["ts"] // bucket_s
+    first = int(bucket.min())
+    idx = (bucket - first).astype(np.int64)
+    rows = np.bincount(idx)
+    flagged = np.bincount(idx, weights=(log["flag"] == 1)).astype(np.int64)
+    return [((first + i) * bucket_s, int(rows[i]), int(flagged[i])) for i in np.flatnonzero(rows)]
+
+#function to count every reason on all rows (flagged or not) with the speeds of impossible travel reasons
+def reason_counts(log):
+    import numpy as np
+    masks = log["reasons"]
+    out = {REASON_NAMES[b]: int(np.count_nonzero(masks & (1 << b))) for b in sorted(REASON_NAMES)}
+    return {k: v for k, v in out.items() if v}, _speeds(log)
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Convert a CSV POS log to the binary log format")
+    p.add_argument("csv_path")
+    p.add_argument("bin_path", nargs="?", default=None)
+    #store reasons with no bit in REASON_BITS as "other" instead of stopping
+    p.add_argument("--allow-other", action="store_true")
+    args = p.parse_args()
+    out = args.bin_path or os.path.splitext(args.csv_path)[0] + SUFFIX
+    n = convert_csv(args.csv_path, out, allow_other=args.allow_other)
+    print(f"{n} rows -> {out} ({os.path.getsize(out) / 1e6:.1f} MB)")
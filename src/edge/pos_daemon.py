@@ -0,0 +1,308 @@
+#long running POS daemon: keeps the card reader(s), the zip table and EdgeRules (with its velocity state) in one
+#process and takes charges from the till software over a Unix domain socket
+#the till sends one request per sale, the daemon waits for the card, runs the tap (see reader_pool.ReaderPool.process)
+#and replies with the decision, so no process start, imports, reader setup or zip load is paid per sale
+#
+#protocol: every message is a 4 byte big endian length followed by that many bytes of UTF-8 JSON
+#requests (a connection can send any number, one reply each, in order):
+#  {"op": "charge", "amount_cents": 999, "merchant": 1234, "zip": "10036", "lane": 0}  (merchant/zip/lane optional)
+#  {"op": "ping"}
+#  {"op": "stats"}
+#replies: {"status": "ok", ...} or {"status": "error", "error": "<message>"}
+#
+#usage: python -m edge.pos_daemon serve [--socket PATH] [--readers ...] [--snapshot PATH]
+#       python -m edge.pos_daemon charge 999 --zip 10036
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+from edge.card_reader import make_readers
+from edge.edge_rules import EdgeRules
+from edge.reader_pool import ReaderPool, MERCHANT_ID, TAP_BUDGET_MS, CARD_TIMEOUT_S
+
+#socket path used when none is given
+SOCKET_ENV = "EDGE_POS_SOCKET"
+DEFAULT_SOCKET = "/tmp/edge_pos.sock"
+#zip table used by the rules
+ZIP_CSV_PATH = "data/raw/zip_lat_long.csv"
+#message frame: 4 byte big endian length, largest message accepted
+FRAME = struct.Struct(">I")
+MAX_MESSAGE = 64 * 1024
+#seconds a client waits for a reply (a charge waits for the card)
+CLIENT_TIMEOUT_S = CARD_TIMEOUT_S + 30
+
+#function to get the socket path (argument, $EDGE_POS_SOCKET or the default)
+def socket_path(path=None):
+    return path or os.environ.get(SOCKET_ENV) or DEFAULT_SOCKET
+
+#FRAMING
+
+#function to read exactly n bytes, returns None if the peer closed before the first byte
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            if not buf:
+                return None
+            raise ConnectionError("connection closed mid message")
+        buf += chunk
+    return bytes(buf)
+
+#function to send one message (a JSON serialisable object)
+def send_msg(sock, obj):
+    data = json.dumps(obj, separators=(",", ":")).encode("utf-8")
+    if len(data) > MAX_MESSAGE:
+        raise ValueError(f"message of {len(data)} bytes is over the {MAX_MESSAGE} byte limit")
+    sock.sendall(FRAME.pack(len(data)) + data)
+
+#function to receive one message, returns None when the peer closed the connection cleanly
+def recv_msg(sock):
+    head = _recv_exact(sock, FRAME.size)
+    if head is None:
+        return None
+    (n,) = FRAME.unpack(head)
+    if n > MAX_MESSAGE:
+        raise ValueError(f"message of {n} bytes is over the {MAX_MESSAGE} byte limit")
+    data = _recv_exact(sock, n) if n else b""
+    if data is None:
+        raise ConnectionError("connection closed mid message")
+    return json.loads(data.decode("utf-8"))
+
+#SERVER
+
+#one client connection: read requests until the client hangs up, reply to each in order
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        pos = self.server.pos
+        while True:
+            try:
+                req = recv_msg(self.request)
+            except (ValueError, ConnectionError) as e:
+                #bad frame, the stream can't be trusted any more
+                try:
+                    send_msg(self.request, {"status": "error", "error": str(e)})
+                except OSError:
+                    pass
+                return
+            if req is None:
+                return
+            send_msg(self.request, pos.handle(req))
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+#the daemon: a ReaderPool (one lane per reader) sharing one EdgeRules, behind a Unix socket
+#snapshot_path keeps the rule state across restarts (restored on start, snapshotted every snapshot_every_s)
+class PosDaemon:
+    def __init__(self, readers, path=None, merchant_id=MERCHANT_ID, budget_ms=TAP_BUDGET_MS,
+                 zip_csv_path=ZIP_CSV_PATH, snapshot_path=None, snapshot_every_s=60.0, rules=None):
+        self.path = socket_path(path)
+        self.rules = rules if rules is not None else EdgeRules(zip_csv_path=zip_csv_path)
+        self.snapshot_path = snapshot_path
+        self.snapshot_every_s = snapshot_every_s
+        self.pool = ReaderPool(self.rules, readers, merchant_id=merchant_id, budget_ms=budget_ms)
+        self.server = None
+        self.started = None
+        self.served = 0
+        self._count_lock = threading.Lock()
+
+    #function to bind the socket, restore the rule state and start the lanes
+    #the socket goes first so a second daemon gives up before it touches the snapshot, journal or readers
+    #if a later step fails, the steps already done are undone (in reverse) before the error is raised
+    def start(self):
+        #a socket file left by a daemon that died is removed, one still answering is not
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                os.unlink(self.path)
+            else:
+                raise RuntimeError(f"another daemon is listening on {self.path}")
+            finally:
+                probe.close()
+        self.server = _Server(self.path, _Handler)
+        self.server.pos = self
+        snapshots = False
+        try:
+            os.chmod(self.path, 0o660)
+            if self.snapshot_path:
+                replayed = self.rules.restore(self.snapshot_path)
+                print(f"restored rule state from {self.snapshot_path} ({replayed} journaled ops replayed)")
+                self.rules.start_snapshots(self.snapshot_path, every_s=self.snapshot_every_s)
+                snapshots = True
+            self.pool.start()
+        except BaseException:
+            if snapshots:
+                #no final snapshot, the state on disk is still the one restored (plus its journal)
+                self.rules.stop_snapshots(final=False)
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            raise
+        self.started = time.monotonic()
+        return self
+
+    #function to answer one request (runs on the connection's thread, charges wait on the lane's Future)
+    def handle(self, req):
+        if not isinstance(req, dict):
+            return {"status": "error", "error": "request must be a JSON object"}
+        op = req.get("op")
+        if op == "charge":
+            try:
+                lane = int(req.get("lane", 0))
+                amount_cents = int(req["amount_cents"])
+                merchant = req.get("merchant")
+                merchant = None if merchant is None else int(merchant)
+                if not 0 <= lane < len(self.pool.lanes):
+                    raise ValueError(f"no lane {lane}")
+            except (KeyError, TypeError, ValueError) as e:
+                return {"status": "error", "error": f"bad charge request: {e}"}
+            zip_code = req.get("zip")
+            #a tap that fails (reader error, bad card data) is the till's problem to report, not the daemon's
+            try:
+                result = self.pool.charge(lane, amount_cents, None if zip_code is None else str(zip_code),
+                                          merchant_id=merchant).result()
+            except Exception as e:
+                return {"status": "error", "error": str(e)}
+            with self._count_lock:
+                self.served += 1
+            return {"status": "ok", "result": result}
+        if op == "ping":
+            return {"status": "ok", "lanes": len(self.pool.lanes), "uptime_s": time.monotonic() - self.started}
+        if op == "stats":
+            return {"status": "ok", "served": self.served,
+                    "lanes": [dict(lane.stats) for lane in self.pool.lanes], "state": self.rules.state_stats()}
+        return {"status": "error", "error": f"unknown op {op!r}"}
+
+    #function to serve until shutdown() (from another thread or a signal)
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+    #function to close the socket, stop the lanes and write a last snapshot
+    def close(self):
+        if self.server is not None:
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        self.pool.stop()
+        if self.snapshot_path:
+            self.rules.stop_snapshots(final=True)
+
+#CLIENT
+
+#client for the till software, keeps one connection open for any number of requests
+class PosClient:
+    def __init__(self, path=None, timeout=CLIENT_TIMEOUT_S):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path(path))
+
+    #function to send a request and wait for its reply
+    def request(self, req):
+        send_msg(self.sock, req)
+        reply = recv_msg(self.sock)
+        if reply is None:
+            raise ConnectionError("daemon closed the connection")
+        return reply
+
+    #function to charge amount_cents, returns the tap result (see ReaderPool.process)
+    #raises RuntimeError if the daemon rejected the request
+    def charge(self, amount_cents, zip_code=None, merchant_id=None, lane=0):
+        req = {"op": "charge", "amount_cents": int(amount_cents), "lane": lane}
+        if zip_code is not None:
+            req["zip"] = zip_code
+        if merchant_id is not None:
+            req["merchant"] = merchant_id
+        reply = self.request(req)
+        if reply.get("status") != "ok":
+            raise RuntimeError(reply.get("error"))
+        return reply["result"]
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#function to run the daemon until Ctrl-C or SIGTERM
+def serve(args):
+    daemon = PosDaemon(make_readers(args.readers), path=args.socket, merchant_id=args.merchant,
+                       budget_ms=args.budget_ms, zip_csv_path=args.zip_csv, snapshot_path=args.snapshot,
+                       snapshot_every_s=args.snapshot_every).start()
+    #shutdown() blocks until serve_forever returns, so call it off the main thread
+    signal.signal(signal.SIGTERM, lambda *a: threading.Thread(target=daemon.shutdown).start())
+    print(f"POS daemon on {daemon.path}, {len(daemon.pool.lanes)} lane(s). Ctrl-C to stop.")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+        print(f"stopped after {daemon.served} charge(s)")
+
+#function to send one charge and print the decision (same output as edge_pos_loop)
+def charge(args):
+    with PosClient(args.socket) as client:
+        try:
+            result = client.charge(args.amount_cents, args.zip, args.merchant, args.lane)
+        except RuntimeError as e:
+            print("Error:", e)
+            sys.exit(2)
+    if result["card_id"] is None:
+        print("No card detected.")
+        sys.exit(1)
+    print("EDGE CHECK:", "FLAGGED" if result["flag"] else "OK", result["reasons"])
+    print("Append:", result["ok"], result["msg"])
+    print("Tap:", result["tap"])
+
+#function to send a ping or stats request and print the reply
+def query(args):
+    with PosClient(args.socket) as client:
+        print(json.dumps(client.request({"op": args.cmd}), indent=2))
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="POS daemon (serve) and its till client (charge/ping/stats)")
+    p.add_argument("--socket", default=None, help=f"socket path (default ${SOCKET_ENV} or {DEFAULT_SOCKET})")
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    s_serve = sub.add_parser("serve")
+    #comma separated reader names, as reader_pool (default $EDGE_READERS)
+    s_serve.add_argument("--readers", default=None)
+    s_serve.add_argument("--merchant", type=int, default=MERCHANT_ID)
+    s_serve.add_argument("--budget-ms", type=int, default=TAP_BUDGET_MS)
+    s_serve.add_argument("--zip-csv", default=ZIP_CSV_PATH)
+    #keep the rule state across restarts
+    s_serve.add_argument("--snapshot", default=None)
+    s_serve.add_argument("--snapshot-every", type=float, default=60.0)
+    s_serve.set_defaults(func=serve)
+
+    s_charge = sub.add_parser("charge")
+    s_charge.add_argument("amount_cents", type=int)
+    s_charge.add_argument("--merchant", type=int, default=None)
+    s_charge.add_argument("--zip")
+    s_charge.add_argument("--lane", type=int, default=0)
+    s_charge.set_defaults(func=charge)
+
+    for name in ("ping", "stats"):
+        sub.add_parser(name).set_defaults(func=query)
+
+    args = p.parse_args()
+    args.func(args)
@@ -1,16 +1,24 @@
 #import libraries and classes
-import time, argparse, csv, json, os, statistics, sys, time, datetime, psutil, random
+import time, argparse, csv, json, os, statistics, sys, time, datetime, psutil, random, threading
 from collections import Counter
+from array import array
 
 from edge.edge_rules import EdgeRules
+#edge_rules puts src on the path so the offline detectors can be imported too
+from baseline_detector import (
+    RuleCombiner, MerchantBaseline, CardBaseline, AmountCap, CardEWMA, ImpossibleTravel, MerchantWindow, StatePolicy
+)
 
 #set path to log Tx records
 LOG_PATH = "data/runs/pos_log.csv"
+#zip code table used by the rules
+ZIP_CSV_PATH = "data/raw/zip_lat_long.csv"
+#src directory (for imports in child processes)
+SRC_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), ".."))
 
-#function to measure CPU time to evaluate a transaction
-def latency(args):
-    #instantiate rules object
-    rules = EdgeRules(zip_csv_path="data/raw/zip_lat_long.csv")
+#function to time rules.evaluate for a number of iterations
+#returns the sorted per-call samples (micro seconds) and the total loop time (ms)
+def time_evaluate(rules, iters):
     #warm up states for EWMA
     for _ in range(10): 
         #generate random transaction value from €1 - €40
@@ -22,8 +30,6 @@ def latency(args):
         }
         rules.evaluate(tx)
 
-    #number of iterations to run, passed in command line
-    iters = int(args.iters)
     #empty list to keep smaples
     samples = []
     #start time
@@ -41,31 +47,79 @@ def latency(args):
 
     #sort samples
     samples.sort()
-    #finction to get time value at a gvien percentile
-    def q(p):
-        #get index for p in samples
-        p_index = int(p/100*len(samples))-1
-        #round the value and return
-        r = round(samples[p_index], 2)
-        return r
-
-    #print iteration counter, total time, mean time, and 50th, 95th, and 99th percentiles    
-    print(f"Iterations: {iters}  total: {t_total:.2f} ms  mean: {statistics.mean(samples):.2f} micro_s")
-    print(f"P50: {q(50)} micro_s   P95: {q(95)} micro_s   P99: {q(99)} micro_s")
-
-#function to show that all flags are explainable and are given with a reason
-def explainability(args):
+    return samples, t_total
+
+#function to measure CPU time to evaluate a transaction
+#runs the original pandas window buckets (before) and the int epoch buckets (after)
+def latency(args):
+    #number of iterations to run, passed in command line
+    iters = int(args.iters)
+    for label, epoch in (("pandas windows", False), ("epoch windows", True)):
+        #instantiate rules object
+        rules = EdgeRules(zip_csv_path="data/raw/zip_lat_long.csv", epoch_windows=epoch)
+        samples, t_total = time_evaluate(rules, iters)
+
+        #finction to get time value at a gvien percentile
+        def q(p):
+            #get index for p in samples
+            p_index = int(p/100*len(samples))-1
+            #round the value and return
+            r = round(samples[p_index], 2)
+            return r
+
+        #print iteration counter, total time, mean time, and 50th, 95th, and 99th percentiles    
+        print(f"[{label}]")
+        print(f"Iterations: {iters}  total: {t_total:.2f} ms  mean: {statistics.mean(samples):.2f} micro_s")
+        print(f"P50: {q(50)} micro_s   P95: {q(95)} micro_s   P99: {q(99)} micro_s")
+
+#function to parse a --start/--end time: epoch seconds or an ISO date/time in local time (as the log's ts_iso)
+def parse_time(value):
+    if value is None:
+        return None
+    if value.isdigit():
+        return int(value)
+    return int(datetime.datetime.fromisoformat(value).timestamp())
+
+#function to print the explainability numbers (counts is reason -> count)
+#speeds is the median/max km/h of the flagged impossible travel reasons (see pos_binlog.reason_counts), if any
+def print_explainability(total, flagged, with_reasons, counts, speeds=None):
+    #print total tx and flagged
+    print(f"Total tx: {total}  flagged: {flagged}")
+    #calculate and print number of rows with flags
+    if flagged:
+        pct = 100.0 * with_reasons / flagged
+        print(f"Explainable flags (flags with ≥1 reason): {pct:.1f}%")
+        print("Top reasons:")
+        #show the most common reasons
+        for reason, cnt in Counter(counts).most_common(5):
+            print(f"  {reason} --- {cnt}")
+        if speeds:
+            print(f"  impossible travel speed: median {speeds['median_kmh']:.0f} km/h  max {speeds['max_kmh']} km/h")
+    else:
+        print("No flagged transactions yet. Run the walkthrough first.")
+
+#function to read the explainability numbers from a CSV log (rows with start <= ts < end if given)
+#reasons are counted by name as in the binary log (impossible_travel_812kmh -> impossible_travel, once per row),
+#the travel speeds are kept apart
+#returns (total, flagged, with_reasons, Counter of reasons, speeds as print_explainability)
+def explain_csv(path, start=None, end=None):
+    from edge import pos_binlog
     #create variable for total logged transactions, flagged rows, and flags woth reason
     total = 0
     flagged = 0 
     with_reasons = 0
     #counter object
     counts = Counter()
+    speeds = []
     #open log file
-    with open(LOG_PATH) as f:
+    with open(path) as f:
         r = csv.DictReader(f)
         #loop through each transaction in log
         for row in r:
+            if start is not None or end is not None:
+                ts = datetime.datetime.fromisoformat(row["ts_iso"]).timestamp()
+                if (start is not None and ts < start) or (end is not None and ts >= end):
+                    continue
             #add to total count
             total += 1
             #check for a flag and for reasons and add to counts
@@ -74,19 +128,40 @@ def explainability(args):
                 #separate multiple reasons
                 reasons = [s for s in row["reasons"].split("|") if s]
                 if reasons: with_reasons += 1
-                counts.update(reasons)
-    #print total tx and flagged
-    print(f"Total tx: {total}  flagged: {flagged}")
-    #calculate and print number of rows with flags
-    if flagged:
-        pct = 100.0 * with_reasons / flagged
-        print(f"Explainable flags (flags with ≥1 reason): {pct:.1f}%")
-        print("Top reasons:")
-        #show the most common reasons
-        for reason, cnt in counts.most_common(5):
+                names = list(dict.fromkeys(pos_binlog.reason_name(s) for s in reasons))
+                counts.update(names)
+                if "impossible_travel" in names:
+                    speeds.append(pos_binlog.reason_mask(reasons)[1])
+    speeds = {"median_kmh": float(statistics.median(speeds)), "max_kmh": max(speeds)} if speeds else {}
+    return total, flagged, with_reasons, counts, speeds
+
+#function to report on the POS log: explainable flags and top reasons, optionally the flag rate per day and the
+#count of every reason, for rows in a time range
+#a binary log (pos_binlog) is memory mapped and counted a column at a time, a CSV log is parsed row by row
+def explainability(args):
+    from edge import pos_binlog
+    path = args.log
+    start, end = parse_time(args.start), parse_time(args.end)
+    if not pos_binlog.is_binlog(path):
+        if args.flag_rate or args.reasons:
+            print("--flag-rate/--reasons need a binary log, convert it with: python -m edge.pos_binlog", path)
+        print_explainability(*explain_csv(path, start, end))
+        return
+    log = pos_binlog.time_range(pos_binlog.open_binlog(path), start, end)
+    ex = pos_binlog.explain(log)
+    print_explainability(ex["total"], ex["flagged"], ex["with_reasons"], ex["counts"], ex["speeds"])
+    if args.flag_rate:
+        print("Flag rate per day (UTC):")
+        for day, rows, flagged in pos_binlog.flag_rate(log):
+            d = datetime.datetime.fromtimestamp(day, datetime.timezone.utc).date()
+            print(f"  {d}  {rows:>9} tx  {flagged:>8} flagged  {100.0 * flagged / rows:5.2f}%")
+    if args.reasons:
+        counts, speeds = pos_binlog.reason_counts(log)
+        print("Reasons on all rows:")
+        for reason, cnt in sorted(counts.items(), key=lambda kv: -kv[1]):
             print(f"  {reason} --- {cnt}")
-    else:
-        print("No flagged transactions yet. Run the walkthrough first.")
+        if speeds:
+            print(f"  impossible travel speed: median {speeds['median_kmh']:.0f} km/h  max {speeds['max_kmh']} km/h")
 
 #function to determine resources used (RSS) when evaluating a transaction.
 def resource(args):
@@ -120,6 +195,904 @@ def resource(args):
     #print result
     print(f"Process RSS: {rss_mb:.2f} MiB")
 
+#function to show per detector state size under a bounded state policy with many distinct cards
+def state(args):
+    rules = EdgeRules(state_max_entries=args.max_entries, state_ttl_s=args.ttl)
+    n = int(args.iters)
+    t0 = int(time.time())
+    rss0 = psutil.Process(os.getpid()).memory_info().rss / (1024*1024)
+    t1 = time.perf_counter()
+    #every tx from a new card, one tx a second, spread over 200 merchants
+    for i in range(n):
+        rules.evaluate({"timestamp": t0 + i, "merchant_id": i % 200, "card_id": f"card{i}", "amount": 10.0})
+    t2 = time.perf_counter()
+    rss1 = psutil.Process(os.getpid()).memory_info().rss / (1024*1024)
+    print(f"{n} tx from {n} cards  max_entries={args.max_entries}  ttl={args.ttl}")
+    print(f"CPU time per update: {(t2 - t1) / n * 1e6:.2f} micro_s   RSS growth: {rss1 - rss0:.2f} MiB")
+    for name, st in rules.state_stats().items():
+        print(f"  {name:<16} live={st['live']:>8}  evictions={st['evictions']:>8}")
+
+    #cost of the policy on returning cards: CardEWMA.update for 1,000 cards at 20 tx/s, unbounded vs this policy
+    #(with a ttl a card's touch time and LRU place are only refreshed once per ttl step, see BoundedState._used)
+    rng = random.Random(0)
+    cards = [f"card{rng.randrange(1000)}" for _ in range(n)]
+    for label, policy in (("unbounded", StatePolicy()), ("this policy", StatePolicy(args.max_entries, args.ttl))):
+        ewma = CardEWMA(policy=policy)
+        t1 = time.perf_counter()
+        for i, card in enumerate(cards):
+            ewma.update(card, 10.0 + i % 7, t0 + i // 20)
+        print(f"  CardEWMA.update on returning cards, {label:<11}: {(time.perf_counter() - t1) / n * 1e6:.2f} micro_s")
+
+#function to show how window update cost and state grow with the number of distinct keys
+#synthetic stream at a fixed tx rate where keys are drawn from a growing population (most keys go idle)
+#live state stays bounded by the expiry queue, but the cost per update is not flat: it follows how many updates
+#open a new bucket (a new dict/set, filed for expiry and expired later, and more live containers for the gc)
+def cardinality(args):
+    import numpy as np
+    n = int(args.iters)
+    print(f"{n} updates per run, {args.rate} tx/s")
+    base = None
+    for n_keys in (1_000, 10_000, 100_000, 1_000_000):
+        rng = np.random.default_rng(0)
+        keys = rng.integers(0, n_keys, n).tolist()
+        items = rng.integers(0, 10_000, n).tolist()
+        ts = (1_700_000_000 + np.arange(n) // int(args.rate)).tolist()
+        win = MerchantWindow(int_epoch=True)
+        t0 = time.perf_counter()
+        for k, t, c in zip(keys, ts, items):
+            win.update(k, t, c)
+        dt = time.perf_counter() - t0
+        st = win.stats()
+        #every bucket ever opened is either still live or has been expired through the queue
+        opened = st["buckets"] + win.expiry.expired
+        per = dt / n * 1e6
+        base = base or per
+        print(f"  keys={n_keys:>9,}  {per:6.2f} micro_s/update (x{per / base:.1f})  new buckets/update={opened / n:.2f}  "
+              f"live keys={st['live']:>7,}  live buckets={st['buckets']:>7,}")
+
+#function to compare the tumbling bucket and exact sliding window modes of the merchant rule
+#background traffic plus bursts of 6 cards that straddle a 30s bucket boundary
+def sliding(args):
+    import numpy as np
+    n = int(args.iters)
+    rng = np.random.default_rng(1)
+    ts = (1_700_000_000 + np.arange(n) // 20).tolist()
+    merchants = rng.integers(100, 5100, n).tolist()
+    cards = rng.integers(0, 1_000_000, n).tolist()
+    #bursts at merchants 0..99, 3 cards in the last 5s of a bucket and 3 in the first 5s of the next
+    bursts = {}
+    for b in range(int(args.bursts)):
+        i = int(rng.integers(1000, n - 1000))
+        edge = (ts[i] // 30 + 1) * 30
+        for j in range(6):
+            k = i + j * 20
+            ts_k = edge - 5 + j * 2 if j < 3 else edge + (j - 3) * 2
+            merchants[k], cards[k] = b % 100, 2_000_000 + b * 10 + j
+            ts[k] = ts_k
+            bursts[k] = b
+    #keep the stream time ordered after the overwrites
+    order = sorted(range(n), key=lambda k: ts[k])
+
+    for mode in ("tumbling", "sliding"):
+        mb = MerchantBaseline(threshold=6, int_epoch=True, window_mode=mode)
+        caught = set()
+        other = 0
+        t0 = time.perf_counter()
+        for k in order:
+            f, _ = mb.update(merchants[k], ts[k], cards[k])
+            if f:
+                if k in bursts:
+                    caught.add(bursts[k])
+                else:
+                    other += 1
+        dt = time.perf_counter() - t0
+        print(f"[{mode}] {dt / n * 1e6:.2f} micro_s/update  straddling bursts caught: {len(caught)}/{int(args.bursts)}  "
+              f"other flags: {other}  state: {mb.win.stats()}")
+
+#function to compare exact sets and HLL sketches for a very busy merchant (thousands of cards per window)
+def hll(args):
+    import tracemalloc
+    n_cards = int(args.cards)
+    for distinct in ("exact", "hll"):
+        mb = MerchantBaseline(threshold=6, int_epoch=True, distinct=distinct, hll_error=args.error)
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        #10 busy windows in a row, every card distinct
+        for w in range(10):
+            for c in range(n_cards):
+                f, info = mb.update(1, 1_700_000_010 + w * 30, f"card{w}-{c}")
+        dt = time.perf_counter() - t0
+        mem = tracemalloc.get_traced_memory()[0] / (1024*1024)
+        tracemalloc.stop()
+        err = 100.0 * (info["unique_cards"] - n_cards) / n_cards
+        print(f"[{distinct}] {dt / (10 * n_cards) * 1e6:.2f} micro_s/update  window state {mem:.2f} MiB  "
+              f"last count {info['unique_cards']} (true {n_cards}, {err:+.2f}%)")
+
+#function to build a synthetic transaction stream (sorted by time) with some bursts and travel in it
+def synthetic_frame(n, n_cards, n_merchants, seed=0):
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    #0-1 seconds between transactions
+    ts = 1_700_000_000 + np.cumsum(rng.integers(0, 2, n))
+    cards = rng.integers(0, n_cards, n)
+    merchants = rng.integers(0, n_merchants, n)
+    #a few very busy merchants so the merchant window fires
+    busy = rng.random(n) < 0.15
+    merchants[busy] = rng.integers(0, 3, busy.sum())
+    #a few cards on a spree so the card window fires
+    spree = rng.random(n) < 0.03
+    cards[spree] = rng.integers(0, 20, spree.sum())
+    #log normal amounts with the odd large spike
+    amounts = np.round(np.exp(rng.normal(3.0, 0.6, n)), 2)
+    spike = rng.random(n) < 0.002
+    amounts[spike] *= 60
+    #coords from each card's home city, with the odd tap somewhere else and some missing
+    cities = np.array([(40.76, -73.99), (34.02, -118.49), (41.88, -87.63), (29.76, -95.37), (40.71, -74.0)])
+    pick = cards % len(cities)
+    away = rng.random(n) < 0.01
+    pick[away] = rng.integers(0, len(cities), away.sum())
+    lat = cities[pick, 0].astype(object)
+    lon = cities[pick, 1].astype(object)
+    missing = rng.random(n) < 0.1
+    lat[missing] = None
+    lon[missing] = None
+    return pd.DataFrame({
+        "timestamp": pd.to_datetime(ts, unit="s"),
+        "merchant_id": merchants,
+        "card_id": [f"c{c}" for c in cards],
+        "amount": amounts,
+        "lat": lat,
+        "lon": lon,
+    })
+
+#function to build a rule combiner with the same parameters as the edge rules
+def edge_combiner():
+    return RuleCombiner(
+        MerchantBaseline(threshold=6, int_epoch=True),
+        CardBaseline(threshold=3, int_epoch=True),
+        AmountCap(cap=1750),
+        CardEWMA(alpha=0.2, k=5, initial=10, min_gate=100),
+        ImpossibleTravel(vmax_kmh=600.0, min_km=150.0, min_dt_s=60.0),
+    )
+
+#function to check RuleCombiner.evaluate_frame matches the streaming update() path row for row and time both
+def batch(args):
+    df = synthetic_frame(int(args.rows), int(args.cards), int(args.merchants))
+    print(f"Rows: {len(df)}  cards: {df['card_id'].nunique()}  merchants: {df['merchant_id'].nunique()}")
+
+    #streaming path, one row at a time
+    comb = edge_combiner()
+    t0 = time.perf_counter()
+    rows = [comb.rule_flags(tx) for tx in df.to_dict("records")]
+    t_stream = time.perf_counter() - t0
+
+    #batch path
+    t0 = time.perf_counter()
+    out = edge_combiner().evaluate_frame(df)
+    t_batch = time.perf_counter() - t0
+
+    #compare every rule column and the combined flag
+    mismatches = 0
+    for rule in rows[0]:
+        stream = [r[rule] for r in rows]
+        bad = int((out[rule].to_numpy() != stream).sum())
+        mismatches += bad
+        print(f"  {rule:<18} flagged={sum(stream):>7}  mismatches={bad}")
+    bad = int((out["flag"].to_numpy() != [any(r.values()) for r in rows]).sum())
+    mismatches += bad
+    print(f"  {'flag':<18} flagged={int(out['flag'].sum()):>7}  mismatches={bad}")
+
+    print(f"Streaming: {t_stream:.2f} s ({len(df)/t_stream:,.0f} rows/s)")
+    print(f"Batch:     {t_batch:.2f} s ({len(df)/t_batch:,.0f} rows/s)  speedup x{t_stream/t_batch:.1f}")
+    print("PARITY OK" if mismatches == 0 else f"PARITY FAILED ({mismatches} mismatches)")
+    if mismatches:
+        sys.exit(1)
+
+#code run in a fresh interpreter to time a startup step and measure the process RSS after it
+STARTUP_SNIPPET = """
+import os, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {src!r})
+{body}
+t1 = time.perf_counter()
+import psutil
+print((t1 - t0) * 1e3, psutil.Process(os.getpid()).memory_info().rss / (1024*1024), int("pandas" in sys.modules))
+"""
+
+#function to run a startup snippet in a few fresh processes
+#returns median (ms, MiB) and whether pandas got imported
+def run_startup(body, runs):
+    import subprocess
+    ms, mb = [], []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", STARTUP_SNIPPET.format(src=SRC_DIR, body=body)],
+                             capture_output=True, text=True, check=True).stdout.split()
+        ms.append(float(out[0]))
+        mb.append(float(out[1]))
+        pandas = out[2] == "1"
+    return statistics.median(ms), statistics.median(mb), pandas
+
+#one tap through EdgeRules after it is built (cold start ends with the first decision)
+FIRST_TAP = ("\nr.evaluate({'timestamp': 1700000000, 'merchant_id': 1, 'card_id': 'c', 'amount': 9.99, "
+             "'zip': '10036'})")
+
+#function to compare startup time and RSS of loading the zip table from CSV vs the binary index,
+#and of the edge runtime (EdgeRules + first tap) with and without pandas loaded
+def startup(args):
+    from zip_index import index_path_for
+    csv_path = args.zip_csv
+    idx_path = index_path_for(csv_path)
+    runs = int(args.runs)
+
+    #(label, code to time)
+    cases = [
+        ("interpreter only", "pass"),
+        ("zip CSV (csv + dict)",
+         f"from baseline_detector import ZipToCoord\nz = ZipToCoord({csv_path!r}, use_index=False)\nz.get('10036')"),
+        ("zip CSV (pandas + dict, old)",
+         f"import pandas as pd\ndf = pd.read_csv({csv_path!r}, dtype={{'ZIP': str}}, low_memory=False)\n"
+         f"z = dict(zip(df['ZIP'], zip(df['LAT'], df['LNG'])))"),
+    ]
+    if idx_path:
+        cases += [
+            ("zip index (mmap, stdlib only)",
+             f"from zip_index import ZipIndex\nz = ZipIndex({idx_path!r})\nz.get('10036')"),
+            ("EdgeRules with zip index",
+             f"from edge.edge_rules import EdgeRules\nr = EdgeRules(zip_csv_path={csv_path!r})"),
+        ]
+    else:
+        print(f"No built index for {csv_path}, run: python src/zip_index.py {csv_path}")
+    cases.append(("EdgeRules with zip CSV",
+                  f"import baseline_detector\nbaseline_detector.index_path_for = lambda s: None\n"
+                  f"from edge.edge_rules import EdgeRules\nr = EdgeRules(zip_csv_path={csv_path!r})"))
+    #the edge runtime with int epoch seconds only (no pandas) vs with pandas loaded as the edge path used to
+    edge = f"from edge.edge_rules import EdgeRules\nr = EdgeRules(zip_csv_path={csv_path!r})" + FIRST_TAP
+    cases += [
+        ("EdgeRules + first tap", edge),
+        ("EdgeRules + first tap, pandas", "import pandas\n" + edge),
+        ("EdgeRules + first tap, pd path",
+         f"from edge.edge_rules import EdgeRules\nr = EdgeRules(zip_csv_path={csv_path!r}, epoch_windows=False)"
+         + FIRST_TAP),
+    ]
+
+    print(f"Median of {runs} fresh processes:")
+    for label, body in cases:
+        t_ms, rss_mb, pandas = run_startup(body, runs)
+        print(f"  {label:<32} {t_ms:8.1f} ms   RSS {rss_mb:7.2f} MiB   pandas {'loaded' if pandas else 'not loaded'}")
+
+#function to build n synthetic POS transactions over n_cards cards (lat/lon given directly, no zip table needed)
+def synthetic_txs(n, n_cards, n_merchants, start=1_700_000_000, seed=0):
+    rng = random.Random(seed)
+    t = start
+    txs = []
+    for _ in range(n):
+        t += rng.randint(0, 2)
+        txs.append({"timestamp": t, "merchant_id": rng.randrange(n_merchants), "card_id": f"c{rng.randrange(n_cards)}",
+                    "amount": rng.randint(100, 20000) / 100.0,
+                    "lat": 40.0 + rng.random() * 5, "lon": -80.0 + rng.random() * 5})
+    return txs
+
+#function to get every detector's state in a form two EdgeRules can be compared with ==
+#(bucket sets are exported as lists in set order, which can differ between two equal sets)
+def comparable_state(rules):
+    def norm(v):
+        if isinstance(v, tuple) and len(v) == 2 and v[0] == "set":
+            return ("set", frozenset(v[1]))
+        #compare arrays by their bytes (NaN for an unknown location never equals itself)
+        if isinstance(v, array):
+            return (v.typecode, v.tobytes())
+        if isinstance(v, (list, tuple)):
+            return type(v)(norm(x) for x in v)
+        if isinstance(v, dict):
+            return {k: norm(x) for k, x in v.items()}
+        return v
+    with rules._lock:
+        return norm(rules._export_sections())
+
+#function to measure snapshot size / lock hold / restore time for a large state and check crash recovery
+def snapshot(args):
+    import tempfile
+    n_cards = int(args.cards)
+    txs = synthetic_txs(n_cards * 2, n_cards, int(args.merchants))
+    rules = EdgeRules(window_mode=args.window_mode)
+    for tx in txs:
+        rules.evaluate(tx)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "rules.snap")
+        rules.snapshot(path)
+        st = rules.last_snapshot_stats
+        print(f"{n_cards:,} cards: snapshot {st['bytes'] / (1024*1024):.2f} MiB  copy {st['copy_ms']:.1f} ms  "
+              f"columns {st['export_ms']:.1f} ms  encode+write {st['write_ms']:.1f} ms")
+        print("  stage lock held (ms): " + "  ".join(f"{k} {v:.1f}" for k, v in st["stage_ms"].items()))
+
+        fresh = EdgeRules(window_mode=args.window_mode)
+        t0 = time.perf_counter()
+        fresh.restore(path)
+        t_restore = (time.perf_counter() - t0) * 1e3
+        same = comparable_state(fresh) == comparable_state(rules)
+        print(f"restore {t_restore:.1f} ms (every stage locked)  state identical: {same}")
+
+        #what a tap sees: evaluate latency on another thread, without and then during a snapshot
+        #(includes waiting for the GIL while the snapshot thread builds columns and writes, and gc pauses)
+        more = synthetic_txs(20_000, n_cards, int(args.merchants), start=txs[-1]["timestamp"], seed=2)
+        for label, snap in (("no snapshot", False), ("during snapshot", True)):
+            stop = threading.Event()
+            lat = []
+
+            def tap():
+                for tx in more:
+                    if stop.is_set():
+                        break
+                    t0 = time.perf_counter()
+                    rules.evaluate(tx)
+                    lat.append((time.perf_counter() - t0) * 1e3)
+
+            th = threading.Thread(target=tap)
+            th.start()
+            time.sleep(0.05)
+            if snap:
+                rules.snapshot(path)
+            else:
+                time.sleep((st["copy_ms"] + st["export_ms"] + st["write_ms"]) / 1000)
+            stop.set()
+            th.join()
+            lat.sort()
+            print(f"  {label}: evaluate p99 {lat[int(len(lat) * 0.99)]:.2f} ms  slowest {lat[-1]:.1f} ms "
+                  f"over {len(lat):,} taps")
+
+        #crash test: journal on, some traffic, then the process "dies" without a final snapshot
+        crash_path = os.path.join(tmp, "crash.snap")
+        more = synthetic_txs(int(args.after) * 2, n_cards, int(args.merchants), start=txs[-1]["timestamp"], seed=1)
+        live = EdgeRules(window_mode=args.window_mode)
+        for tx in txs:
+            live.evaluate(tx)
+        live.start_snapshots(crash_path, every_s=3600)
+        half = len(more) // 2
+        #a second snapshot taken while taps are running, so the restore below starts from a snapshot
+        #copied stage by stage in the middle of traffic
+        th = threading.Thread(target=lambda: [live.evaluate(tx) for tx in more[:half]])
+        th.start()
+        time.sleep(0.02)
+        live.snapshot(crash_path)
+        th.join()
+        live._snap_stop.set()
+        live._journal.f.flush()
+
+        recovered = EdgeRules(window_mode=args.window_mode)
+        t0 = time.perf_counter()
+        replayed = recovered.restore(crash_path)
+        t_recover = (time.perf_counter() - t0) * 1e3
+        same_live = comparable_state(recovered) == comparable_state(live)
+        mismatches = 0
+        for tx in more[half:]:
+            if live._evaluate(tx) != recovered.evaluate(tx):
+                mismatches += 1
+        rs = recovered.last_restore_stats
+        print(f"crash recovery: {t_recover:.1f} ms = load {rs['load_ms']:.1f} ms + replay {replayed:,} journaled tx "
+              f"{rs['replay_ms']:.1f} ms ({rs['replay_ms'] * 1000 / max(replayed, 1):.0f} us/tx)  "
+              f"state identical: {same_live}  next {len(more) - half:,} decisions mismatched: {mismatches}")
+        if not same or not same_live or mismatches:
+            print("SNAPSHOT CHECK FAILED")
+            sys.exit(1)
+        print("SNAPSHOT OK")
+
+#function to check warmup only replays new card records, by tapping one simulated card over and over
+#each tap: read the last 10 records (oldest first), warmup, evaluate a new tx, append it to the card
+def warmup(args):
+    taps = int(args.taps)
+    rng = random.Random(0)
+    t = 1_700_000_000
+    #card history written by other terminals before this one sees the card
+    card = [{"timestamp": t + i * 60, "amount_cents": rng.randint(100, 4000), "merchant_id": 2000 + i, "zip": None}
+            for i in range(10)]
+    history = len(card)
+
+    results = {}
+    for label, incremental in (("replay all (old)", False), ("incremental", True)):
+        rules = EdgeRules()
+        ring = list(card)
+        applied, t_warm = [], 0.0
+        for i in range(taps):
+            ts = ring[-1]["timestamp"] + rng.randint(0, 3)
+            if not incremental:
+                #forget what was applied, which is what warmup_from_card used to do
+                rules.marks.clear()
+            t0 = time.perf_counter()
+            applied.append(rules.warmup_from_card("c1", ring[-10:]))
+            t_warm += time.perf_counter() - t0
+            tx = {"timestamp": ts, "merchant_id": 1234, "card_id": "c1", "amount": rng.randint(100, 4000) / 100.0}
+            flag, reasons = rules.evaluate(tx)
+            ring.append({"timestamp": ts, "amount_cents": int(round(tx["amount"] * 100)), "merchant_id": 1234,
+                         "zip": None})
+        seen = rules.ewma.state["c1"][2]
+        results[label] = seen
+        print(f"[{label}] first tap applied {applied[0]}, later taps applied {sum(applied[1:])} records in total  "
+              f"warmup {t_warm / taps * 1e6:.1f} micro_s/tap  EWMA seen {seen} (true {history + taps})")
+
+    #a new terminal (fresh EdgeRules) seeing the card for the first time still gets the full history
+    fresh = EdgeRules()
+    n_fresh = fresh.warmup_from_card("c1", ring[-10:])
+    #and a second read of the same records is free
+    n_again = fresh.warmup_from_card("c1", ring[-10:])
+    print(f"fresh rules: applied {n_fresh} then {n_again} on a second read")
+    ok = results["incremental"] == history + taps and n_fresh == 10 and n_again == 0
+    print("WARMUP OK" if ok else "WARMUP CHECK FAILED")
+    if not ok:
+        sys.exit(1)
+
+#function to run the card ring buffer through the MIFARE simulator and check what comes back
+#covers v1, v2 and v3 cards, ring wrap around, random auth failures and the card leaving mid write, and compares how
+#many records each format keeps for a few, a realistic and a uniform spread of merchants
+def card(args):
+    from edge import edge_card as ec
+    from edge.card_reader import SimulatedReader, SimulatedCard, set_reader
+    from edge.reader_pool import TAP_BUDGET_MS
+    rng = random.Random(0)
+    failures = []
+
+    #function to write n random transactions on the reader's card, one card session per tap
+    #flush=False ends each tap without writing the header back (the card left before the flush)
+    def taps(reader, n, merchants, t, flush=True):
+        uid = reader.card.uid
+        written = []
+        for _ in range(n):
+            t += rng.choice([3, 20, 400, 90000])
+            rec = (t, rng.choice([1, 999, 12345, -50, 250_000_00]), rng.choice(merchants), rng.choice([0, 1]),
+                   rng.choice([None, "10036", "02134"]))
+            ok, msg = ec.write_recent_tx(uid, ec.pack_tx(*rec[:4], zip_code=rec[4]))
+            ec.end_session(flush=flush)
+            if ok:
+                written.append({"timestamp": rec[0], "amount_cents": rec[1], "merchant_id": rec[2],
+                                "zip": rec[4], "flags": rec[3]})
+        return written, t
+
+    #function to compare the newest records on the card with what was written
+    #full=False accepts fewer records than asked for (how many fit depends on the card format and the data)
+    def check(label, reader, written, want, full=True):
+        ec.end_session(flush=False)
+        meta, recent = ec.read_recent_tx(reader.card.uid, max_count=want)
+        ec.end_session(flush=False)
+        expected = list(reversed(written))[:len(recent)]
+        ok = recent == expected and (len(recent) == min(want, len(written)) or not full)
+        print(f"  {label:<48} v{meta['version']} records={len(recent):>3}  {'ok' if ok else 'MISMATCH'}")
+        if not ok:
+            failures.append(label)
+
+    no_latency = {"select": 0, "auth": 0, "read": 0, "write": 0}
+    for version in (1, 2, 3):
+        print(f"v{version} card:")
+        for merchants, label in (([1001, 1002, 1003], "few merchants"), (list(range(1, 40)), "many merchants")):
+            reader = SimulatedReader(SimulatedCard(), latency=no_latency)
+            set_reader(reader)
+            ec.reset_header(reader.card.uid, version=version)
+            written, t = taps(reader, 150, merchants, 1_700_000_000)
+            check(f"{label}, 150 taps (ring wrapped), last 10", reader, written, 10)
+            check(f"{label}, whole ring", reader, written, 100, full=False)
+
+        #flaky RF: 20% of auths fail, the retries should hide it
+        reader = SimulatedReader(SimulatedCard(), latency=no_latency, auth_fail_rate=0.2, seed=1)
+        set_reader(reader)
+        while not ec.reset_header(reader.card.uid, version=version):
+            pass
+        ec.reset_io_stats()
+        written, t = taps(reader, 30, [1001, 1002], t)
+        check(f"20% auth failures ({ec.io_stats()['retries']} retries)", reader, written[-10:], 10)
+
+        #card pulled away part way through a tap, then tapped again
+        reader = SimulatedReader(SimulatedCard(), latency=no_latency)
+        set_reader(reader)
+        ec.reset_header(reader.card.uid, version=version)
+        written, t = taps(reader, 12, [1001, 1002], t)
+        card_obj = reader.card
+        reader.remove(after=3)
+        lost, t = taps(reader, 1, [1001], t)
+        reader.present(card_obj)
+        more, t = taps(reader, 5, [1001, 1002], t)
+        check("card removed mid write, next taps", reader, more, 5)
+
+        #header never written back for 20 taps, every tap has to find the records the header missed
+        reader = SimulatedReader(SimulatedCard(), latency=no_latency)
+        set_reader(reader)
+        ec.reset_header(reader.card.uid, version=version)
+        written, t = taps(reader, 8, [1001, 1002], t)
+        more, t = taps(reader, 20, [1001, 1002], t, flush=False)
+        ec.reset_io_stats()
+        check("header not flushed for 20 taps", reader, written + more, 20)
+        st = ec.io_stats()
+        print(f"    recovery: {st['recoveries']} scan(s), {st['auths']} auths, {st['reads']} block reads")
+
+        #header wiped, everything comes from the ring
+        ec.clear_header(reader.card.uid)
+        check("header cleared", reader, written + more, 20)
+
+        #slow, flaky reader with a budget: the read has to stop in time with the newest records it got
+        #tight budgets (50% auth failures) may run out before the header is read, that is reported as "no header"
+        #(history "none"), not as ok; the tap budget with a realistic reader (10% auth failures) must get records
+        reader = SimulatedReader(SimulatedCard(), latency=no_latency, seed=2)
+        set_reader(reader)
+        ec.reset_header(reader.card.uid, version=version)
+        written, t = taps(reader, 28, [1001, 1002], t)
+        reader.latency = dict(SimulatedReader.LATENCY)
+        for budget_ms, fail_rate, reads in ((15, 0.5, 1), (40, 0.5, 1), (TAP_BUDGET_MS, 0.1, 10)):
+            reader.auth_fail_rate = fail_rate
+            outcomes = Counter()
+            worst_ms = 0.0
+            for _ in range(reads):
+                ec.end_session(flush=False)
+                deadline = ec.Deadline(budget_ms / 1000.0)
+                meta, recent = ec.read_recent_tx(reader.card.uid, max_count=20, deadline=deadline)
+                ec.end_session(flush=False)
+                rep = deadline.report()
+                worst_ms = max(worst_ms, rep["elapsed_ms"])
+                #one command (select + auth) can run past the budget, never a whole retry loop
+                if (recent != list(reversed(written))[:len(recent)] or rep["elapsed_ms"] > budget_ms + 20
+                        or (rep["history"] == "full") != (len(recent) == 20)):
+                    outcomes["MISMATCH"] += 1
+                elif meta is None:
+                    outcomes["no header"] += 1
+                elif not recent:
+                    outcomes["no records"] += 1
+                else:
+                    outcomes[rep["history"]] += 1
+            #at the tap budget every read has to give the rules the newest records
+            ok = not outcomes["MISMATCH"] and (budget_ms < TAP_BUDGET_MS
+                                               or outcomes["partial"] + outcomes["full"] == reads)
+            label = f"{budget_ms} ms budget, {fail_rate:.0%} auth failures, {reads} read(s)"
+            print(f"  {label:<48} " + "  ".join(f"{k} {v}" for k, v in sorted(outcomes.items()))
+                  + f"  slowest {worst_ms:.0f} ms  "
+                  + ("FAILED" if not ok else "ok" if budget_ms >= TAP_BUDGET_MS else "stopped in time"))
+            if not ok:
+                failures.append(f"{budget_ms} ms budget")
+
+    #records kept once the ring has wrapped, per format and merchant spread (400 taps, zip codes fixed per merchant)
+    #realistic: 30 merchants with Zipf-like tap shares, gaps from minutes to a day, amounts around $20
+    def spread(kind, n, seed=3):
+        g = random.Random(seed)
+        merchants = list(range(2000, 2030)) if kind != "uniform" else list(range(1, 41))
+        zips = {m: g.choice(["10036", "02134", "30301", "60601", "11201", None]) for m in merchants}
+        weights = [1 / (i + 1) ** 1.1 for i in range(len(merchants))]
+        t = 1_700_000_000
+        out = []
+        for _ in range(n):
+            t += 5 + int(g.expovariate(1 / g.choice([1800, 14400, 60000])))
+            if kind == "few":
+                m = g.choice(merchants[:3])
+            elif kind == "realistic":
+                m = g.choices(merchants, weights)[0]
+            else:
+                m = g.choice(merchants)
+            out.append((t, int(g.lognormvariate(7.5, 1.0)), m, 1 if g.random() < 0.05 else 0, zips[m]))
+        return out
+
+    print("records kept after 400 taps (block writes per tap):")
+    kept = {}
+    for kind in ("few", "realistic", "uniform"):
+        row = []
+        for version in (1, 2, 3):
+            reader = SimulatedReader(SimulatedCard(), latency=no_latency)
+            set_reader(reader)
+            ec.reset_header(reader.card.uid, version=version)
+            ec.reset_io_stats()
+            txs = spread(kind, 400)
+            for tx in txs:
+                ec.write_recent_tx(reader.card.uid, ec.pack_tx(*tx[:4], zip_code=tx[4]))
+                ec.end_session()
+            writes = ec.io_stats()["writes"] / len(txs)
+            ec.end_session(flush=False)
+            meta, recent = ec.read_recent_tx(reader.card.uid, max_count=200)
+            expected = [{"timestamp": t, "amount_cents": a, "merchant_id": m, "zip": z, "flags": f}
+                        for t, a, m, f, z in reversed(txs)][:len(recent)]
+            if recent != expected:
+                failures.append(f"{kind} merchants v{version}")
+            kept[kind, version] = len(recent)
+            row.append(f"v{version} {len(recent):>3} ({writes:.2f})")
+        print(f"  {kind + ' merchants':<20} " + "   ".join(row))
+    #the default format has to keep more history than v1 for a realistic spread of merchants
+    if kept["realistic", ec.CARD_VERSION] <= kept["realistic", 1]:
+        failures.append(f"v{ec.CARD_VERSION} keeps no more records than v1")
+
+    set_reader(None)
+    print("CARD OK" if not failures else f"CARD CHECK FAILED: {failures}")
+    if failures:
+        sys.exit(1)
+
+#function to check the precompiled card codecs are byte compatible with the old pack/unpack functions and time both
+def codec(args):
+    import struct
+    from edge import edge_card as ec
+    n = int(args.iters)
+
+    #the pack/unpack functions as they were before the precompiled layouts (one struct call per field)
+    def old_pack_header(version, write_index, total_count, last_timestamp, tail=0):
+        b = bytearray(16)
+        b[0:4] = b"COLM"
+        b[4] = version & 0xFF
+        b[5] = write_index & 0xFF
+        b[6:8] = struct.pack(">H", total_count & 0xFFFF)
+        b[8:12] = struct.pack(">I", last_timestamp & 0xFFFFFFFF)
+        b[12] = 0
+        b[13] = tail & 0xFF
+        b[14:16] = struct.pack(">H", ec.sum16(b[:14]))
+        return bytes(b)
+
+    def old_unpack_header(b):
+        if not b or len(b) != 16 or b[0:4] != b"COLM":
+            return None
+        if ec.sum16(b[:14]) != struct.unpack(">H", b[14:16])[0]:
+            return None
+        return {"version": b[4], "write_index": b[5], "total_count": struct.unpack(">H", b[6:8])[0],
+                "last_timestamp": struct.unpack(">I", b[8:12])[0], "tail": b[13],
+                #byte 12 was always 0 then, it is the v3 block sequence now
+                "seq": b[12]}
+
+    def old_pack_tx(timestamp, amount_cents, merchant_id, flags, zip_code=None):
+        b = bytearray(16)
+        b[0:4] = struct.pack(">I", timestamp & 0xFFFFFFFF)
+        b[4:8] = struct.pack(">i", amount_cents)
+        b[8:10] = struct.pack(">H", merchant_id & 0xFFFF)
+        zip_int = 0
+        if zip_code:
+            z = "".join(ch for ch in str(zip_code) if ch.isdigit())[:5]
+            if z:
+                zip_int = max(0, min(65535, int(z)))
+        b[10:12] = struct.pack(">H", zip_int)
+        b[12] = flags & 0xFF
+        b[13] = 0
+        b[14:16] = struct.pack(">H", ec.sum16(bytes(b[:14])))
+        return bytes(b)
+
+    def old_unpack_tx(b):
+        if not b or len(b) != 16:
+            return None
+        if ec.sum16(b[0:14]) != struct.unpack(">H", b[14:16])[0]:
+            return None
+        zip_int = struct.unpack(">H", b[10:12])[0]
+        return {"timestamp": struct.unpack(">I", b[0:4])[0], "amount_cents": struct.unpack(">i", b[4:8])[0],
+                "merchant_id": struct.unpack(">H", b[8:10])[0], "zip": str(zip_int).zfill(5) if zip_int > 0 else None,
+                "flags": b[12]}
+
+    #byte compatibility on random fields (zips as strings, ints, with dashes and junk)
+    rng = random.Random(0)
+    zips = [None, "", "10036", "02134", "10036-1234", 2134, 99999, " 9021", "abc", 0, "123456"]
+    txs = [(rng.randrange(1 << 32), rng.randrange(-(1 << 31), 1 << 31), rng.randrange(1 << 17), rng.randrange(256),
+            rng.choice(zips)) for _ in range(n)]
+    headers = [(rng.randrange(256), rng.randrange(300), rng.randrange(1 << 17), rng.randrange(1 << 33),
+                rng.randrange(256)) for _ in range(n)]
+    bad = 0
+    for t in txs:
+        raw = ec.pack_tx(*t[:4], zip_code=t[4])
+        bad += raw != old_pack_tx(*t[:4], zip_code=t[4]) or ec.unpack_tx(raw) != old_unpack_tx(raw)
+        #a corrupted block must be rejected by both
+        broken = raw[:3] + bytes([raw[3] ^ 1]) + raw[4:]
+        bad += (ec.unpack_tx(broken) is None) != (old_unpack_tx(broken) is None)
+    for h in headers:
+        raw = ec.pack_header(*h)
+        bad += raw != old_pack_header(*h) or ec.unpack_header(raw) != old_unpack_header(raw)
+    blocks = b"".join(ec.pack_tx(*t[:4], zip_code=t[4]) for t in txs[:1000])
+    bad += list(ec.unpack_tx_blocks(blocks)) != [old_unpack_tx(blocks[i:i + 16]) for i in range(0, len(blocks), 16)]
+    print(f"byte compatibility on {n:,} records and headers: {'ok' if not bad else f'{bad} MISMATCHES'}")
+
+    #timings (micro seconds per call)
+    recs = [ec.pack_tx(*t[:4], zip_code=t[4]) for t in txs]
+    hdrs = [ec.pack_header(*h) for h in headers]
+
+    def per_call(f, items):
+        t0 = time.perf_counter()
+        for x in items:
+            f(*x)
+        return (time.perf_counter() - t0) / len(items) * 1e6
+
+    rows = [
+        ("pack_tx", old_pack_tx, ec.pack_tx, [t[:4] + (t[4],) for t in txs]),
+        ("unpack_tx", old_unpack_tx, ec.unpack_tx, [(r,) for r in recs]),
+        ("pack_header", old_pack_header, ec.pack_header, headers),
+        ("unpack_header", old_unpack_header, ec.unpack_header, [(h,) for h in hdrs]),
+    ]
+    for name, old, new, items in rows:
+        t_old, t_new = per_call(old, items), per_call(new, items)
+        print(f"  {name:<14} old {t_old:6.2f} micro_s  new {t_new:6.2f} micro_s  ({t_old / t_new:.1f}x)")
+    #ten records out of one buffer, as a history read
+    t0 = time.perf_counter()
+    for i in range(0, 1000, 10):
+        [old_unpack_tx(blocks[j:j + 16]) for j in range(i * 16, (i + 10) * 16, 16)]
+    t_old = (time.perf_counter() - t0) / 100 * 1e6
+    t0 = time.perf_counter()
+    for i in range(0, 1000, 10):
+        list(ec.unpack_tx_blocks(memoryview(blocks)[i * 16:(i + 10) * 16]))
+    t_new = (time.perf_counter() - t0) / 100 * 1e6
+    print(f"  {'10 records':<14} old {t_old:6.2f} micro_s  new {t_new:6.2f} micro_s  ({t_old / t_new:.1f}x)")
+    if bad:
+        print("CODEC CHECK FAILED")
+        sys.exit(1)
+    print("CODEC OK")
+
+#function to compare the tap path cost of logging a row: open/append/close per row (the old log_row) vs queueing
+#it for the TxLog writer thread (with and without fsync), then check the files hold the same rows and that
+#rotation keeps every row
+def txlog(args):
+    import shutil
+    import tempfile
+    from edge.tx_log import TxLog
+    n = int(args.rows)
+    tmp = tempfile.mkdtemp()
+
+    #log_row as it was: makedirs + exists + open + write + close on every row, in the tap
+    def old_log_row(path, tx, edge_flag, reasons):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        exists = os.path.exists(path)
+        with open(path, "a", newline="") as f:
+            w = csv.writer(f)
+            if not exists:
+                w.writerow(["ts_iso","uid","amount_cents","merchant_id","flag","reasons"])
+            w.writerow([datetime.datetime.fromtimestamp(tx["timestamp"]).isoformat(timespec="seconds"),
+                        tx["card_id"], tx["amount_cents"], tx["merchant_id"], int(edge_flag), "|".join(reasons)])
+
+    rng = random.Random(0)
+    rows = [({"timestamp": 1_700_000_000 + i, "card_id": f"{rng.getrandbits(32):08x}",
+              "amount_cents": rng.randint(100, 400000), "merchant_id": rng.randrange(5000)},
+             rng.random() < 0.1, rng.choice([[], [], ["card_ewma"], ["merchant_window", "amount_cap"]]))
+            for i in range(n)]
+
+    def report(label, per_row, total_s, extra=""):
+        per_row.sort()
+        print(f"  {label:<24} per row: mean={statistics.mean(per_row):7.2f} micro_s  P99={per_row[int(0.99 * len(per_row)) - 1]:7.2f}  "
+              f"max={per_row[-1]:8.1f}  total {total_s * 1e3:7.1f} ms{extra}")
+
+    #time append(tx, flag, reasons) for every row, gap_s apart (taps come a few ms apart at the most)
+    def timed(append, gap_s):
+        per_row = []
+        t0 = time.perf_counter()
+        for tx, flag, reasons in rows:
+            t = time.perf_counter()
+            append(tx, flag, reasons)
+            per_row.append((time.perf_counter() - t) * 1e6)
+            if gap_s:
+                time.sleep(gap_s)
+        return per_row, time.perf_counter() - t0
+
+    gap_s = args.gap_ms / 1000.0
+    print(f"{n} rows, {args.gap_ms:g} ms apart, log in {tmp}")
+    old_path = os.path.join(tmp, "old", "pos_log.csv")
+    per_row, total_s = timed(lambda tx, flag, reasons: old_log_row(old_path, tx, flag, reasons), gap_s)
+    report("open/append/close", per_row, total_s)
+    with open(old_path) as f:
+        expected = f.read()
+
+    ok = True
+    for label, kw in (("TxLog", {}), ("TxLog fsync", {"fsync": True})):
+        path = os.path.join(tmp, label.replace(" ", "_"), "pos_log.csv")
+        log = TxLog(path, **kw)
+        t0 = time.perf_counter()
+        per_row, t_append = timed(log.append, gap_s)
+        log.close()
+        st = log.stats
+        report(label + " (append)", per_row, t_append,
+               f"  then {(time.perf_counter() - t0 - t_append) * 1e3:.1f} ms to drain; {st['commits']} commits, "
+               f"{st['fsyncs']} fsyncs, max batch {st['max_batch']}")
+        with open(path) as f:
+            same = f.read() == expected
+        ok &= same and st["rows"] == n
+        print(f"    same file as open/append/close: {same}")
+
+    #rotation by size: every row is kept across the rotated files, each with its header
+    path = os.path.join(tmp, "rotate", "pos_log.csv")
+    keep = n
+    with TxLog(path, rotate_bytes=64 * 1024, keep=keep) as log:
+        for tx, flag, reasons in rows:
+            log.append(tx, flag, reasons)
+            #small commits so the rotation point is hit often
+            if rng.random() < 0.01:
+                log.flush()
+    files = [path] + [f"{path}.{i}" for i in range(1, keep + 1) if os.path.exists(f"{path}.{i}")]
+    lines = []
+    for fp in reversed(files):
+        with open(fp) as f:
+            header, *body = f.read().splitlines()
+        lines += body
+    rotated = "\n".join(lines) == "\n".join(expected.splitlines()[1:])
+    ok &= rotated
+    print(f"  rotation at 64 KiB: {len(files)} files, {log.stats['rotations']} rotations, every row kept in order: "
+          f"{rotated}")
+
+    #a row that can't be formatted is skipped, the rest of its group commit is still written
+    path = os.path.join(tmp, "bad", "pos_log.csv")
+    with TxLog(path) as log:
+        for i, (tx, flag, reasons) in enumerate(rows[:100]):
+            log.append(dict(tx, timestamp=10**20) if i == 50 else tx, flag, reasons)
+    with open(path) as f:
+        kept = f.read().splitlines()[1:] == [line for i, line in enumerate(expected.splitlines()[1:101]) if i != 50]
+    kept &= log.stats["bad_rows"] == 1 and log.stats["rows"] == 99 and log.error is None
+    ok &= kept
+    print(f"  one bad row in 100: skipped ({log.stats['bad_rows']}), other 99 kept: {kept}")
+    shutil.rmtree(tmp)
+    print("TXLOG OK" if ok else "TXLOG FAILED")
+    if not ok:
+        sys.exit(1)
+
+#function to benchmark the explainability report on a large synthetic log, CSV (parsed row by row) vs binary
+#(memory mapped, vectorised), on the whole log and on its last 7 days, and check the converter and both reports agree
+def binlog(args):
+    import shutil
+    import tempfile
+    import numpy as np
+    from edge import pos_binlog
+    n = int(args.rows)
+    tmp = tempfile.mkdtemp(dir=args.dir)
+    bin_path = os.path.join(tmp, "pos_log.posb")
+    csv_path = os.path.join(tmp, "pos_log.csv")
+
+    #synthetic traffic: 180 days, ~5% flagged with 1-2 reasons, some impossible travel
+    rng = np.random.default_rng(0)
+    log = np.zeros(n, dtype=np.dtype(pos_binlog.DTYPE_FIELDS))
+    log["ts"] = 1_700_000_000 + np.sort(rng.integers(0, 180 * 86400, n))
+    log["amount_cents"] = rng.integers(100, 400000, n)
+    log["merchant_id"] = rng.integers(0, 5000, n)
+    log["uid"] = rng.integers(1, 1 << 32, n, dtype=np.uint64)
+    log["uid_len"] = 8
+    flagged = rng.random(n) < 0.05
+    log["flag"] = flagged
+    bits = np.array([1 << b for b in pos_binlog.REASON_BITS.values()], dtype=np.uint16)
+    masks = bits[rng.integers(0, len(bits), n)] | np.where(rng.random(n) < 0.3, bits[rng.integers(0, len(bits), n)], 0)
+    log["reasons"] = np.where(flagged, masks, 0)
+    travel = (log["reasons"] & (1 << pos_binlog.REASON_BITS["impossible_travel"])) != 0
+    log["travel_kmh"] = np.where(travel, rng.integers(601, 5000, n), 0)
+    with open(bin_path, "wb") as f:
+        f.write(pos_binlog.file_header())
+        log.tofile(f)
+
+    #the same rows as log_row writes them
+    t0 = time.perf_counter()
+    with open(csv_path, "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["ts_iso", "uid", "amount_cents", "merchant_id", "flag", "reasons"])
+        for ts, uid, amount, merchant, flag, mask, kmh in zip(
+                log["ts"].tolist(), log["uid"].tolist(), log["amount_cents"].tolist(), log["merchant_id"].tolist(),
+                log["flag"].tolist(), log["reasons"].tolist(), log["travel_kmh"].tolist()):
+            w.writerow([datetime.datetime.fromtimestamp(ts).isoformat(timespec="seconds"), f"{uid:08x}", amount,
+                        merchant, flag, "|".join(pos_binlog.mask_reasons(mask, kmh))])
+    print(f"{n:,} rows: CSV {os.path.getsize(csv_path) / 1e6:,.0f} MB (written in {time.perf_counter() - t0:.0f} s), "
+          f"binary {os.path.getsize(bin_path) / 1e6:,.0f} MB")
+
+    ok = True
+    last_week = int(log["ts"][-1]) - 7 * 86400
+    for label, start in (("all rows", None), ("last 7 days", last_week)):
+        t0 = time.perf_counter()
+        total, n_flagged, with_reasons, counts, speeds = explain_csv(csv_path, start)
+        t_csv = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        ex = pos_binlog.explain(pos_binlog.time_range(pos_binlog.open_binlog(bin_path), start))
+        t_bin = time.perf_counter() - t0
+        same = (total, n_flagged, with_reasons, dict(counts), speeds) == (ex["total"], ex["flagged"],
+                                                                           ex["with_reasons"], ex["counts"],
+                                                                           ex["speeds"])
+        ok &= same
+        print(f"  explainability {label:<12} CSV {t_csv:7.2f} s   binary {t_bin * 1e3:8.1f} ms  "
+              f"(x{t_csv / t_bin:,.0f})  {ex['total']:,} rows  same result: {same}")
+
+    t0 = time.perf_counter()
+    rates = pos_binlog.flag_rate(pos_binlog.open_binlog(bin_path))
+    t_rate = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    pos_binlog.reason_counts(pos_binlog.open_binlog(bin_path))
+    t_reasons = time.perf_counter() - t0
+    print(f"  flag rate per day ({len(rates)} days) {t_rate * 1e3:.1f} ms, reason counts {t_reasons * 1e3:.1f} ms")
+
+    #converting the CSV gives back the binary log byte for byte
+    conv_path = os.path.join(tmp, "converted.posb")
+    t0 = time.perf_counter()
+    pos_binlog.convert_csv(csv_path, conv_path)
+    t_conv = time.perf_counter() - t0
+    same = np.array_equal(np.asarray(pos_binlog.open_binlog(conv_path)).view(np.uint8),
+                          np.asarray(pos_binlog.open_binlog(bin_path)).view(np.uint8))
+    ok &= same
+    print(f"  CSV -> binary converter {t_conv:.1f} s ({n / t_conv:,.0f} rows/s)  identical to the binary log: {same}")
+    shutil.rmtree(tmp)
+    print("BINLOG OK" if ok else "BINLOG FAILED")
+    if not ok:
+        sys.exit(1)
+
 if __name__ == "__main__":
     #create a parser 
     p = argparse.ArgumentParser(prog="metrics")
@@ -133,6 +1106,14 @@ if __name__ == "__main__":
 
     #register explainability subcommand
     s_exp = sub.add_parser("explainability")
+    #CSV or binary (.posb) log
+    s_exp.add_argument("--log", default=LOG_PATH)
+    #time range, epoch seconds or ISO local time (start inclusive, end exclusive)
+    s_exp.add_argument("--start", default=None)
+    s_exp.add_argument("--end", default=None)
+    #binary log only: flag rate per day, count of every reason
+    s_exp.add_argument("--flag-rate", action="store_true")
+    s_exp.add_argument("--reasons", action="store_true")
     s_exp.set_defaults(func=explainability)
 
     #register resource use subcommand and add iteration argument
@@ -140,6 +1121,80 @@ if __name__ == "__main__":
     s_res.add_argument("--iters", type=int, default=200000)
     s_res.set_defaults(func=resource)
 
+    #register bounded state subcommand
+    s_state = sub.add_parser("state")
+    s_state.add_argument("--iters", type=int, default=200000)
+    s_state.add_argument("--max-entries", type=int, default=None)
+    s_state.add_argument("--ttl", type=float, default=None)
+    s_state.set_defaults(func=state)
+
+    #register window cost vs key cardinality subcommand
+    s_card = sub.add_parser("cardinality")
+    s_card.add_argument("--iters", type=int, default=500000)
+    s_card.add_argument("--rate", type=int, default=200)
+    s_card.set_defaults(func=cardinality)
+
+    #register tumbling vs sliding window subcommand
+    s_sl = sub.add_parser("sliding")
+    s_sl.add_argument("--iters", type=int, default=300000)
+    s_sl.add_argument("--bursts", type=int, default=200)
+    s_sl.set_defaults(func=sliding)
+
+    #register exact vs HLL merchant counting subcommand
+    s_hll = sub.add_parser("hll")
+    s_hll.add_argument("--cards", type=int, default=5000)
+    s_hll.add_argument("--error", type=float, default=0.02)
+    s_hll.set_defaults(func=hll)
+
+    #register batch engine parity/timing subcommand
+    s_bat = sub.add_parser("batch")
+    s_bat.add_argument("--rows", type=int, default=200000)
+    s_bat.add_argument("--cards", type=int, default=5000)
+    s_bat.add_argument("--merchants", type=int, default=500)
+    s_bat.set_defaults(func=batch)
+
+    #register startup time / RSS subcommand (zip CSV vs binary index)
+    s_st = sub.add_parser("startup")
+    s_st.add_argument("--zip-csv", default=ZIP_CSV_PATH)
+    s_st.add_argument("--runs", type=int, default=5)
+    s_st.set_defaults(func=startup)
+
+    #register snapshot/restore subcommand
+    s_snap = sub.add_parser("snapshot")
+    s_snap.add_argument("--cards", type=int, default=100000)
+    s_snap.add_argument("--merchants", type=int, default=500)
+    s_snap.add_argument("--after", type=int, default=5000)
+    s_snap.add_argument("--window-mode", default="tumbling", choices=["tumbling", "sliding"])
+    s_snap.set_defaults(func=snapshot)
+
+    #register incremental warmup subcommand
+    s_warm = sub.add_parser("warmup")
+    s_warm.add_argument("--taps", type=int, default=200)
+    s_warm.set_defaults(func=warmup)
+
+    #register simulated card ring buffer checks
+    s_cardsim = sub.add_parser("card")
+    s_cardsim.set_defaults(func=card)
+
+    #register card codec compatibility / micro benchmark
+    s_codec = sub.add_parser("codec")
+    s_codec.add_argument("--iters", type=int, default=100000)
+    s_codec.set_defaults(func=codec)
+
+    #register tx log subcommand
+    s_log = sub.add_parser("txlog")
+    s_log.add_argument("--rows", type=int, default=20000)
+    #time between rows (0 = as fast as possible)
+    s_log.add_argument("--gap-ms", type=float, default=0.0)
+    s_log.set_defaults(func=txlog)
+
+    #register binary log benchmark subcommand
+    s_bin = sub.add_parser("binlog")
+    s_bin.add_argument("--rows", type=int, default=10_000_000)
+    #directory for the generated logs (a few GB at 10M rows)
+    s_bin.add_argument("--dir", default=None)
+    s_bin.set_defaults(func=binlog)
+
     #parse the command line args
     args = p.parse_args()
     #run function
@@ -0,0 +1,161 @@
+#multi lane POS host: one worker thread per card reader (checkout lane), all feeding one shared EdgeRules
+#each lane takes charges from its own queue: wait for a card, warm up from its history, evaluate, append the tx
+#the rules are shared, so the merchant window counts cards from every lane of the store
+#(EdgeRules locks each detector separately, taps on different lanes run different detectors at the same time)
+import argparse
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+from edge.card_reader import make_readers, set_thread_reader
+from edge.edge_card import wait_for_card, read_recent_tx, pack_tx, write_recent_tx, end_session, Deadline
+from edge.edge_rules import EdgeRules
+
+#constant for merchant ID, used in transactions (one store, every lane)
+MERCHANT_ID = 1234
+#time budget for the card IO of one tap (ms), as edge_pos_loop
+TAP_BUDGET_MS = 300
+#seconds a lane waits for a card before giving up on a charge
+CARD_TIMEOUT_S = 60
+
+#one checkout lane: a reader, its charge queue and its worker thread
+class Lane:
+    def __init__(self, pool, index, reader):
+        self.pool = pool
+        self.index = index
+        self.reader = reader
+        self.charges = queue.Queue()
+        self.stats = {"taps": 0, "flagged": 0, "no_card": 0, "write_failed": 0}
+        self.thread = threading.Thread(target=self._run, name=f"lane-{index}", daemon=True)
+
+    #worker loop: the thread owns the reader, so card IO on different lanes runs in parallel
+    def _run(self):
+        set_thread_reader(self.reader)
+        while True:
+            item = self.charges.get()
+            if item is None:
+                return
+            charge, fut = item
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                result = self.pool.process(self, charge)
+            except BaseException as e:
+                fut.set_exception(e)
+                continue
+            fut.set_result(result)
+            if self.pool.on_result is not None:
+                self.pool.on_result(self, result)
+
+#pool of lanes sharing one EdgeRules
+#on_result(lane, result) is called on the lane's thread after every tap (logging, next card in a simulation, ...)
+class ReaderPool:
+    def __init__(self, rules, readers, merchant_id=MERCHANT_ID, budget_ms=TAP_BUDGET_MS,
+                 card_timeout=CARD_TIMEOUT_S, on_result=None):
+        self.rules = rules
+        self.merchant_id = merchant_id
+        self.budget_ms = budget_ms
+        self.card_timeout = card_timeout
+        self.on_result = on_result
+        self.lanes = [Lane(self, i, r) for i, r in enumerate(readers)]
+        self.started = False
+
+    def start(self):
+        if not self.started:
+            for lane in self.lanes:
+                lane.thread.start()
+            self.started = True
+        return self
+
+    #function to queue a charge on a lane, returns a Future with the tap result (see process)
+    #merchant_id None charges as the pool's merchant
+    def charge(self, lane, amount_cents, zip_code=None, merchant_id=None):
+        fut = Future()
+        merchant_id = self.merchant_id if merchant_id is None else int(merchant_id)
+        self.lanes[lane].charges.put(({"amount_cents": int(amount_cents), "zip": zip_code,
+                                       "merchant_id": merchant_id}, fut))
+        return fut
+
+    #function to stop the workers once their queued charges are done
+    def stop(self):
+        for lane in self.lanes:
+            lane.charges.put(None)
+        if self.started:
+            for lane in self.lanes:
+                lane.thread.join()
+        self.started = False
+
+    #function to run one tap on the calling lane's reader (same steps as edge_pos_loop.process_transaction)
+    #returns a dict: lane, card_id (None if no card came), flag, reasons, ok/msg of the card write,
+    #tap (deadline report) and ms (wall time of the tap from card detection)
+    def process(self, lane, charge):
+        uid = wait_for_card(timeout=self.card_timeout)
+        if not uid:
+            lane.stats["no_card"] += 1
+            return {"lane": lane.index, "card_id": None, "flag": False, "reasons": [], "ok": False,
+                    "msg": "no card", "tap": None, "ms": 0.0}
+        t0 = time.perf_counter()
+        card_id = uid.hex()
+        deadline = Deadline(self.budget_ms / 1000.0 if self.budget_ms > 0 else None)
+        #read the last 10 txs (fewer if the budget runs out) and warm up on them, oldest first
+        meta, recent = read_recent_tx(uid, max_count=10, deadline=deadline)
+        self.rules.warmup_from_card(card_id, list(reversed(recent)), partial=deadline.partial)
+
+        tx = {
+            "timestamp": int(time.time()),
+            "merchant_id": charge["merchant_id"],
+            "card_id": card_id,
+            "amount": charge["amount_cents"] / 100.0,
+            "zip": charge["zip"],
+            "lat": None,
+            "lon": None,
+        }
+        flag, reasons = self.rules.evaluate(tx)
+        rec = pack_tx(timestamp=tx["timestamp"], amount_cents=charge["amount_cents"], merchant_id=charge["merchant_id"],
+                      zip_code=charge["zip"], flags=1 if flag else 0)
+        ok, msg = write_recent_tx(uid, rec, deadline=deadline)
+        #end the card session while the card is still on the reader (writes back the cached header)
+        end_session()
+
+        lane.stats["taps"] += 1
+        lane.stats["flagged"] += 1 if flag else 0
+        lane.stats["write_failed"] += 0 if ok else 1
+        return {"lane": lane.index, "card_id": card_id, "flag": flag, "reasons": reasons, "ok": ok, "msg": msg,
+                "tap": deadline.report(), "ms": (time.perf_counter() - t0) * 1e3}
+
+#interactive host: one line per charge on stdin, "<lane> <amount_cents> [zip]"
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Multi lane POS host, one worker per card reader")
+    #comma separated reader names, e.g. pn532:D4:D20,pn532:D5:D21 (default $EDGE_READERS)
+    p.add_argument("--readers", default=None)
+    p.add_argument("--merchant", type=int, default=MERCHANT_ID)
+    p.add_argument("--budget-ms", type=int, default=TAP_BUDGET_MS)
+    args = p.parse_args()
+
+    rules = EdgeRules(zip_csv_path="data/raw/zip_lat_long.csv")
+
+    def show(lane, result):
+        if result["card_id"] is None:
+            print(f"[lane {lane.index}] no card detected")
+        else:
+            print(f"[lane {lane.index}] card {result['card_id']}: {'FLAGGED' if result['flag'] else 'OK'} "
+                  f"{result['reasons']}  append: {result['ok']} {result['msg']}  {result['ms']:.0f} ms")
+
+    pool = ReaderPool(rules, make_readers(args.readers), merchant_id=args.merchant, budget_ms=args.budget_ms,
+                      on_result=show).start()
+    print(f"{len(pool.lanes)} lane(s) ready. Enter '<lane> <amount_cents> [zip]' per charge, Ctrl-D to quit.")
+    for line in sys.stdin:
+        parts = line.split()
+        if not parts:
+            continue
+        try:
+            lane, amount = int(parts[0]), int(parts[1])
+            if not 0 <= lane < len(pool.lanes):
+                raise ValueError
+        except (ValueError, IndexError):
+            print("usage: <lane> <amount_cents> [zip]")
+            continue
+        pool.charge(lane, amount, parts[2] if len(parts) > 2 else None)
+    pool.stop()
@@ -0,0 +1,264 @@
+#binary snapshots of EdgeRules detector state, plus a replay journal of everything applied since the last snapshot
+#compact tagged binary format (no pickle), versioned and checksummed, standard library only
+import numbers
+import os
+import struct
+import zlib
+from array import array
+from collections import OrderedDict
+
+#snapshot file layout (little endian):
+#header: magic, format version, number of sections, journal sequence number, created (epoch seconds)
+#then per section: name length (1 byte), payload length (4 bytes), name, payload (one encoded value)
+#then a crc32 of everything before it
+MAGIC = b"EFRS"
+VERSION = 1
+HEADER = struct.Struct("<4sHHQd")
+SECTION = struct.Struct("<BI")
+CRC = struct.Struct("<I")
+
+#journal record: payload length, crc32 of payload, payload (one encoded (op, args) tuple)
+RECORD = struct.Struct("<II")
+#journal files sit next to the snapshot as <snapshot>.journal.<seq>
+JOURNAL_SUFFIX = ".journal."
+
+_I64 = struct.Struct("<q")
+_F64 = struct.Struct("<d")
+_U32 = struct.Struct("<I")
+
+#VALUE ENCODING
+#each value is a one byte tag followed by its data
+#N None, T/F bools, i int64, I big int, f float, s str, b bytes, t tuple, l list, L list of str,
+#d dict, o OrderedDict, a array.array, P pandas Timestamp (int ns, pandas only imported to decode one)
+#other mappings (anything with keys() and [key]) are encoded as d
+
+#function to append the encoding of v to out (bytearray)
+def encode_value(v, out):
+    if v is None:
+        out += b"N"
+    elif v is True:
+        out += b"T"
+    elif v is False:
+        out += b"F"
+    elif isinstance(v, numbers.Integral):
+        v = int(v)
+        if -(1 << 63) <= v < (1 << 63):
+            out += b"i"
+            out += _I64.pack(v)
+        else:
+            raw = str(v).encode()
+            out += b"I"
+            out += _U32.pack(len(raw))
+            out += raw
+    elif isinstance(v, float):
+        out += b"f"
+        out += _F64.pack(v)
+    elif isinstance(v, str):
+        raw = v.encode()
+        out += b"s"
+        out += _U32.pack(len(raw))
+        out += raw
+    elif isinstance(v, (bytes, bytearray, memoryview)):
+        raw = bytes(v)
+        out += b"b"
+        out += _U32.pack(len(raw))
+        out += raw
+    elif isinstance(v, array):
+        raw = v.tobytes()
+        out += b"a"
+        out += v.typecode.encode()
+        out += _U32.pack(len(raw))
+        out += raw
+    elif type(v).__name__ == "Timestamp" and hasattr(v, "value"):
+        out += b"P"
+        out += _I64.pack(v.value)
+    elif isinstance(v, tuple):
+        out += b"t"
+        out += _U32.pack(len(v))
+        for x in v:
+            encode_value(x, out)
+    elif isinstance(v, list):
+        #lists of plain strings (card ids) are stored as one NUL separated blob, much faster to load
+        if v and all(type(x) is str for x in v):
+            blob = "\0".join(v).encode()
+            if blob.count(0) == len(v) - 1:
+                out += b"L"
+                out += _U32.pack(len(v))
+                out += _U32.pack(len(blob))
+                out += blob
+                return
+        out += b"l"
+        out += _U32.pack(len(v))
+        for x in v:
+            encode_value(x, out)
+    elif isinstance(v, dict):
+        out += b"o" if isinstance(v, OrderedDict) else b"d"
+        out += _U32.pack(len(v))
+        for k, x in v.items():
+            encode_value(k, out)
+            encode_value(x, out)
+    elif hasattr(v, "keys") and hasattr(v, "__getitem__"):
+        #dict-like records (edge_card.TxRecord) are stored as plain dicts
+        encode_value({k: v[k] for k in v.keys()}, out)
+    else:
+        raise TypeError(f"cannot encode {type(v).__name__} in a rule snapshot")
+
+#function to decode one value from buf (bytes or memoryview) at offset off
+#returns (value, new offset)
+def decode_value(buf, off):
+    tag = chr(buf[off])
+    off += 1
+    if tag == "N":
+        return None, off
+    if tag == "T":
+        return True, off
+    if tag == "F":
+        return False, off
+    if tag == "i":
+        return _I64.unpack_from(buf, off)[0], off + 8
+    if tag == "f":
+        return _F64.unpack_from(buf, off)[0], off + 8
+    if tag in "sbI":
+        n = _U32.unpack_from(buf, off)[0]
+        off += 4
+        raw = bytes(buf[off:off + n])
+        if tag == "s":
+            return raw.decode(), off + n
+        if tag == "I":
+            return int(raw.decode()), off + n
+        return raw, off + n
+    if tag == "a":
+        typecode = chr(buf[off])
+        n = _U32.unpack_from(buf, off + 1)[0]
+        off += 5
+        return array(typecode, bytes(buf[off:off + n])), off + n
+    if tag == "P":
+        import pandas as pd
+        return pd.Timestamp(_I64.unpack_from(buf, off)[0]), off + 8
+    if tag in "tl":
+        n = _U32.unpack_from(buf, off)[0]
+        off += 4
+        items = []
+        for _ in range(n):
+            x, off = decode_value(buf, off)
+            items.append(x)
+        return (tuple(items) if tag == "t" else items), off
+    if tag == "L":
+        n, size = struct.unpack_from("<II", buf, off)
+        off += 8
+        return bytes(buf[off:off + size]).decode().split("\0"), off + size
+    if tag in "do":
+        n = _U32.unpack_from(buf, off)[0]
+        off += 4
+        d = OrderedDict() if tag == "o" else {}
+        for _ in range(n):
+            k, off = decode_value(buf, off)
+            d[k], off = decode_value(buf, off)
+        return d, off
+    raise ValueError(f"bad value tag {tag!r} at offset {off - 1}")
+
+#SNAPSHOT FILES
+
+#function to write sections (dict of name -> value) to path atomically
+#seq is the journal sequence number that starts right after this snapshot
+#returns the number of bytes written
+def write_snapshot(path, sections, seq, created):
+    out = bytearray(HEADER.pack(MAGIC, VERSION, len(sections), seq, created))
+    for name, value in sections.items():
+        payload = bytearray()
+        encode_value(value, payload)
+        raw = name.encode()
+        out += SECTION.pack(len(raw), len(payload))
+        out += raw
+        out += payload
+    out += CRC.pack(zlib.crc32(out))
+
+    #write to a temp file, fsync then rename so a crash never leaves a half written snapshot
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(out)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(out)
+
+#function to read a snapshot written by write_snapshot
+#returns (seq, created, sections)
+def read_snapshot(path):
+    with open(path, "rb") as f:
+        buf = f.read()
+    if len(buf) < HEADER.size + CRC.size or zlib.crc32(buf[:-CRC.size]) != CRC.unpack_from(buf, len(buf) - CRC.size)[0]:
+        raise ValueError(f"{path} is truncated or corrupt")
+    magic, version, n_sections, seq, created = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a rule snapshot")
+    if version != VERSION:
+        raise ValueError(f"{path} is snapshot version {version}, expected {VERSION}")
+    view = memoryview(buf)
+    off = HEADER.size
+    sections = {}
+    for _ in range(n_sections):
+        name_len, size = SECTION.unpack_from(buf, off)
+        off += SECTION.size
+        name = bytes(view[off:off + name_len]).decode()
+        off += name_len
+        sections[name], _ = decode_value(view[off:off + size], 0)
+        off += size
+    return seq, created, sections
+
+#JOURNAL
+
+#function to get the journal path for a snapshot path and sequence number
+def journal_path(path, seq):
+    return f"{path}{JOURNAL_SUFFIX}{seq:08d}"
+
+#function to list (seq, journal path) for a snapshot path, oldest first
+def journal_paths(path):
+    folder = os.path.dirname(path) or "."
+    prefix = os.path.basename(path) + JOURNAL_SUFFIX
+    found = []
+    for name in os.listdir(folder):
+        if name.startswith(prefix) and name[len(prefix):].isdigit():
+            found.append((int(name[len(prefix):]), os.path.join(folder, name)))
+    return sorted(found)
+
+#function to delete journals older than seq (already covered by a snapshot)
+def prune_journals(path, seq):
+    for s, p in journal_paths(path):
+        if s < seq:
+            os.remove(p)
+
+#append only log of the operations applied to the rules since a snapshot
+class Journal:
+    def __init__(self, path, seq, fsync=False):
+        self.path = journal_path(path, seq)
+        self.seq = seq
+        self.fsync = fsync
+        self.f = open(self.path, "ab")
+
+    #function to add one (op, args) record, written through to the OS (and disk if fsync)
+    def append(self, op, args):
+        payload = bytearray()
+        encode_value((op, args), payload)
+        self.f.write(RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+        self.f.flush()
+        if self.fsync:
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+#function to read (op, args) records from a journal file
+#stops at the first truncated or corrupt record (the tail of a crash)
+def read_journal(path):
+    with open(path, "rb") as f:
+        buf = f.read()
+    off = 0
+    while off + RECORD.size <= len(buf):
+        size, crc = RECORD.unpack_from(buf, off)
+        payload = buf[off + RECORD.size:off + RECORD.size + size]
+        if len(payload) != size or zlib.crc32(payload) != crc:
+            return
+        off += RECORD.size + size
+        record, _ = decode_value(payload, 0)
+        yield record
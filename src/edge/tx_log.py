@@ -0,0 +1,230 @@
+#POS transaction log (CSV or binary, see pos_binlog) written by a background thread
+#append() only puts the row on a bounded queue, the writer thread formats and writes whatever has queued up since
+#its last write in one go (group commit), optionally fsyncs it, and rotates the file by size and/or age
+#flush() waits until every row appended before it is written, close() flushes and stops the writer
+#(also run at interpreter exit, so rows still queued at shutdown are written)
+import atexit
+import csv
+import datetime
+import os
+import queue
+import threading
+import time
+
+from edge import pos_binlog
+
+#columns of the POS log
+HEADER = ["ts_iso", "uid", "amount_cents", "merchant_id", "flag", "reasons"]
+#rows that can wait for the writer before append() blocks (or drops, see block)
+QUEUE_ROWS = 4096
+#rows written per group commit at most
+BATCH_ROWS = 512
+#seconds between checks that the writer is still alive while waiting for room on the queue
+WRITER_CHECK_S = 0.5
+
+#queue markers
+_STOP = object()
+
+#log file with a background writer
+#fsync=True makes every group commit durable before flush() returns (one disk flush per commit, not per row)
+#rotate_bytes / rotate_s start a new file once the current one is that big / that old, the old ones are kept
+#as path.1 (newest) .. path.<keep>
+#block=True makes append() wait for room when the queue is full, False drops the row (counted in stats); rows
+#appended after the writer thread has died are dropped either way
+#fmt "csv" (the columns in HEADER) or "bin" (fixed width records with a reason bitmask, see pos_binlog)
+class TxLog:
+    def __init__(self, path, fsync=False, rotate_bytes=None, rotate_s=None, keep=5, max_queue=QUEUE_ROWS,
+                 batch_rows=BATCH_ROWS, block=True, fmt="csv"):
+        if fmt not in ("csv", "bin"):
+            raise ValueError(f"unknown log format {fmt!r} (use 'csv' or 'bin')")
+        self.path = path
+        self.fmt = fmt
+        self.fsync = fsync
+        self.rotate_bytes = rotate_bytes
+        self.rotate_s = rotate_s
+        self.keep = keep
+        self.batch_rows = batch_rows
+        self.block = block
+        self.closed = False
+        self.error = None
+        self.stats = {"rows": 0, "commits": 0, "fsyncs": 0, "rotations": 0, "dropped": 0, "blocked": 0,
+                      "max_batch": 0, "failed": 0, "bad_rows": 0, "other_reasons": 0}
+        self._q = queue.Queue(max_queue)
+        self._f = None
+        self._opened = None
+        self._close_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="tx-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    #function to log a transaction (tx dict with timestamp, card_id, amount_cents, merchant_id)
+    #returns False if the row was dropped (queue full with block=False) or the log is closed
+    def append(self, tx, edge_flag, reasons):
+        if self.closed:
+            return False
+        if not self._thread.is_alive():
+            #the writer died, the row could only sit on the queue
+            self.stats["dropped"] += 1
+            return False
+        row = (tx["timestamp"], tx["card_id"], tx["amount_cents"], tx["merchant_id"], int(edge_flag), tuple(reasons))
+        try:
+            self._q.put_nowait(row)
+        except queue.Full:
+            if not self.block:
+                self.stats["dropped"] += 1
+                return False
+            self.stats["blocked"] += 1
+            if not self._put(row):
+                self.stats["dropped"] += 1
+                return False
+        return True
+
+    #function to put an item on the queue, waiting for room only while the writer thread is alive
+    #(a dead writer never empties the queue, so the caller would wait forever)
+    #returns False if the writer is gone
+    def _put(self, item):
+        while self._thread.is_alive():
+            try:
+                self._q.put(item, timeout=WRITER_CHECK_S)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    #function to wait until every row appended so far is written (and fsynced if fsync=True)
+    #returns False on timeout or if the writer hit an error (see self.error)
+    def flush(self, timeout=None):
+        if not self._thread.is_alive():
+            return self.error is None
+        done = threading.Event()
+        if not self._put(done):
+            return False
+        return done.wait(timeout) and self.error is None
+
+    #function to write everything still queued and stop the writer (safe to call more than once)
+    def close(self, timeout=None):
+        with self._close_lock:
+            if self.closed:
+                return self.error is None
+            self.closed = True
+        if self._thread.is_alive():
+            self._q.put(_STOP)
+            self._thread.join(timeout)
+        atexit.unregister(self.close)
+        return self.error is None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #WRITER THREAD
+
+    def _run(self):
+        try:
+            while True:
+                #wait for the first row, then take whatever else has queued up meanwhile
+                batch = [self._q.get()]
+                while len(batch) < self.batch_rows:
+                    try:
+                        batch.append(self._q.get_nowait())
+                    except queue.Empty:
+                        break
+                rows = [item for item in batch if isinstance(item, tuple)]
+                if rows:
+                    self._commit(rows)
+                for item in batch:
+                    if isinstance(item, threading.Event):
+                        item.set()
+                if _STOP in batch:
+                    return
+        except BaseException as e:
+            #the writer is dying (append() drops rows from now on), flush() and close() report it
+            self.error = e
+            raise
+        finally:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+    #function to format one row for the log file (bytes for "bin", a list of csv fields for "csv")
+    #a "bin" row with a reason that has no bit keeps it only as "other", counted in stats["other_reasons"]
+    def _format(self, row):
+        if self.fmt == "bin":
+            if any(pos_binlog.reason_name(r) not in pos_binlog.REASON_BITS for r in row[5]):
+                self.stats["other_reasons"] += 1
+            return pos_binlog.pack_row(*row)
+        ts, uid, amount, merchant, flag, reasons = row
+        return [datetime.datetime.fromtimestamp(ts).isoformat(timespec="seconds"), uid, amount, merchant, flag,
+                "|".join(reasons)]
+
+    #function to write one group of rows
+    #a row that can't be formatted (e.g. an out of range timestamp or amount) is skipped and counted in
+    #stats["bad_rows"], the rest of the group is still written
+    def _commit(self, rows):
+        out = []
+        for row in rows:
+            try:
+                out.append(self._format(row))
+            except Exception:
+                self.stats["bad_rows"] += 1
+        if not out:
+            return
+        try:
+            if self._f is None or self._due():
+                self._open(rotate=self._f is not None)
+            if self.fmt == "bin":
+                self._f.write(b"".join(out))
+            else:
+                csv.writer(self._f).writerows(out)
+            self._f.flush()
+            if self.fsync:
+                os.fsync(self._f.fileno())
+                self.stats["fsyncs"] += 1
+        except Exception as e:
+            #keep the writer alive (the disk may come back), the rows of this commit are lost
+            self.error = e
+            self.stats["failed"] += len(out)
+            if self._f is not None:
+                try:
+                    self._f.close()
+                except OSError:
+                    pass
+                self._f = None
+            return
+        #the file is writable again, flush() reports success from here on
+        self.error = None
+        self.stats["rows"] += len(out)
+        self.stats["commits"] += 1
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(out))
+
+    #function to check whether the current file is due for rotation
+    def _due(self):
+        if self.rotate_bytes is not None and self._f.tell() >= self.rotate_bytes:
+            return True
+        return self.rotate_s is not None and time.monotonic() - self._opened >= self.rotate_s
+
+    #function to open the log file (rotating the current one out first if asked), writing the header to a new file
+    def _open(self, rotate=False):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if rotate:
+            #path.<keep> is dropped, path.i -> path.i+1, path -> path.1
+            for i in range(self.keep - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            if self.keep > 0:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+            self.stats["rotations"] += 1
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._f = open(self.path, "ab") if self.fmt == "bin" else open(self.path, "a", newline="")
+        self._opened = time.monotonic()
+        if self._f.tell() == 0:
+            if self.fmt == "bin":
+                self._f.write(pos_binlog.file_header())
+            else:
+                csv.writer(self._f).writerow(HEADER)
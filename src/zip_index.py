@@ -0,0 +1,126 @@
+#compact binary zip code -> (lat, long) index
+#built once from the zip CSV, then memory mapped at startup instead of parsing the CSV with pandas
+#only uses the standard library so the edge runtime can look up zips without pandas
+import argparse
+import array
+import bisect
+import csv
+import mmap
+import os
+import struct
+import sys
+
+#file layout (native little endian):
+#header: magic, version, number of zips, 4 spare bytes (16 bytes)
+#then count x uint32 zips (sorted), count x float32 lat, count x float32 long
+MAGIC = b"ZIPX"
+VERSION = 1
+HEADER = struct.Struct("<4sII4x")
+#file extension used for built indexes
+INDEX_SUFFIX = ".zidx"
+
+#function to turn a zip code (string or int) into the integer key used by the index and the CSV dict
+#(ZipToCoord), so "02134", "2134" and 2134 are the same zip whichever way the table was loaded
+#returns None if there are no digits or too many to be a zip
+def zip_key(zip_code):
+    z = "".join(ch for ch in str(zip_code) if ch.isdigit())
+    if not z or len(z) > 9:
+        return None
+    return int(z)
+
+#function to find the index file to use for a source path
+#returns the source itself if it is an index, or a built index next to the CSV if it is at least as new as the CSV
+def index_path_for(source):
+    source = os.fspath(source)
+    if source.endswith(INDEX_SUFFIX):
+        return source
+    candidate = os.path.splitext(source)[0] + INDEX_SUFFIX
+    try:
+        if os.path.getmtime(candidate) >= os.path.getmtime(source):
+            return candidate
+    except OSError:
+        pass
+    return None
+
+#function to read a coordinate from the CSV, an empty one is NaN (as pandas and the ZipToCoord dict read it)
+def coord(v):
+    return float(v) if v.strip() else float("nan")
+
+#function to build the binary index from the zip CSV (columns ZIP, LAT, LNG)
+#duplicate zips keep the last row, same as the old dict build
+#returns the number of zips written
+def build_index(csv_path, out_path=None):
+    if out_path is None:
+        out_path = os.path.splitext(csv_path)[0] + INDEX_SUFFIX
+    coords = {}
+    with open(csv_path, newline="") as f:
+        for row in csv.DictReader(f):
+            key = zip_key(row["ZIP"])
+            if key is None:
+                continue
+            coords[key] = (coord(row["LAT"]), coord(row["LNG"]))
+
+    keys = sorted(coords)
+    zips = array.array("I", keys)
+    lats = array.array("f", (coords[k][0] for k in keys))
+    lons = array.array("f", (coords[k][1] for k in keys))
+    #files are always little endian
+    if sys.byteorder != "little":
+        for a in (zips, lats, lons):
+            a.byteswap()
+
+    #write to a temp file then rename so a half written index is never picked up
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(keys)))
+        f.write(zips.tobytes())
+        f.write(lats.tobytes())
+        f.write(lons.tobytes())
+    os.replace(tmp_path, out_path)
+    return len(keys)
+
+#read only view of a built index, looked up by binary search over the mapped zip array
+class ZipIndex:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} zip index")
+        self.count = count
+
+        #slice the mapped file into the three arrays (no copies on little endian machines)
+        off = HEADER.size
+        view = memoryview(self._mm)
+        if sys.byteorder == "little":
+            self._zips = view[off:off + 4 * count].cast("I")
+            self._lats = view[off + 4 * count:off + 8 * count].cast("f")
+            self._lons = view[off + 8 * count:off + 12 * count].cast("f")
+        else:
+            self._zips = array.array("I", view[off:off + 4 * count])
+            self._lats = array.array("f", view[off + 4 * count:off + 8 * count])
+            self._lons = array.array("f", view[off + 8 * count:off + 12 * count])
+            for a in (self._zips, self._lats, self._lons):
+                a.byteswap()
+
+    def __len__(self):
+        return self.count
+
+    #function to get (lat, long) for a zip code, or (None, None) if it is not in the index
+    def get(self, zip_code):
+        key = zip_key(zip_code)
+        if key is None:
+            return (None, None)
+        i = bisect.bisect_left(self._zips, key)
+        if i < self.count and self._zips[i] == key:
+            return (self._lats[i], self._lons[i])
+        return (None, None)
+
+if __name__ == "__main__":
+    #one time build step, e.g. python src/zip_index.py data/raw/zip_lat_long.csv
+    p = argparse.ArgumentParser(description="Build the binary zip -> coords index from the zip CSV")
+    p.add_argument("csv_path")
+    p.add_argument("out_path", nargs="?", help="defaults to the CSV path with a .zidx extension")
+    args = p.parse_args()
+    n = build_index(args.csv_path, args.out_path)
+    print(f"wrote {n:,} zips to {args.out_path or os.path.splitext(args.csv_path)[0] + INDEX_SUFFIX}")
@@ -0,0 +1,5 @@
+import os, sys
+#put src on the path so tests import the modules the same way the edge scripts do
+SRC_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "src"))
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
@@ -0,0 +1,103 @@
+#RuleCombiner.evaluate_frame must give the same flags as streaming every row through rule_flags()
+import numpy as np
+import pandas as pd
+import pytest
+
+from baseline_detector import (
+    RuleCombiner, MerchantBaseline, CardBaseline, AmountCap, CardEWMA, ImpossibleTravel
+)
+
+RULES = ["merchant_window", "card_window", "amount_cap", "card_ewma", "impossible_travel"]
+
+#function to build a combiner with the edge rule parameters (window options passed to both window rules)
+def combiner(int_epoch=True, window_mode="tumbling", distinct="exact"):
+    return RuleCombiner(
+        MerchantBaseline(threshold=6, int_epoch=int_epoch, window_mode=window_mode, distinct=distinct),
+        CardBaseline(threshold=3, int_epoch=int_epoch, window_mode=window_mode),
+        AmountCap(cap=1750),
+        CardEWMA(alpha=0.2, k=5, initial=10, min_gate=100),
+        ImpossibleTravel(vmax_kmh=600.0, min_km=150.0, min_dt_s=60.0),
+    )
+
+#function to build a small stream with busy merchants, card sprees, amount spikes and far away taps
+def frame(n=4000, seed=0, int_ts=False):
+    rng = np.random.default_rng(seed)
+    ts = 1_700_000_000 + np.cumsum(rng.integers(0, 2, n))
+    cards = rng.integers(0, 300, n)
+    merchants = rng.integers(0, 200, n)
+    busy = rng.random(n) < 0.2
+    merchants[busy] = rng.integers(0, 3, busy.sum())
+    spree = rng.random(n) < 0.05
+    cards[spree] = rng.integers(0, 5, spree.sum())
+    amounts = np.round(np.exp(rng.normal(3.0, 0.6, n)), 2)
+    spike = rng.random(n) < 0.01
+    amounts[spike] *= 60
+    cities = np.array([(40.76, -73.99), (34.02, -118.49), (41.88, -87.63)])
+    pick = cards % len(cities)
+    away = rng.random(n) < 0.05
+    pick[away] = rng.integers(0, len(cities), away.sum())
+    lat = cities[pick, 0].astype(object)
+    lon = cities[pick, 1].astype(object)
+    missing = rng.random(n) < 0.1
+    lat[missing] = None
+    lon[missing] = None
+    return pd.DataFrame({
+        "timestamp": ts if int_ts else pd.to_datetime(ts, unit="s"),
+        "merchant_id": merchants,
+        "card_id": [f"c{c}" for c in cards],
+        "amount": amounts,
+        "lat": lat,
+        "lon": lon,
+    })
+
+#function to check evaluate_frame against rule_flags row for row (on fresh combiners)
+def assert_parity(df, **kw):
+    streaming = combiner(**kw)
+    stream = [streaming.rule_flags(tx) for tx in df.to_dict("records")]
+    out = combiner(**kw).evaluate_frame(df)
+    for rule in RULES:
+        expected = [r[rule] for r in stream]
+        assert out[rule].tolist() == expected, rule
+    assert out["flag"].tolist() == [any(r.values()) for r in stream]
+    return out
+
+#in order tumbling/exact: every window rule takes the grouped (vectorised) path
+@pytest.mark.parametrize("int_ts", [False, True])
+def test_in_order_fast_path(int_ts):
+    out = assert_parity(frame(int_ts=int_ts))
+    #the data must actually exercise the rules, or parity proves nothing
+    for rule in ("merchant_window", "card_window", "amount_cap", "impossible_travel"):
+        assert out[rule].any(), rule
+
+#pandas bucket keys instead of epoch ints
+def test_in_order_pandas_buckets():
+    assert_parity(frame(), int_epoch=False)
+
+#rows out of time order: the window rules fall back to replaying row by row
+def test_out_of_order_falls_back():
+    df = frame(seed=1)
+    rng = np.random.default_rng(1)
+    #swap some neighbouring rows so time goes backwards in places
+    order = np.arange(len(df))
+    for i in rng.choice(len(df) - 1, 200, replace=False):
+        order[i], order[i + 1] = order[i + 1], order[i]
+    df = df.iloc[order].reset_index(drop=True)
+    assert not df["timestamp"].is_monotonic_increasing
+    assert_parity(df)
+
+#sliding windows are replayed row by row
+def test_sliding_window_mode():
+    out = assert_parity(frame(seed=2), window_mode="sliding")
+    assert out["merchant_window"].any()
+
+#HLL merchant counts are replayed row by row
+def test_hll_merchant_distinct():
+    out = assert_parity(frame(seed=3), distinct="hll")
+    assert out["merchant_window"].any()
+
+#evaluate_frame must not touch the combiner's live state
+def test_live_state_untouched():
+    comb = combiner()
+    comb.evaluate_frame(frame(n=500))
+    assert len(comb.ce.state) == 0
+    assert len(comb.m.win.counts) == 0
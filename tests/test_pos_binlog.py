@@ -0,0 +1,41 @@
+#CSV -> binary log conversion keeps every reason name or refuses to convert
+import csv
+import os
+
+import pytest
+
+from edge import pos_binlog
+
+#function to write a CSV log with one row per reasons string
+def write_csv(path, reasons):
+    with open(path, "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["ts_iso", "uid", "amount_cents", "merchant_id", "flag", "reasons"])
+        for i, r in enumerate(reasons):
+            w.writerow([f"2026-01-01T10:00:{i:02d}", "04a1b2c3", 999, 1234, 1 if r else 0, r])
+
+def rows(path):
+    with open(path, "rb") as f:
+        data = f.read()[pos_binlog.HEADER.size:]
+    size = pos_binlog.RECORD.size
+    return [pos_binlog.unpack_row(data[i:i + size]) for i in range(0, len(data), size)]
+
+def test_known_reasons_round_trip(tmp_path):
+    src, dst = os.path.join(tmp_path, "log.csv"), os.path.join(tmp_path, "log.posb")
+    reasons = ["", "merchant_window|card_ewma", "impossible_travel_812kmh", "amount_cap"]
+    write_csv(src, reasons)
+    assert pos_binlog.convert_csv(src, dst) == 4
+    assert ["|".join(r[5]) for r in rows(dst)] == reasons
+
+def test_unknown_reason_is_refused(tmp_path):
+    src, dst = os.path.join(tmp_path, "log.csv"), os.path.join(tmp_path, "log.posb")
+    write_csv(src, ["card_window", "velocity_spike", ""])
+    with pytest.raises(ValueError, match="line 3: reason 'velocity_spike'"):
+        pos_binlog.convert_csv(src, dst)
+    assert not os.path.exists(dst)
+
+def test_unknown_reason_stored_as_other_when_allowed(tmp_path):
+    src, dst = os.path.join(tmp_path, "log.csv"), os.path.join(tmp_path, "log.posb")
+    write_csv(src, ["card_window", "velocity_spike|card_ewma"])
+    assert pos_binlog.convert_csv(src, dst, allow_other=True) == 2
+    assert [r[5] for r in rows(dst)] == [["card_window"], ["card_ewma", "other"]]
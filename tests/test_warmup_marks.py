@@ -0,0 +1,133 @@
+#warmup marks: every card record is applied to the detectors once, however often and however far the card is read
+import os
+import random
+
+from edge.edge_rules import EdgeRules
+from edge import edge_card as ec
+from edge.card_reader import SimulatedReader, SimulatedCard, set_reader
+
+T0 = 1_700_000_000
+
+#function to make n card records, one a minute from start (as read_recent_tx returns them, reversed to oldest first)
+def records(n, start=T0, merchant=2000):
+    rng = random.Random(start)
+    return [{"timestamp": start + i * 60, "amount_cents": rng.randint(100, 4000), "merchant_id": merchant + i,
+             "zip": None} for i in range(n)]
+
+#number of records the EWMA detector has seen for a card
+def seen(rules, card="c1"):
+    state = rules.ewma.state.get(card)
+    return state[2] if state else 0
+
+#function to evaluate a tx for card at ts and return the record the terminal writes back to the card
+def tap(rules, ts, card="c1"):
+    tx = {"timestamp": ts, "merchant_id": 1234, "card_id": card, "amount": 12.5}
+    rules.evaluate(tx)
+    return {"timestamp": ts, "amount_cents": 1250, "merchant_id": 1234, "zip": None}
+
+def test_repeat_tap_applies_nothing():
+    rules = EdgeRules()
+    ring = records(10)
+    assert rules.warmup_from_card("c1", ring) == 10
+    for _ in range(3):
+        assert rules.warmup_from_card("c1", ring) == 0
+    assert seen(rules) == 10
+
+#two records in the same second, the first applied by an earlier tap, the second written since by another terminal
+def test_same_second_applies_only_the_new_record():
+    rules = EdgeRules()
+    ring = records(5)
+    assert rules.warmup_from_card("c1", ring) == 5
+    ring.append(dict(ring[-1], merchant_id=3000, amount_cents=999))
+    assert rules.warmup_from_card("c1", ring) == 1
+    assert rules.warmup_from_card("c1", ring) == 0
+    assert seen(rules) == 6
+
+#the tx an evaluate applied is written to the card, the next tap reads it back and must not count it again
+def test_evaluate_write_retap_counts_the_tap_once():
+    rules = EdgeRules()
+    ring = records(10)
+    rules.warmup_from_card("c1", ring)
+    for i in range(5):
+        ring.append(tap(rules, ring[-1]["timestamp"] + i % 2))
+        assert rules.warmup_from_card("c1", ring[-10:]) == 0
+    assert seen(rules) == 15
+
+#a deadline cut read has the newest records only: the ones it missed are applied by the next full read
+def test_partial_read_does_not_skip_unread_records():
+    rules = EdgeRules()
+    ring = records(4)
+    rules.warmup_from_card("c1", ring)
+    #another terminal writes 6 records, this terminal's read is cut after the newest 2
+    ring += records(6, start=ring[-1]["timestamp"] + 60, merchant=3000)
+    assert rules.warmup_from_card("c1", ring[-2:], partial=True) == 2
+    ring.append(tap(rules, ring[-1]["timestamp"] + 5))
+    #next tap reads everything: only the 4 records the cut read missed are new
+    assert rules.warmup_from_card("c1", ring[-10:]) == 4
+    assert rules.warmup_from_card("c1", ring[-10:]) == 0
+    assert seen(rules) == len(ring)
+    #the gap is closed, the mark is at the newest record again
+    assert rules.marks["c1"] == (ring[-1]["timestamp"], 1)
+
+#a card seen for the first time through a cut read (or with no records read at all)
+def test_first_partial_read_keeps_the_older_records_applicable():
+    rules = EdgeRules()
+    ring = records(10)
+    assert rules.warmup_from_card("c1", [], partial=True) == 0
+    assert rules.warmup_from_card("c1", ring[-3:], partial=True) == 3
+    assert rules.warmup_from_card("c1", ring[-5:], partial=True) == 2
+    ring.append(tap(rules, ring[-1]["timestamp"] + 1))
+    assert rules.warmup_from_card("c1", ring[-10:]) == 4
+    assert seen(rules) == 10
+    assert rules.warmup_from_card("c1", ring[-10:]) == 0
+
+#a cut read that still reaches back past the mark's second has no gap, it is an ordinary warmup
+def test_partial_read_reaching_past_the_mark_is_exact():
+    rules = EdgeRules()
+    ring = records(6)
+    rules.warmup_from_card("c1", ring)
+    ring += records(2, start=ring[-1]["timestamp"] + 60, merchant=3000)
+    assert rules.warmup_from_card("c1", ring[-4:], partial=True) == 2
+    assert rules.marks["c1"] == (ring[-1]["timestamp"], 1)
+
+#a card with a gap survives a snapshot and restore
+def test_gap_survives_snapshot(tmp_path):
+    rules = EdgeRules()
+    ring = records(4)
+    rules.warmup_from_card("c1", ring)
+    ring += records(4, start=ring[-1]["timestamp"] + 60, merchant=3000)
+    rules.warmup_from_card("c1", ring[-1:], partial=True)
+    path = os.path.join(tmp_path, "rules.snap")
+    rules.snapshot(path)
+    fresh = EdgeRules()
+    fresh.restore(path)
+    assert fresh.marks["c1"] == rules.marks["c1"]
+    assert fresh.warmup_from_card("c1", ring) == 3
+    assert seen(fresh) == 8
+
+#the same through the card simulator: a slow reader and a tight budget cut the read, the next read fills in the rest
+def test_deadline_cut_read_on_simulated_card():
+    reader = SimulatedReader(SimulatedCard(), latency={"select": 0, "auth": 0, "read": 0, "write": 0})
+    set_reader(reader)
+    try:
+        uid = reader.card.uid
+        ec.reset_header(uid)
+        for r in records(10):
+            ec.write_recent_tx(uid, ec.pack_tx(r["timestamp"], r["amount_cents"], r["merchant_id"], 0))
+            ec.end_session()
+        rules = EdgeRules()
+        #the header takes ~80 ms at this latency and each ring sector ~40 ms, so the budget ends in the ring
+        reader.latency = {"select": 0.002, "auth": 0.01, "read": 0.01, "write": 0}
+        deadline = ec.Deadline(0.1)
+        meta, recent = ec.read_recent_tx(uid, max_count=10, deadline=deadline)
+        ec.end_session(flush=False)
+        assert deadline.partial and 0 < len(recent) < 10
+        assert rules.warmup_from_card(uid.hex(), list(reversed(recent)), partial=True) == len(recent)
+        reader.latency = {"select": 0, "auth": 0, "read": 0, "write": 0}
+        meta, recent = ec.read_recent_tx(uid, max_count=10)
+        ec.end_session(flush=False)
+        rules.warmup_from_card(uid.hex(), list(reversed(recent)))
+        assert len(recent) == 10
+        assert seen(rules, uid.hex()) == 10
+    finally:
+        set_reader(None)
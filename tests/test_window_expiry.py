@@ -0,0 +1,54 @@
+#window buckets expire on one event clock for every key (BucketExpiry), these tests pin what that means
+import random
+
+from baseline_detector import MerchantWindow
+
+#reference: the original per key pruning, each update drops only this key's buckets behind its own event
+class PerKeyWindow:
+    def __init__(self, window_s=30, keep_windows=10):
+        self.window = window_s
+        self.keep = keep_windows
+        self.counts = {}
+
+    def update(self, key, ts, item):
+        bucket = ts // self.window
+        buckets = self.counts.setdefault(key, {})
+        buckets.setdefault(bucket, set()).add(item)
+        n = len(buckets[bucket])
+        for b in [b for b in buckets if b < bucket - self.keep]:
+            del buckets[b]
+        return n
+
+#for time ordered input the shared clock gives the same counts as per key pruning
+def test_in_order_matches_per_key_pruning():
+    rng = random.Random(0)
+    win, ref = MerchantWindow(int_epoch=True), PerKeyWindow()
+    t = 1_700_000_000
+    for _ in range(20_000):
+        t += rng.randint(0, 3)
+        k, item = rng.randrange(50), rng.randrange(8)
+        assert win.update(k, t, item) == ref.update(k, t, item)
+
+#a late event still inside the horizon joins the items already in its bucket
+def test_late_event_inside_horizon_is_counted_with_its_bucket():
+    win = MerchantWindow(int_epoch=True)
+    t0 = 1_700_000_010
+    win.update("m", t0, "a")
+    #the clock moves on 5 buckets (keep_windows is 10)
+    win.update("other", t0 + 5 * 30, "x")
+    assert win.update("m", t0, "b") == 2
+
+#a late event behind the horizon set by another key's newer events is counted on its own and not stored,
+#where per key pruning would still have counted it with the key's earlier item
+def test_late_event_behind_horizon_counts_alone():
+    win, ref = MerchantWindow(int_epoch=True), PerKeyWindow()
+    t0 = 1_700_000_010
+    for w in (win, ref):
+        w.update("m", t0, "a")
+        #only another key moves the clock 20 buckets on
+        w.update("other", t0 + 20 * 30, "x")
+    assert ref.update("m", t0, "b") == 2
+    assert win.update("m", t0, "b") == 1
+    #nothing was stored for the late event, and the expired bucket is gone
+    assert "m" not in win.counts
+    assert win.update("m", t0, "c") == 1
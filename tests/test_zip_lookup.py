@@ -0,0 +1,42 @@
+#ZipToCoord must answer the same with the built binary index as with the CSV dict
+import math
+
+import pytest
+
+from baseline_detector import ZipToCoord
+from zip_index import build_index
+
+ROWS = "ZIP,LAT,LNG\n2134,42.35,-71.13\n10036,40.76,-73.99\n99999,,\n"
+
+@pytest.fixture
+def lookups(tmp_path):
+    csv_path = tmp_path / "zips.csv"
+    csv_path.write_text(ROWS)
+    by_dict = ZipToCoord(str(csv_path), use_index=False)
+    #a blank coordinate must not stop the index build
+    assert build_index(str(csv_path)) == 3
+    by_index = ZipToCoord(str(csv_path))
+    assert by_index._index is not None
+    return by_dict, by_index
+
+#function to compare coords from the two paths (the index stores float32, NaN for a blank coordinate)
+def same(a, b):
+    if a == (None, None) or b == (None, None):
+        return a == b
+    return all((math.isnan(x) and math.isnan(y)) or abs(x - y) < 1e-4 for x, y in zip(a, b))
+
+@pytest.mark.parametrize("zip_code", ["2134", "02134", 2134, "10036", 10036, " 10036 ", "99999", "12345",
+                                      "", "abc", None])
+def test_index_and_dict_agree(lookups, zip_code):
+    by_dict, by_index = lookups
+    assert same(by_dict.get(zip_code), by_index.get(zip_code))
+
+def test_leading_zero_zip_found(lookups):
+    for lookup in lookups:
+        assert lookup.get("02134") != (None, None)
+        assert lookup.get("2134") == lookup.get("02134")
+
+def test_blank_coordinate_is_nan(lookups):
+    for lookup in lookups:
+        lat, lon = lookup.get("99999")
+        assert math.isnan(lat) and math.isnan(lon)